@@ -52,22 +52,28 @@ sudo python acquisition.py
 #    import sys
 #    sys.path.insert(1,'/home/leon/Software/magpy-git/')
 
-import threading
 import sys, getopt, os
 from datetime import datetime, timezone
 import time
 import socket
 import subprocess
 import importlib
+import importlib.util
 
-## Import MagPy packages
+## Startup profiling (option --profile-startup) - enabled before all heavy imports
+## -----------------------------------------------------------
+from martas.core.startup import StartupProfiler
+profiler = StartupProfiler(enabled='--profile-startup' in sys.argv)
+
+## MagPy (credentials) and protocol libraries are imported on demand
 ## -----------------------------------------------------------
-from magpy.opt import cred as mpcred
 
 ## Import specific MARTAS packages
 ## -----------------------------------------------------------
 sys.path.insert(1,'/home/leon/Software/MARTAS/')
 from martas.core import methods as mm
+from martas.core.bufferwriter import get_pool
+from martas.core.scheduler import get_scheduler
 from martas.version import __version__
 
 ## Import MQTT
@@ -88,7 +94,7 @@ if sys.platform == 'win32':
 
 from twisted.internet import reactor
 from twisted.python import log
-from twisted.internet.serialport import SerialPort
+# twisted.internet.serialport (and pyserial) is imported by passive_thread
 
 
 # ###################################################################
@@ -232,10 +238,80 @@ def SendInit(confdict,sensordict):
     """
     pass
 
-def do_every (interval, worker_func, iterations = 0):
-    if iterations != 1:
-        threading.Timer(interval,do_every, [interval, worker_func, 0 if iterations == 0 else iterations-1]).start ()
-    worker_func()
+_protocol_classes = {}
+
+def protocol_module(protocolname):
+    """
+    DESCRIPTION:
+    returns module and class name of a supported protocol
+    """
+    return "martas.lib.{}protocol".format(protocolname.lower()), "{}Protocol".format(protocolname)
+
+def resolve_protocols(sensorlist):
+    """
+    DESCRIPTION:
+    check the protocols named in sensors.cfg without importing them.
+    Only these protocols are imported later on (when the sensor thread starts).
+    RETURNS:
+    list of available protocol names
+    """
+    available = []
+    for protocolname in sorted(set([sensor.get('protocol') for sensor in sensorlist if sensor.get('protocol')])):
+        if not protocolname in SUPPORTED_PROTOCOLS:
+            log.msg("  -> protocol {} not in SUPPORTED_PROTOCOLS".format(protocolname))
+            continue
+        module, cls = protocol_module(protocolname)
+        try:
+            spec = importlib.util.find_spec(module)
+        except ImportError:
+            spec = None
+        if spec is None:
+            log.msg("  -> protocol library {} not found".format(module))
+            continue
+        available.append(protocolname)
+    return available
+
+def load_protocol(protocolname, debug=False):
+    """
+    DESCRIPTION:
+    import the protocol library on first use and return the protocol class
+    """
+    protclass = _protocol_classes.get(protocolname)
+    if protclass is None:
+        module, cls = protocol_module(protocolname)
+        if debug:
+            log.msg("DEBUG -> Importing: {} from {}".format(cls,module))
+        protclass = getattr(importlib.import_module(module), cls)
+        _protocol_classes[protocolname] = protclass
+        profiler.mark("protocol {} imported".format(protocolname))
+        if debug:
+            print("... importing done")
+    return protclass
+
+def profile_first_publish(client):
+    """
+    DESCRIPTION:
+    report the startup profile together with the first published data
+    """
+    publish = client.publish
+    def first_publish(topic, *args, **kwargs):
+        if not profiler.reported and str(topic).endswith('data'):
+            profiler.mark("first sample published ({})".format(topic))
+            log.msg(profiler.report())
+            profiler.disable()
+            client.publish = publish
+        return publish(topic, *args, **kwargs)
+    client.publish = first_publish
+
+def do_every (interval, worker_func, iterations = 0, name=None):
+    """
+    DESCRIPTION:
+    call worker_func every interval seconds - all periodic calls are handled by
+    a single drift free scheduler (core/scheduler.py)
+    """
+    if not name:
+        name = getattr(worker_func, '__qualname__', 'job')
+    return get_scheduler().add(name, interval, worker_func, iterations=iterations)
 
 def active_thread(confdict,sensordict, mqttclient, activeconnections):
     """
@@ -254,14 +330,9 @@ def active_thread(confdict,sensordict, mqttclient, activeconnections):
     protlst = [activeconnections[key] for key in activeconnections]
     amount = protlst.count(protocolname) + 1 # LoadTEST_1234 existing connections (new amount is len(exist)+1)
     if protocolname in SUPPORTED_PROTOCOLS:
-        module = "martas.lib.{}protocol".format(protocolname.lower())
-        cls = "{}Protocol".format(protocolname)
         pname =  "{}{}".format(protocolname, amount)
+        prot[pname] = load_protocol(protocolname, debug=confdict.get('debug') == 'True')
         if confdict.get('debug') == 'True':
-            log.msg("DEBUG -> Importing: {} from {}".format(cls,module))
-        prot[pname] = getattr(importlib.import_module(module), cls)
-        if confdict.get('debug') == 'True':
-            print("... importing done")
             print("Initializing the protocol ...")
         protocol = prot.get(pname)(mqttclient, sensordict, confdict)
         log.msg("... protocol successfully initialized")
@@ -277,7 +348,7 @@ def active_thread(confdict,sensordict, mqttclient, activeconnections):
         log.msg("  -> did not find appropriate sampling rate - using 30 sec")
         rate = 30.
 
-    do_every(rate, protocol.sendRequest)
+    do_every(rate, protocol.sendRequest, name=sensorid)
 
     activeconnection = {sensorid: protocolname}
     log.msg("  -> active connection established ... sampling every {} sec".format(rate))
@@ -302,14 +373,9 @@ def passive_thread(confdict,sensordict, mqttclient, establishedconnections):
     amount = protlst.count(protocolname) + 1 # Load existing connections (new amount is len(exist)+1)
     #amount = 1                           # Load existing connections (new amount is len(exist)+1)
     if protocolname in SUPPORTED_PROTOCOLS:
-        module = "martas.lib.{}protocol".format(protocolname.lower())
-        cls = "{}Protocol".format(protocolname)
         pname =  "{}{}".format(protocolname, amount)
+        prot[pname] = load_protocol(protocolname, debug=confdict.get('debug') == 'True')
         if confdict.get('debug') == 'True':
-            log.msg("DEBUG -> Importing: {} from {}".format(cls, module))
-        prot[pname] = getattr(importlib.import_module(module), cls)
-        if confdict.get('debug') == 'True':
-            print("... importing done")
             print("Initializing the protocol ...")
         protocol = prot.get(pname)(mqttclient, sensordict, confdict)
         log.msg("... protocol successfully initialized")
@@ -320,6 +386,7 @@ def passive_thread(confdict,sensordict, mqttclient, establishedconnections):
     log.msg("  -> Connecting to port {} ...".format(port))
     if confdict.get('debug') == 'True':
         log.msg("DEBUG -> perameters - protocol {}, port {}, baudrate {}".format(pname, port, int(sensordict.get('baudrate'))))
+    from twisted.internet.serialport import SerialPort
     serialPort = SerialPort(protocol, port, reactor, baudrate=int(sensordict.get('baudrate')))
 
     passiveconnection = {sensorid: protocolname}
@@ -341,14 +408,9 @@ def auto_thread(confdict,sensordict, mqttclient, establishedconnections):
     amount = protlst.count(protocolname) + 1 # Load existing connections (new amount is len(exist)+1)
     #amount = 1                           # Load existing connections (new amount is len(exist)+1)
     if protocolname in SUPPORTED_PROTOCOLS:
-        module = "martas.lib.{}protocol".format(protocolname.lower())
-        cls = "{}Protocol".format(protocolname)
         pname =  "{}{}".format(protocolname, amount)
+        prot[pname] = load_protocol(protocolname, debug=confdict.get('debug') == 'True')
         if confdict.get('debug') == 'True':
-            log.msg("DEBUG -> Importing: {} from {}".format(cls, module))
-        prot[pname] = getattr(importlib.import_module(module), cls)
-        if confdict.get('debug') == 'True':
-            print("... importing done")
             print("Initializing the protocol ...")
         protocol = prot.get(pname)(mqttclient, sensordict, confdict)
         log.msg("... protocol successfully initialized")
@@ -411,7 +473,7 @@ def main(argv):
     ##  ----------------------------
     usagestring = 'acquisition.py -m <martas>'
     try:
-        opts, args = getopt.getopt(argv,"hm:TD",["martas=","test=","debug=",])
+        opts, args = getopt.getopt(argv,"hm:TD",["martas=","test=","debug=","profile-startup"])
     except getopt.GetoptError:
         print('Check your options:')
         print(usagestring)
@@ -426,6 +488,7 @@ def main(argv):
             print('Options:')
             print('-h                             help')
             print('-m                             path to martas configuration')
+            print('--profile-startup              report import times and startup milestones')
             print('------------------------------------------------------')
             print('Examples:')
             print('1. Basic (using defauilt martas.cfg')
@@ -439,11 +502,14 @@ def main(argv):
             test = True
         elif opt in ("-D", "--debug"):
             debug = True
+        elif opt == "--profile-startup":
+            pass # evaluated when importing - see profiler
 
     ##  Load defaults dict
     ##  ----------------------------
     conf = mm.get_conf(martasfile)
     conf["station"] = conf.get("station").lower()
+    profiler.mark("configuration loaded")
     if conf.get('debug') in ["True","TRUE","true"]:
         debug = True
 
@@ -462,6 +528,15 @@ def main(argv):
     if debug:
         print ("Configuration:", conf)
 
+    ##  Buffer file handling (flush interval, byte budget, fsync policy)
+    ##  ----------------------------
+    get_pool().configure(conf)
+
+    ##  Periodic requests of active sensors (worker threads, status reports)
+    ##  ----------------------------
+    get_scheduler().configure(conf)
+    get_scheduler().report = log.msg
+
     cred = conf.get('mqttcred',"")
     credpath = conf.get('credentialpath', None)
     broker = conf.get('broker',"")
@@ -469,6 +544,8 @@ def main(argv):
     mqttdelay = int(conf.get('mqttdelay',60))
     mqttcert = conf.get('mqttcert',"")
     mqttpsk = conf.get('mqttpsk',"")
+    if mqttpsk or cred:
+        from magpy.opt import cred as mpcred
     if mqttpsk:
         pskidentity = mpcred.lc(mqttpsk, 'user', path=credpath)
         pskpwd = mpcred.lc(mqttpsk, 'passwd', path=credpath)
@@ -484,6 +561,10 @@ def main(argv):
 
     if debug:
         print ("Sensor data:", sensorlist)
+    # only protocols named in sensors.cfg are imported (on demand)
+    protocols = resolve_protocols(sensorlist)
+    if debug:
+        print ("Protocols used:", protocols)
 
     ## Check for credentials
     ## ----------------------------
@@ -568,9 +649,13 @@ def main(argv):
     try:
         client.connect(broker, mqttport, mqttdelay)
         client.loop_start()
+        profiler.mark("mqtt connected")
     except:
         log.msg("Critical error - no network connection available during startup or mosquitto server not running - check whether data is recorded")
 
+    if profiler.enabled:
+        profile_first_publish(client)
+
     establishedconnections = {}
     ## Connect to serial port (sensor dependency) -> returns publish
     # Start subprocesses for each publishing protocol
@@ -636,6 +721,12 @@ def main(argv):
 
         sensorid = sensor.get('sensorid')
 
+    profiler.mark("sensors initialized")
+    # Start periodic requests of all active clients
+    if get_scheduler().jobs:
+        log.msg("acquisition: Starting scheduler for {} active sensor(s)".format(len(get_scheduler().jobs)))
+        get_scheduler().start()
+
     # Start all passive clients
     if passive_count > 0:
         log.msg("acquisition: Starting reactor for passive sensors. Sending data now ...")
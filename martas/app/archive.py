@@ -15,10 +15,14 @@ from magpy.opt import cred as mpcred
 # Relative import of core methods as long as martas is not configured as package
 from martas.core.methods import martaslog as ml
 from martas.core import methods as mm
+from martas.core.workerpool import run_jobs, read_slot
 from martas.version import __version__
 
 
 import getopt
+import time
+import pickle
+import tempfile
 from datetime import datetime, timezone
 import pwd
 import socket
@@ -59,6 +63,17 @@ sensordict      :    Sensor1:depth,format,writeDB,writeArchive,applyFlags,cleanr
 # Sensors present in path to be skipped (Begging of Sensorname is enough
 blacklist       :    BLV,QUAKES,Sensor2,Sensor3,
 
+# Maximal amount of simultaneous database reads if several workers are used (option -w)
+maxreads        :    2
+
+# Amount of data rows read from the database at once - days are read in chunks whose
+# time span is adapted to the sampling rate (0: read complete days). PYSTR/PYASCII with
+# writemodes overwrite/append are appended chunk by chunk. All other formats and writemodes
+# collect the chunks of a day in a temporary file in spoolpath (default: system temp directory)
+# and write the day at once (requires memory for one day of data).
+chunksize       :    500000
+spoolpath       :    /srv/archive/tmp
+
 
 
 DESCRIPTION:
@@ -83,6 +98,9 @@ APPLICATION:
     # Manual for specific sensors and time range
     python3 archive.py -c /config.cfg -b 2020-11-22 -s Sensor1,Sensor2 -d 30
 
+    # Archive DataIDs in four worker processes, each with its own database connection
+    python3 archive.py -c config.cfg -w 4
+
 """
 
 
@@ -193,6 +211,331 @@ def validtimerange(timetuple, mintime, maxtime, debug=False):
         print ("  Found invalid time range")
     return False
 
+# archive formats whose writers append to an existing file without reading it
+APPENDFORMATS = ['PYSTR', 'PYASCII']
+
+
+def get_chunkrows(chunksize):
+    """
+    DESCRIPTION
+        amount of data rows read from the database at once (None: complete days)
+    """
+    try:
+        chunkrows = int(chunksize) if chunksize not in [None, ''] else 500000
+    except (TypeError, ValueError):
+        chunkrows = 500000
+    return chunkrows if chunkrows > 0 else None
+
+
+def is_appendable(writemode='overwrite', archiveformat='PYSTR'):
+    """
+    DESCRIPTION
+        True if chunks can be appended to the archive file of the day one by one. Only
+        formats which really append (PYSTR, PYASCII - PYCDF reads and rewrites the whole file
+        for every append) with the writemodes overwrite and append (replace merges existing
+        files, which would duplicate the following chunks). Other combinations use a DaySpool.
+    """
+    return writemode in ['overwrite', 'append'] and str(archiveformat).upper() in APPENDFORMATS
+
+
+def join_chunks(streams):
+    """
+    DESCRIPTION
+        combine consecutive chunks of a day into a single DataStream - columns missing in
+        some chunks are filled with NaN (numerical keys) or empty strings
+    """
+    streams = [stream for stream in streams if stream.length()[0] > 0]
+    if not streams:
+        return DataStream()
+    header = dict(streams[0].header)
+    for stream in streams[1:]:
+        for key in stream.header:
+            header.setdefault(key, stream.header[key])
+    array = [np.asarray([]) for key in KEYLIST]
+    for idx, key in enumerate(KEYLIST):
+        if not any(len(stream.ndarray[idx]) > 0 for stream in streams):
+            continue
+        cols = []
+        for stream in streams:
+            col = stream.ndarray[idx]
+            if not len(col) > 0:
+                n = stream.length()[0]
+                col = np.full(n, np.nan) if key in NUMKEYLIST else np.full(n, '', dtype=object)
+            cols.append(np.asarray(col, dtype=object))
+        array[idx] = np.concatenate(cols)
+    return DataStream(header=header, ndarray=np.asarray(array, dtype=object))
+
+
+class DaySpool(object):
+    """
+    DESCRIPTION
+        collects the chunks of a day in a temporary file for archive formats and writemodes
+        which cannot be appended chunk by chunk (see is_appendable). Only one chunk is held in
+        memory while reading the database, the day is loaded once for writing the archive file.
+    APPLICATION
+        spool = DaySpool(spoolpath)
+        spool.add(stream)
+        stream = spool.finish()
+    """
+
+    def __init__(self, spoolpath=None):
+        if spoolpath and not os.path.isdir(spoolpath):
+            os.makedirs(spoolpath)
+        self.file = tempfile.TemporaryFile(prefix='archive_', suffix='.spool', dir=spoolpath or None)
+        self.chunks = 0
+        self.rows = 0
+
+    def add(self, stream):
+        pickle.dump((stream.header, stream.ndarray), self.file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.chunks += 1
+        self.rows += stream.length()[0]
+
+    def finish(self):
+        """
+        DESCRIPTION
+            returns all spooled chunks as one DataStream and removes the temporary file
+        """
+        self.file.seek(0)
+        streams = []
+        for i in range(self.chunks):
+            header, ndarray = pickle.load(self.file)
+            streams.append(DataStream(header=header, ndarray=ndarray))
+        self.close()
+        return join_chunks(streams)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_chunks(db, data, starttime, endtime, chunkrows=500000, period=None, debug=False):
+    """
+    DESCRIPTION
+        generator of time slices of a data table between starttime and endtime. The length of
+        the slices is adapted to the sampling period of the data so that each read contains
+        about chunkrows rows, independent of the sampling rate. Slices are half-open
+        (slicestart <= time < sliceend, DataBank.read includes both ends) so that no row is read
+        twice - only the last slice includes endtime. Without chunkrows the complete time range is
+        read at once.
+    RETURNS
+        tuples (slicestart, sliceend, DataStream)
+    """
+    starttime = magpymeth.testtime(starttime)
+    endtime = magpymeth.testtime(endtime)
+    if not chunkrows:
+        with read_slot():
+            stream = db.read(data,starttime=starttime,endtime=endtime)
+        yield starttime, endtime, stream
+        return
+    # one hour for the first slice if the sampling period is not yet known
+    span = timedelta(seconds=chunkrows*period) if period else timedelta(hours=1)
+    current = starttime
+    while current < endtime:
+        sliceend = min(current + max(span, timedelta(minutes=1)), endtime)
+        if debug:
+            print ("  Reading data from DB between {} and {} ...".format(current, sliceend))
+        with read_slot():
+            if sliceend < endtime:
+                stream = db.read(data,starttime=current,sql='time < "{}"'.format(sliceend))
+            else:
+                stream = db.read(data,starttime=current,endtime=sliceend)
+        if stream.length()[0] > 1:
+            sr = stream.samplingrate()
+            if sr and not isnan(sr) and sr > 0:
+                span = timedelta(seconds=chunkrows*sr)
+        yield current, sliceend, stream
+        current = sliceend
+
+
+class ArchiveReport(object):
+    """
+    DESCRIPTION
+        progress and throughput of archiving a DataID
+    """
+
+    def __init__(self, dataid):
+        self.dataid = dataid
+        self.rows = 0
+        self.chunks = 0
+        self.begin = time.time()
+
+    def add(self, rows):
+        self.rows += rows
+        self.chunks += 1
+
+    def seconds(self):
+        return time.time() - self.begin
+
+    def rate(self):
+        seconds = self.seconds()
+        return self.rows/seconds if seconds > 0 else 0.
+
+    def progress(self, until):
+        return "{}: archived until {} - {} rows in {} chunks ({:.0f} rows/s)".format(self.dataid, until, self.rows, self.chunks, self.rate())
+
+    def summary(self):
+        return "{}: {} rows in {} chunks within {:.1f} sec ({:.0f} rows/s)".format(self.dataid, self.rows, self.chunks, self.seconds(), self.rate())
+
+
+def archive_dataid(db, job):
+    """
+    DESCRIPTION
+        archive the data of a single DataID and clean the database table - called for every
+        DataID by main (possibly in a worker process, see option -w)
+    PARAMETER
+        job : tuple (DataID, time range dictionary of the DataID, configuration, settings)
+    RETURNS
+        status messages (dict)
+    """
+    data, times, config, settings = job
+    obsdepth = settings.get('obsdepth', 0)
+    startdate = settings.get('startdate', '')
+    hostname = settings.get('hostname', socket.gethostname().upper())
+    debug = settings.get('debug', False)
+    subdirectory = config.get('subdirectory',None)
+    statusmsg = {}
+    if not times:
+        times = {}
+    sr = 1
+    datainfoid = ''
+    print (" ---------------------------- ")
+    print (" Checking data set {}".format(data))
+    name = "{}-archiving-{}".format(hostname,data.replace("_","-"))
+    msg = "checking"
+    if debug:
+        print ("  Times: {}".format(times))
+    # TODO create a warning if mintime is much younger as it should be after cleaning
+
+    if not db: # check whether db is still connected
+        print ("    Lost DB - reconnecting ...")
+        db = mm.connect_db(config.get('dbcredentials'), exitonfailure=False, report=False)
+
+    para = [config.get('defaultdepth'), config.get('archiveformat'),config.get('writearchive'),config.get('applyflags'), config.get('cleandb'),config.get('cleanratio')]
+    # Get default parameter from config
+    depth,fo,wa,af,cdb,ratio = get_parameter(para)
+    writemode = config.get('writemode','replace')
+
+    # Modify parameters if DataID specifications are give
+    for sensd in config.get('sensordict',{}):
+        if data.find(sensd) >= 0:
+            print ("  Found data specific parameters for sensorgroup {}:".format(sensd)) 
+            para = config.get('sensordict').get(sensd)
+            depth,fo,wa,af,cdb,ratio = get_parameter(para)
+            print ("   -> {}".format(para))
+
+    # Manual specifications
+    if obsdepth:
+        print ("  Overriding configuration file data with manual specifications - new depth = {}".format(obsdepth)) 
+        depth = obsdepth
+
+    # Create datelist (needs to be sorted)
+    dateslist = create_datelist(startdate=startdate, depth=depth, debug=debug)
+
+    # check time range
+    try:
+        # This method might fail if datainfodict does not contain dates - in this case just proceed with normal analysis
+        gettrstate = validtimerange(dateslist, times.get('mintime'), times.get('maxtime'))
+    except:
+        print ("   -> Could not extract time ranges from datainfo dictionary")
+        gettrstate = True
+
+    if not gettrstate:
+        print ("  Apparently no data is existing for the seleceted days - skipping")
+        return statusmsg
+
+    # run the following in a daily manner? to save memory... check
+    chunkrows = get_chunkrows(config.get('chunksize'))
+    appendable = is_appendable(writemode, fo)
+    if chunkrows and not appendable:
+        print ("  Format {} with writemode {} cannot be appended chunk by chunk - spooling the chunks of each day to {}".format(fo, writemode, config.get('spoolpath') or tempfile.gettempdir()))
+    report = ArchiveReport(data)
+    for tup in dateslist:
+        if debug:
+            print ("  Running for range", tup)
+        first = True
+        spool = DaySpool(config.get('spoolpath')) if chunkrows and not appendable and not debug and wa else None
+        for chunkstart, chunkend, stream in read_chunks(db, data, tup[0], tup[1], chunkrows=chunkrows, debug=debug):
+            report.add(stream.length()[0])
+            # Data found
+            if not stream.length()[0] > 0:
+                continue
+            dataidnum = stream.header.get('DataID')
+            if not max(stream.ndarray[0]).replace(tzinfo=None) < datetime.now(timezone.utc).replace(tzinfo=None):
+                print ("  Found in-appropriate date in stream - maxdate = {} - cutting off".format(max(stream.ndarray[0])))
+                stream = stream.trim(endtime=datetime.now(timezone.utc).replace(tzinfo=None))
+            if first:
+                print ("  Archiving {} data from {} to {}".format(data,tup[0],tup[1]))
+                sr = stream.samplingrate()
+                print ("   with sampling period {} sec".format(sr))
+                if isnan(sr):
+                    print ("Please take care - could not extract sampling rate - will assume 60 seconds")
+                    sr = 60
+
+            path = config.get('archivepath')
+            archivepath = None
+
+            if path:
+                #construct archive path
+                try:
+                    sensorid = stream.header['SensorID']
+                    stationid = stream.header['StationID']
+                    datainfoid = stream.header['DataID']
+                    archivepath = os.path.join(path,stationid,sensorid,stream.header['DataID'])
+                except:
+                    print ("  Obviously a problem with insufficient header information")
+                    print ("  - check StationID, SensorID and DataID in DB")
+                    archivepath = None
+
+            if af and sr > 0.9:
+                if first:
+                    print ("You selected to apply flags and save them along with the cdf archive.")
+                flaglist = db.flags_from_db(sensorid=stream.header['SensorID'],starttime=chunkstart,endtime=chunkend)
+                if len(flaglist) > 0:
+                    print ("  Found {} flags in database for the selected time range - adding them to the archive file".format(len(flaglist)))
+                    stream = flaglist.apply_flags(stream, mode='insert')
+
+            # the first chunk of a day is written with the selected writemode, all further chunks are appended
+            mode = writemode if first else 'append'
+            if not debug and wa and archivepath:
+                if first:
+                    print ("Writing data to:", archivepath)
+                if spool:
+                    spool.add(stream)
+                else:
+                    stream.write(archivepath,filenamebegins=datainfoid+'_',format_type=fo,mode=mode,subdirectory=subdirectory)
+            else:
+                print ("   Debug: skip writing")
+                print ("    -> without debug {} inputs would be written to {} (mode {})".format(stream.length()[0],archivepath,mode))
+            first = False
+            print ("   {}".format(report.progress(chunkend)))
+            del stream
+        if spool:
+            if spool.chunks and archivepath:
+                print ("   Writing {} spooled rows of {} chunks (mode {})".format(spool.rows, spool.chunks, writemode))
+                stream = spool.finish()
+                stream.write(archivepath,filenamebegins=datainfoid+'_',format_type=fo,mode=writemode,subdirectory=subdirectory)
+                del stream
+            spool.close()
+        if first:
+            print ("No data between {} and {}".format(tup[0],tup[1]))
+        else:
+            print ("... success")
+        msg = "successfully finished"
+    print ("  {}".format(report.summary()))
+
+    if not debug and cdb and not datainfoid == '':
+        print ("Now deleting old entries in database older than {} days".format(sr*ratio))
+        # TODO get coverage before
+        db.delete(datainfoid,samplingrateratio=ratio)
+        # TODO get coverage after
+    else:
+        print ("   Debug: skip deleting DB")
+        print ("    -> without debug all entries older than {} days would be deleted".format(sr*ratio))
+
+    statusmsg[name] = msg
+    return statusmsg
+
+
 def main(argv):
     version = __version__
     conf = ''
@@ -203,9 +546,10 @@ def main(argv):
     statusmsg = {}
     proxies = {}
     hostname = socket.gethostname().upper()
+    workers = 1
     debug=False
     try:
-        opts, args = getopt.getopt(argv,"hc:b:d:s:gi:a:D",["config=","begin=","depth=","sensors=","debug=",])
+        opts, args = getopt.getopt(argv,"hc:b:d:s:w:gi:a:D",["config=","begin=","depth=","sensors=","workers=","debug=",])
     except getopt.GetoptError:
         print ('archive.py -c <config> -b <begin> -d <depth> -s <sensors>')
         sys.exit(2)
@@ -237,6 +581,7 @@ def main(argv):
             print ('-d            : depth')
             print ('-b            : begin: end = begin - depth(days)')
             print ('-s            : list sensor to deal with')
+            print ('-w            : (int) amount of worker processes archiving DataIDs in parallel, default 1')
             print ('-------------------------------------')
             print ('Example:')
             print ('every day cron job: python archive.py -c cobsdb -p /srv/archive')
@@ -257,6 +602,11 @@ def main(argv):
                 sys.exit()
         elif opt in ("-s", "--sensors"):
             obssenslist = arg.split(",")
+        elif opt in ("-w", "--workers"):
+            try:
+                workers = max(1, int(arg))
+            except ValueError:
+                print ("amount of workers needs to be an integer - using 1")
         elif opt == "-v":
             print ("archive.py version: {}".format(version))
         elif opt in ("-D", "--debug"):
@@ -283,7 +633,10 @@ def main(argv):
     logpath = config.get('logpath')
     receiver = config.get('notification')
     receiverconf = config.get('notificationconf')
-    subdirectory = config.get('subdirectory',None)
+    try:
+        maxreads = int(config.get('maxreads',2))
+    except (TypeError, ValueError):
+        maxreads = 2
 
     db = mm.connect_db(config.get('dbcredentials'))
 
@@ -291,126 +644,16 @@ def main(argv):
 
     datainfoiddict = get_data_dictionary(db,sql,debug=False)
 
+    settings = {'obsdepth': obsdepth, 'startdate': startdate, 'hostname': hostname, 'debug': debug}
+    jobs = []
     for data in datainfoiddict:
-        sr = 1
-        datainfoid = ''
-        print (" ---------------------------- ")
-        print (" Checking data set {}".format(data))
-        name = "{}-archiving-{}".format(hostname,data.replace("_","-"))
-        msg = "checking"
-        if debug:
-            print ("  Times: {}".format(datainfoiddict.get(data)))
-        # TODO create a warning if mintime is much younger as it should be after cleaning
-
         if obssenslist and not data in obssenslist:
-            print ("  Not in observers specified dataid list - this DataID will be skipped")
-            continue
-
-        if not db: # check whether db is still connected
-            print ("    Lost DB - reconnecting ...")
-            db = mm.connect_db(config.get('dbcredentials'), exitonfailure=False, report=False)
-
-        para = [config.get('defaultdepth'), config.get('archiveformat'),config.get('writearchive'),config.get('applyflags'), config.get('cleandb'),config.get('cleanratio')]
-        # Get default parameter from config
-        depth,fo,wa,af,cdb,ratio = get_parameter(para)
-        writemode = config.get('writemode','replace')
-
-        # Modify parameters if DataID specifications are give
-        for sensd in config.get('sensordict',{}):
-            if data.find(sensd) >= 0:
-                print ("  Found data specific parameters for sensorgroup {}:".format(sensd)) 
-                para = config.get('sensordict').get(sensd)
-                depth,fo,wa,af,cdb,ratio = get_parameter(para)
-                print ("   -> {}".format(para))
-
-        # Manual specifications
-        if obsdepth:
-            print ("  Overriding configuration file data with manual specifications - new depth = {}".format(obsdepth)) 
-            depth = obsdepth
-
-        # Create datelist (needs to be sorted)
-        dateslist = create_datelist(startdate=startdate, depth=depth, debug=debug)
-
-        # check time range
-        try:
-            # This method might fail if datainfodict does not contain dates - in this case just proceed with normal analysis
-            gettrstate = validtimerange(dateslist, datainfoiddict.get(data).get('mintime'), datainfoiddict.get(data).get('maxtime'))
-        except:
-            print ("   -> Could not extract time ranges from datainfo dictionary")
-            gettrstate = True
-
-        if not gettrstate:
-            print ("  Apparently no data is existing for the seleceted days - skipping")
+            print ("  {} not in observers specified dataid list - this DataID will be skipped".format(data))
             continue
+        jobs.append((data, datainfoiddict.get(data), config, settings))
 
-        # run the following in a daily manner? to save memory... check
-        for tup in dateslist:
-            if debug:
-                print ("  Running for range", tup)
-            stream = DataStream()
-            #tup = (day,nextday)
-            if debug:
-                print ("  Reading data from DB ...")
-            stream = db.read(data,starttime=tup[0],endtime=tup[1])
-            if debug:
-                print ("    -> Done ({} data points)".format(stream.length()[0]))
-
-            # Data found
-            if stream.length()[0] > 0:
-                dataidnum = stream.header.get('DataID')
-                if not max(stream.ndarray[0]).replace(tzinfo=None) < datetime.now(timezone.utc).replace(tzinfo=None):
-                    print ("  Found in-appropriate date in stream - maxdate = {} - cutting off".format(max(stream.ndarray[0])))
-                    stream = stream.trim(endtime=datetime.now(timezone.utc).replace(tzinfo=None))
-                print ("  Archiving {} data from {} to {}".format(data,tup[0],tup[1]))
-                sr = stream.samplingrate()
-                print ("   with sampling period {} sec".format(sr))
-                if isnan(sr):
-                    print ("Please take care - could not extract sampling rate - will assume 60 seconds")
-                    sr = 60
-
-                path = config.get('archivepath')
-                archivepath = None
-
-                if path:
-                    #construct archive path
-                    try:
-                        sensorid = stream.header['SensorID']
-                        stationid = stream.header['StationID']
-                        datainfoid = stream.header['DataID']
-                        archivepath = os.path.join(path,stationid,sensorid,stream.header['DataID'])
-                    except:
-                        print ("  Obviously a problem with insufficient header information")
-                        print ("  - check StationID, SensorID and DataID in DB")
-                        archivepath = None
-
-                if af and sr > 0.9:
-                    print ("You selected to apply flags and save them along with the cdf archive.")
-                    flaglist = db.flags_from_db(sensorid=stream.header['SensorID'],starttime=tup[0],endtime=tup[1])
-                    if len(flaglist) > 0:
-                        print ("  Found {} flags in database for the selected time range - adding them to the archive file".format(len(flaglist)))
-                        stream = flaglist.apply_flags(stream, mode='insert')
-
-                if not debug and wa and archivepath:
-                    print ("Writing data to:", archivepath)
-                    stream.write(archivepath,filenamebegins=datainfoid+'_',format_type=fo,mode=writemode,subdirectory=subdirectory)
-                    print ("... success")
-                else:
-                    print ("   Debug: skip writing")
-                    print ("    -> without debug a file with {} inputs would be written to {}".format(stream.length()[0],archivepath))
-            else:
-                print ("No data between {} and {}".format(tup[0],tup[1]))
-            msg = "successfully finished"
-
-        if not debug and cdb and not datainfoid == '':
-                    print ("Now deleting old entries in database older than {} days".format(sr*ratio))
-                    # TODO get coverage before
-                    db.delete(datainfoid,samplingrateratio=ratio)
-                    # TODO get coverage after
-        else:
-                    print ("   Debug: skip deleting DB")
-                    print ("    -> without debug all entries older than {} days would be deleted".format(sr*ratio))
-
-        statusmsg[name] = msg
+    for msg in run_jobs(archive_dataid, jobs, workers=workers, db=db, dbcredentials=config.get('dbcredentials'), maxreads=maxreads, debug=debug):
+        statusmsg.update(msg)
 
     if debug or obssenslist:   #No update of statusmessages if only a selected sensor list is analyzed
         print (statusmsg)
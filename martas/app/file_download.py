@@ -13,7 +13,6 @@ from magpy.opt import cred as mpcred
 import getopt
 import fnmatch
 import pexpect
-import ftplib
 import pwd
 import zipfile
 import tempfile
@@ -21,11 +20,12 @@ from dateutil import parser
 from datetime import datetime, timezone
 from shutil import copyfile
 import filecmp
-import subprocess
 import socket
 
 from martas.core.methods import martaslog as ml
 from martas.core import methods as mm
+from martas.core import freshness as fr
+from martas.core import transfer as tr
 
 """
 DESCRIPTION
@@ -156,9 +156,14 @@ zipdata            :      False
 
 
 # delete from remote source after successful transfer
-# (doesnt work with scp)
+# (doesnt work with scp without paramiko)
 deleteremote       :      False
 
+# Parallel transfers (ftp, scp) - each with a persistent session to the remote host
+# Complete files are skipped and partial downloads (*.part) are resumed. rsync transfers
+# are combined to one rsync call per destination directory.
+#transferworkers    :      4
+
 # Force data to the given revision number
 #forcerevision      :      0001
 
@@ -669,6 +674,32 @@ def create_transfer_list(config=None,datelist=None,debug=False):
     return filelist
 
 
+def zip_raw_file(destname, zipping=False, debug=False):
+    """
+    DESCRIPTION
+        zip a downloaded raw file if zipping is selected
+    RETURNS
+        path of the (zipped) file
+    """
+    if not zipping:
+        return destname
+    if debug:
+        print (" raw data wil be zipped")
+    dirname = os.path.dirname(destname)
+    oldname = os.path.basename(destname)
+    pname = os.path.splitext(oldname)
+    if not pname[1] in [".zip",".gz",".ZIP",".GZ"]:
+        zipname = pname[0]+'.zip'
+        with zipfile.ZipFile(os.path.join(dirname,zipname), 'w') as myzip:
+            myzip.write(destname,oldname, zipfile.ZIP_DEFLATED)
+        os.remove(destname)
+        destname = os.path.join(dirname,zipname)
+    else:
+        if debug:
+            print (" data is zipped already")
+    return destname
+
+
 def obtain_data_files(config=None,filelist=None,debug=False):
     """
     DESCRIPTION
@@ -706,9 +737,11 @@ def obtain_data_files(config=None,filelist=None,debug=False):
     port = config.get('rmport',21)
     zipping = mm.get_bool(config.get('zipdata'))
     forcelocal = mm.get_bool(config.get('forcedirectory',False))
-    deleteopt = " "
+    try:
+        workers = int(config.get('transferworkers',4))
+    except (TypeError, ValueError):
+        workers = 4
     sensid = ""
-    ftp = None
 
     #filename = config.get('filenamestructure')
     #dateformat = config.get('dateformat')
@@ -740,16 +773,8 @@ def obtain_data_files(config=None,filelist=None,debug=False):
 
     if not protocol == '' or (protocol == '' and not destination == tempfile.gettempdir()):
         ### Create a directory by getting sensorid names (from source directory)
-        # Open the specific channel
-        if protocol in ['ftp','FTP']:
-            if not port == 21:
-                ftp = ftplib.FTP()
-                ftp.connect(address,port)
-            else:
-                ftp = ftplib.FTP(address)
-            ftp.login(user,password)
-            ftp.cwd(source)
-
+        # Remote files are collected and transferred together (see martas.core.transfer)
+        transferjobs = []
         for f in filelist:
             datedir = ''
             if debug:
@@ -793,23 +818,10 @@ def obtain_data_files(config=None,filelist=None,debug=False):
             if debug:
                 print ("   -> write destination (for raw files): {} , {}".format(destpath, li[-1]))
 
-            if protocol in ['ftp','FTP']:
-                fhandle = open(destname, 'wb')
-                ftp.retrbinary('RETR ' + f, fhandle.write)
-                fhandle.close()
-                if deleteremote in [True,'True']:
-                    ftp.delete(f)
-            elif protocol in ['scp','SCP']:
-                mm.scptransfer(user+'@'+address+':'+f,destpath,password,timeout=600)
-            elif protocol in ['rsync']:
-                # create a command line string with rsync ### please note,,, rsync requires password less comminuctaion
-                if deleteremote in [True,'True']:
-                    deleteopt = " --remove-source-files "
-                else:
-                    deleteopt = " "
-                rsyncstring = "rsync -avz -e ssh{}{} {}".format(deleteopt, user+'@'+address+':'+f,destpath)
-                print ("Executing:", rsyncstring)
-                subprocess.call(rsyncstring.split())
+            if protocol in ['ftp','FTP','scp','SCP','rsync']:
+                # ### please note,,, rsync requires password less comminuctaion
+                transferjobs.append((f, destname))
+                continue
             elif protocol in ['html','HTML']:
                 pass
             elif protocol in ['']:
@@ -819,25 +831,14 @@ def obtain_data_files(config=None,filelist=None,debug=False):
                         os.remove(f)
                 else:
                     print ("   -> raw file already existing - skipping write")
-            if zipping:
-                if debug:
-                    print (" raw data wil be zipped")
-                dirname = os.path.dirname(destname)
-                oldname = os.path.basename(destname)
-                pname = os.path.splitext(oldname)
-                if not pname[1] in [".zip",".gz",".ZIP",".GZ"]:
-                    zipname = pname[0]+'.zip'
-                    with zipfile.ZipFile(os.path.join(dirname,zipname), 'w') as myzip:
-                        myzip.write(destname,oldname, zipfile.ZIP_DEFLATED)
-                    os.remove(destname)
-                    destname = os.path.join(dirname,zipname)
-                else:
-                    if debug:
-                        print (" data is zipped already")
-            localpathlist.append(destname)
-
-        if protocol in ['ftp','FTP']:
-            ftp.close()
+            localpathlist.append(zip_raw_file(destname, zipping=zipping, debug=debug))
+
+        if transferjobs:
+            print ("  Transferring {} files using {} with {} parallel sessions".format(len(transferjobs), protocol, workers))
+            done, counts = tr.download_files(transferjobs, protocol, address, port=port, user=user, password=password, source=source, workers=workers, deleteremote=deleteremote in [True,'True'], debug=debug)
+            print ("   -> {} new, {} resumed, {} skipped (complete), {} failed".format(counts.get('new'), counts.get('resume'), counts.get('skip'), counts.get('failed')))
+            for destname in done:
+                localpathlist.append(zip_raw_file(destname, zipping=zipping, debug=debug))
     else:
         localpathlist = [elem for elem in filelist]
 
@@ -1008,8 +1009,10 @@ def write_data(config=None,localpathlist=None,debug=False):
                             print (" - Force option chosen: forcing data to table {}".format(tabname))
                             print ("   IMPORTANT: general database meta information will not be updated")
                             db.write(data, tablename=tabname)
+                            fr.update_freshness_from_stream(db, data, tablename=tabname)
                         else:
                             db.write(data)
+                            fr.update_freshness_from_stream(db, data)
                     except:
                         print (" !! Error when writing ", f)
                         success = False
@@ -70,6 +70,26 @@ filter.py -c singlefilter.cfg -j archive,second -d 2 -e 2021-02-26
 |        |               |            |               |             |         |           |
 |        |  read_conf    |      2.0.0 |  yes          |             |         |           |
 |        |  get_sensors  |      2.0.0 |  yes          |             |         |           |
+|        |  filter_parameters |  2.0.2 |  yes       |             |         |           |
+|        |  read_filter_state |  2.0.2 |  yes       | incremental realtime filtering |  |   |
+|        |  write_filter_state | 2.0.2 |  yes       | incremental realtime filtering |  |   |
+|        |  incremental_start | 2.0.2 |  yes       | incremental realtime filtering |  |   |
+|        |  incremental_filter | 2.0.2 |  yes       | incremental realtime filtering |  |   |
+|        |  filter_instrument | 2.0.2 |  -         | one instrument, option -w |  |           |
+
+Incremental realtime filtering:
+    If "filterstate" is defined in basics (e.g. "filterstate":"/srv/archive/filterstate.json"), realtime
+    jobs store the time of the last filtered output of each instrument. The next run only reads raw
+    data since this time minus an overlap (two filter widths plus two resample periods), and only
+    writes new filtered samples whose filter window is completely covered by raw data. Thus the written
+    values are identical to the inner part of the full (batch) filter run. Add "incremental":"False"
+    to the parameters of an instrument to use the full window.
+
+Parallel filtering:
+    Option -w (--workers) N filters the instruments in N worker processes. Each worker opens
+    its own database connection. The amount of simultaneous database reads of all workers is
+    limited by "maxreads" in basics (default 2) to avoid overloading the database. Status
+    messages and incremental states of all instruments are collected by the main process.
 
 
 """
@@ -86,6 +106,8 @@ import json
 from martas.version import __version__
 from martas.core.methods import martaslog as ml
 from martas.core import methods as mm
+from martas.core import freshness as fr
+from martas.core.workerpool import run_jobs, read_slot
 
 
 def read_conf(path):
@@ -235,7 +257,276 @@ def get_sensors(db=None,groupdict=None,samprate=None,recent=False,recentthreshol
     return returndict
 
 
-def apply_filter(db, statusmsg=None, groupdict=None, permanent=None, blacklist=None, jobtype='realtime', endtime=datetime.now(timezone.utc).replace(tzinfo=None), dayrange=2, basepath='', dbinputsensors=None, destination='db', outputformat='PYCDF', recentthreshold=7200, debug=False):
+def filter_parameters(options):
+    """
+    DESCRIPTION
+        extract filter type, filter width, resample period and noresample from instrument options
+    """
+    noresample = None
+    resample_period = None
+    if options.get('filtertype') == 'default':
+        filtertype = 'gaussian'
+        filterwidth = None # use default of 3.3333333 seconds
+    else:
+        filtertype = options.get('filtertype','gaussian')
+        fwin = options.get('filterwidth',None)
+        filterwidth = timedelta(seconds=fwin)
+        resamp = options.get('resample_period',None)
+        if resamp == 'noresample':
+            noresample = True
+        else:
+            try:
+                resample_period=int(resamp)
+            except:
+                resample_period=1.0
+                pass
+    return filtertype, filterwidth, resample_period, noresample
+
+
+def filter_window(filterwidth, resample_period):
+    """
+    DESCRIPTION
+        filter width and resample period in seconds (defaults of DataStream.filter if None)
+    """
+    fw = filterwidth.total_seconds() if filterwidth else 3.33333333
+    rp = float(resample_period) if resample_period else 1.0
+    return fw, rp
+
+
+def incremental_start(lastoutput, filterwidth=None, resample_period=None):
+    """
+    DESCRIPTION
+        begin of the raw data required to continue filtering after lastoutput
+        (overlap of two filter widths plus two resample periods)
+    """
+    fw, rp = filter_window(filterwidth, resample_period)
+    return lastoutput - timedelta(seconds=2*fw + 2*rp)
+
+
+def incremental_filter(stream, lastoutput, filtertype='gaussian', filterwidth=None, resample_period=None, noresample=None, missingdata='conservative'):
+    """
+    DESCRIPTION
+        filter raw data read since incremental_start and return only the new filtered samples
+        after lastoutput whose filter window is completely covered by raw data
+    """
+    fw, rp = filter_window(filterwidth, resample_period)
+    filtstream = stream.filter(filter_type=filtertype, filter_width=filterwidth, missingdata=missingdata, resample_period=resample_period, noresample=noresample)
+    validend = stream.end() - timedelta(seconds=fw/2. + rp)
+    return filtstream.trim(starttime=lastoutput+timedelta(microseconds=1), endtime=validend)
+
+
+def read_filter_state(path):
+    """
+    DESCRIPTION
+        read the incremental filter state {instrument: {'lastoutput': isotime}}
+    """
+    state = {}
+    if path and os.path.isfile(path):
+        try:
+            with open(path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            print ("filter: could not read filter state {} - using full windows".format(path))
+    return state
+
+
+def write_filter_state(path, state):
+    if not path:
+        return
+    tmppath = path + '.tmp'
+    with open(tmppath, "w") as f:
+        json.dump(state, f)
+    os.replace(tmppath, path)
+
+
+def filter_instrument(db, job):
+    """
+    DESCRIPTION
+        filter the data of a single instrument - called for every high resolution
+        instrument by apply_filter (possibly in a worker process, see option --workers)
+    PARAMETER
+        job : tuple (instrument, options, incremental state of the instrument or None, settings of apply_filter)
+    RETURNS
+        instrument, status messages (dict), new incremental state of the instrument or None
+    """
+    inst, options, laststate, settings = job
+    permanent = settings.get('permanent', [])
+    jobtype = settings.get('jobtype', 'realtime')
+    endtime = settings.get('endtime')
+    dayrangedefault = settings.get('dayrange', 2)
+    basepath = settings.get('basepath', '')
+    dbinputsensors = settings.get('dbinputsensors', [])
+    destination = settings.get('destination', 'db')
+    outputformat = settings.get('outputformat', 'PYCDF')
+    recentthreshold = settings.get('recentthreshold', 7200)
+    debug = settings.get('debug', False)
+    sn = socket.gethostname()
+    stationid = ''
+    sensor = ''
+    statusmsg = {}
+    newstate = None
+    if not db:
+        statusmsg['{}-filter-{}-{}'.format(sn,jobtype,inst.replace('_',''))] = 'database connection failed'
+        return inst, statusmsg, newstate
+
+    if debug:
+        print ("  ----------------------------")
+        print ("  Dealing with instrument {}".format(inst))
+    name = '{}-filter-{}-{}'.format(sn,jobtype,inst.replace('_',''))
+    last = DataStream()
+    dataexpected = True
+    lastoutput = None
+    try:
+        filtertype, filterwidth, resample_period, noresample = filter_parameters(options)
+        if debug:
+            print ("     -> Selected options:", options)
+            print ("  Obtaining projected data amount")
+        if laststate is not None and inst in permanent and not options.get('incremental', True) in [False, 'False', 'false'] and laststate.get('lastoutput'):
+            lastoutput = methods.testtime(laststate.get('lastoutput'))
+            if lastoutput < datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=recentthreshold):
+                # outdated state (e.g. after a longer outage): use the full window
+                lastoutput = None
+        if lastoutput:
+            # incremental realtime job: new raw data plus an overlap covering the filter window
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            begin = incremental_start(lastoutput, filterwidth, resample_period)
+            if debug:
+                print ("     Incremental realtime job -> getting data since {} from database".format(begin))
+            with read_slot():
+                last = db.read(inst, starttime=begin, endtime=now)
+        elif jobtype == 'realtime' and inst in permanent:
+            if debug:
+                print ("     Realtime job selected -> getting data from database")
+            amount = options.get('window',40000)
+            rt = options.get('realtime',True)
+            # amount * sampling rate defines coverage in seconds -> 10Hz (0.1 sec * 40000 -> 4000 sec or 0.5 sec * 10000 -> 5000 sec)
+            if not mm.get_bool(rt):
+                amount = amount*3                # triple the amount of expected data if only hourly uploads are existing
+            with read_slot():
+                last = db.get_lines(inst,amount)
+            try:
+                test = len(last)
+            except:
+                statusmsg[name] = 'db access - data not existing'
+            if debug:
+                print ("     -> Extracting {} data points".format(amount))
+            if len(last) > 0:
+                sr = last.samplingrate()
+                expectedcoverage_in_sec = amount*sr
+                now = datetime.now(timezone.utc).replace(tzinfo=None)
+                last = last.trim(starttime=now-timedelta(seconds=expectedcoverage_in_sec),endtime=now) # remove all timesteps exceeding current time (typical IWT error)
+                if debug:
+                    print ("     -> Extracted {} data points in reality after slicing".format(len(last)))
+                    print ("     -> Done")
+        elif jobtype == 'realtime' and not inst in permanent:
+            dataexpected = False
+        elif not jobtype == 'realtime':
+            dayrange = options.get('dayrange',dayrangedefault)
+            if debug:
+                print ("     Archive job selected -> getting data from archive")
+            stationid = db.select('StationID', 'DATAINFO', 'DataID LIKE "{}"'.format(inst))[0]
+            sensor = "_".join(inst.split('_')[:-1])
+            datapath = os.path.join(basepath,stationid,sensor,inst,'*')
+            if debug:
+                print ("Datapath", datapath)
+            begin = endtime-timedelta(days=dayrange)
+            if debug:
+                print ("    Reading data between {} and {}".format(begin, endtime))
+            last = read(datapath,starttime=begin,endtime=endtime)
+            if debug:
+                print ("     -> found data between {}".format(last.timerange()))
+                print ("         corresponding to {} datapoints".format(len(last)))
+                print ("     -> Done")
+
+        if debug:
+            print ("    Got {} datapoints".format(last.length()[0]))
+
+        if last.length()[0] > 0:
+            missingdata = options.get('missingdata', 'conservative')
+            destrevision = options.get('revision', '0002')
+            if debug:
+                print ("    Default analysis parameter (may be re-specified for individual sensors): {}, filter type: {}, filter width: {}, resample period: {}, {}".format(inst, filtertype, filterwidth, resample_period, noresample))
+            if lastoutput:
+                # only new samples with a filter window completely covered by raw data
+                filtstream = incremental_filter(last, lastoutput, filtertype=filtertype, filterwidth=filterwidth, resample_period=resample_period, noresample=noresample, missingdata=missingdata)
+                if debug:
+                    print ("     Incremental: {} new filtered samples".format(len(filtstream)))
+            else:
+                filtstream = last.filter(filter_type=filtertype, filter_width=filterwidth, missingdata=missingdata,resample_period=resample_period,noresample=noresample)
+                # cut out the last 90% to reduce boundary filter effects # after 0.4.6
+                try:
+                    if debug:
+                        print ("    Cutting out two lines (seconds) from start and two from beginning ..")
+                    am = len(filtstream)
+                    print (len(filtstream))
+                    filtstream = filtstream.cut(am-2, 1, 0)
+                    filtstream = filtstream.cut(am-4, 1, 1)
+                    print ("Should be length -4", len(filtstream))
+                    if debug:
+                        print ("     Filtstream coverage: length={}, {}".format(len(filtstream), filtstream.timerange()) )
+                        print ("     -> Done")
+                except:
+                    pass
+
+            #### ALWAYS write to 0002 table
+            newtab = "{}_{}".format(inst[:-5],destrevision)
+
+            if lastoutput and not len(filtstream) > 0:
+                if debug:
+                    print ("    No new filtered samples")
+            elif not destination == 'disk':
+                # Write to database
+                try:
+                    if not debug:
+                        if newtab in dbinputsensors:
+                            # if the sensor is already contained in DATAINFO then solely write data contents
+                            db.write(filtstream,tablename=newtab)
+                        else:
+                            #print ("   Sensor contained in DBlist - adding Metainformation to DATAINFO")
+                            db.write(filtstream)
+                        # keep the freshness index of the monitor up to date
+                        fr.update_freshness_from_stream(db, filtstream, tablename=newtab)
+                        if laststate is not None and inst in permanent and len(filtstream) > 0:
+                            # incremental realtime filtering continues after this sample
+                            newstate = {'lastoutput': filtstream.end().isoformat()}
+                        #print ("    Writing to DB successful")
+                    else:
+                        print ("    !! Debug selected - skipping writing to DB")
+                except:
+                    """db.write errors currently not captured - 
+                       only general DB connection failures.
+                       it happens once in a while that DB connection
+                       is lost before writing (on sol at 3:00 and 4:00 UTC)
+                       eventually connected to other DB access e.g.di analyses
+                    """
+                    pass
+            else:
+                if debug:
+                    print ("   Writing data directly to disk...")
+                archivepath = os.path.join(basepath,stationid,sensor,newtab)
+                if debug:
+                    print ("   Destinationpath: {}".format(archivepath))
+                if not debug and outputformat and archivepath:
+                    #print ("     valid write conditions")
+                    filtstream.write(archivepath,filenamebegins=newtab+'_',format_type=outputformat)
+                    #print ("    -> Done")
+                else:
+                    print ("   Debug: skip writing")
+                    print ("    -> without debug a file with {} inputs would be written to {}".format(filtstream.length()[0],archivepath))
+
+            statusmsg[name] = 'fine'
+        else:
+            # send no data monitor
+            if dataexpected:
+                statusmsg[name] = 'no data found'
+    except:
+        # send failed message to monitor
+        statusmsg[name] = 'one second filter: general failure'
+
+    return inst, statusmsg, newstate
+
+
+def apply_filter(db, statusmsg=None, groupdict=None, permanent=None, blacklist=None, jobtype='realtime', endtime=datetime.now(timezone.utc).replace(tzinfo=None), dayrange=2, basepath='', dbinputsensors=None, destination='db', outputformat='PYCDF', recentthreshold=7200, filterstate=None, workers=1, dbcredentials=None, maxreads=2, debug=False):
     """
     DESCRIPTION
         Create one-second records by filtering data sets
@@ -243,6 +534,10 @@ def apply_filter(db, statusmsg=None, groupdict=None, permanent=None, blacklist=N
     PARAMETER
         jobtype  : 'realtime' or 'archive'
         destination : 'db' or 'disk' -> if db (for realtime), disk archiving is done by archive; disk should only be used to convert old files 
+        filterstate : path of the incremental filter state (realtime jobs only, None: full window)
+        workers  : amount of worker processes filtering instruments in parallel (1: sequential using db)
+        dbcredentials : credentials used by each worker to open its own database connection
+        maxreads : maximal amount of simultaneous database reads of all workers
     """
     # Allow to define groups in highreslist (e.g. LEMI036*)
     # Then firstly extract all instruments which fit to the appropriate group
@@ -260,13 +555,10 @@ def apply_filter(db, statusmsg=None, groupdict=None, permanent=None, blacklist=N
         blacklist = []
     if not dbinputsensors:
         dbinputsensors = []
-    stationid = ''
-    sensor = ''
 
     if debug:
         print ("Selected options are: Destination = {}; outputformat = {}; path = {}".format(destination, outputformat, basepath))
 
-    dayrangedefault = dayrange
     sn = socket.gethostname()
     recent = True
     if jobtype == 'archive':
@@ -277,149 +569,26 @@ def apply_filter(db, statusmsg=None, groupdict=None, permanent=None, blacklist=N
         print ("  Obtained HF list (sampling rate higher then 1 Hz):", highreslst)
         print ("  Starting one second data filtering:  (Filtering high resolution data sets)")
     p1start = datetime.now()
+    state = None
+    if jobtype == 'realtime' and filterstate:
+        state = read_filter_state(filterstate)
+    settings = {'permanent': permanent, 'jobtype': jobtype, 'endtime': endtime, 'dayrange': dayrange,
+                'basepath': basepath, 'dbinputsensors': dbinputsensors, 'destination': destination,
+                'outputformat': outputformat, 'recentthreshold': recentthreshold, 'debug': debug}
+    jobs = []
     for inst in highreslst:
-        if debug:
-            print ("  ----------------------------")
-            print ("  Dealing with instrument {}".format(inst))
-        name = '{}-filter-{}-{}'.format(sn,jobtype,inst.replace('_',''))
-        last = DataStream()
-        dataexpected = True
+        laststate = state.get(inst, {}) if state is not None else None
+        jobs.append((inst, highreslst[inst], laststate, settings))
+    for inst, instmsg, newstate in run_jobs(filter_instrument, jobs, workers=workers, db=db, dbcredentials=dbcredentials, maxreads=maxreads, debug=debug):
+        statusmsg.update(instmsg)
+        if state is not None and newstate:
+            state[inst] = newstate
+
+    if state is not None and not debug:
         try:
-            noresample = None
-            resample_period = None
-            options = highreslst[inst]
-            if debug:
-                print ("     -> Selected options:", options)
-                print ("  Obtaining projected data amount")
-            if jobtype == 'realtime' and inst in permanent:
-                if debug:
-                    print ("     Realtime job selected -> getting data from database")
-                amount = options.get('window',40000)
-                rt = options.get('realtime',True)
-                # amount * sampling rate defines coverage in seconds -> 10Hz (0.1 sec * 40000 -> 4000 sec or 0.5 sec * 10000 -> 5000 sec)
-                if not mm.get_bool(rt):
-                    amount = amount*3                # triple the amount of expected data if only hourly uploads are existing
-                last = db.get_lines(inst,amount)
-                try:
-                    test = len(last)
-                except:
-                    statusmsg[name] = 'db access - data not existing'
-                if debug:
-                    print ("     -> Extracting {} data points".format(amount))
-                if len(last) > 0:
-                    sr = last.samplingrate()
-                    expectedcoverage_in_sec = amount*sr
-                    now = datetime.now(timezone.utc).replace(tzinfo=None)
-                    last = last.trim(starttime=now-timedelta(seconds=expectedcoverage_in_sec),endtime=now) # remove all timesteps exceeding current time (typical IWT error)
-                    if debug:
-                        print ("     -> Extracted {} data points in reality after slicing".format(len(last)))
-                        print ("     -> Done")
-            elif jobtype == 'realtime' and not inst in permanent:
-                dataexpected = False
-            elif not jobtype == 'realtime':
-                dayrange = options.get('dayrange',dayrangedefault)
-                if debug:
-                    print ("     Archive job selected -> getting data from archive")
-                stationid = db.select('StationID', 'DATAINFO', 'DataID LIKE "{}"'.format(inst))[0]
-                sensor = "_".join(inst.split('_')[:-1])
-                datapath = os.path.join(basepath,stationid,sensor,inst,'*')
-                if debug:
-                    print ("Datapath", datapath)
-                begin = endtime-timedelta(days=dayrange)
-                if debug:
-                    print ("    Reading data between {} and {}".format(begin, endtime))
-                last = read(datapath,starttime=begin,endtime=endtime)
-                if debug:
-                    print ("     -> found data between {}".format(last.timerange()))
-                    print ("         corresponding to {} datapoints".format(len(last)))
-                    print ("     -> Done")
-
-            if debug:
-                print ("    Got {} datapoints".format(last.length()[0]))
-
-            if last.length()[0] > 0:
-                if options.get('filtertype') == 'default':
-                    filtertype = 'gaussian'
-                    filterwidth = None # use default of 3.3333333 seconds
-                else:
-                    filtertype = options.get('filtertype','gaussian')
-                    fwin = options.get('filterwidth',None)
-                    filterwidth = timedelta(seconds=fwin)
-                    resamp = options.get('resample_period',None)
-                    if resamp == 'noresample':
-                        noresample = True
-                    else:
-                        try:
-                            resample_period=int(resamp)
-                        except:
-                            resample_period=1.0
-                            pass
-                missingdata = options.get('missingdata', 'conservative')
-                destrevision = options.get('revision', '0002')
-                if debug:
-                    print ("    Default analysis parameter (may be re-specified for individual sensors): {}, filter type: {}, filter width: {}, resample period: {}, {}".format(inst, filtertype, filterwidth, resample_period, noresample))
-                filtstream = last.filter(filter_type=filtertype, filter_width=filterwidth, missingdata=missingdata,resample_period=resample_period,noresample=noresample)
-                # cut out the last 90% to reduce boundary filter effects # after 0.4.6
-                try:
-                    if debug:
-                        print ("    Cutting out two lines (seconds) from start and two from beginning ..")
-                    am = len(filtstream)
-                    print (len(filtstream))
-                    filtstream = filtstream.cut(am-2, 1, 0)
-                    filtstream = filtstream.cut(am-4, 1, 1)
-                    print ("Should be length -4", len(filtstream))
-                    if debug:
-                        print ("     Filtstream coverage: length={}, {}".format(len(filtstream), filtstream.timerange()) )
-                        print ("     -> Done")
-                except:
-                    pass
-
-                #### ALWAYS write to 0002 table
-                newtab = "{}_{}".format(inst[:-5],destrevision)
-
-                if not destination == 'disk':
-                    # Write to database
-                    try:
-                        if not debug:
-                            if newtab in dbinputsensors:
-                                # if the sensor is already contained in DATAINFO then solely write data contents
-                                db.write(filtstream,tablename=newtab)
-                            else:
-                                #print ("   Sensor contained in DBlist - adding Metainformation to DATAINFO")
-                                db.write(filtstream)
-                            #print ("    Writing to DB successful")
-                        else:
-                            print ("    !! Debug selected - skipping writing to DB")
-                    except:
-                        """db.write errors currently not captured - 
-                           only general DB connection failures.
-                           it happens once in a while that DB connection
-                           is lost before writing (on sol at 3:00 and 4:00 UTC)
-                           eventually connected to other DB access e.g.di analyses
-                        """
-                        pass
-                else:
-                    if debug:
-                        print ("   Writing data directly to disk...")
-                    archivepath = os.path.join(basepath,stationid,sensor,newtab)
-                    if debug:
-                        print ("   Destinationpath: {}".format(archivepath))
-                    if not debug and outputformat and archivepath:
-                        #print ("     valid write conditions")
-                        filtstream.write(archivepath,filenamebegins=newtab+'_',format_type=outputformat)
-                        #print ("    -> Done")
-                    else:
-                        print ("   Debug: skip writing")
-                        print ("    -> without debug a file with {} inputs would be written to {}".format(filtstream.length()[0],archivepath))
-
-                statusmsg[name] = 'fine'
-            else:
-                # send no data monitor
-                if dataexpected:
-                    statusmsg[name] = 'no data found'
-        except:
-            # send failed message to monitor
-            statusmsg[name] = 'one second filter: general failure'
+            write_filter_state(filterstate, state)
+        except OSError:
+            statusmsg['{}-filter-state'.format(sn)] = 'could not write filter state {}'.format(filterstate)
 
     if debug:
         p1end = datetime.now()
@@ -446,9 +615,10 @@ def main(argv):
     db = None
     telegramconfig = '/etc/martas/telegram.cfg'
     endtime = datetime.now(timezone.utc).replace(tzinfo=None)
+    workers = 1
 
     try:
-        opts, args = getopt.getopt(argv,"hc:j:e:d:p:l:xD",["config=","joblist=","endtime=","dayrange=","path=","loggername","sendlog","debug=",])
+        opts, args = getopt.getopt(argv,"hc:j:e:d:p:l:w:xD",["config=","joblist=","endtime=","dayrange=","path=","loggername","workers=","sendlog","debug=",])
     except getopt.GetoptError:
         print ('filter.py -c <config>')
         sys.exit(2)
@@ -472,6 +642,7 @@ def main(argv):
             print ('-d            : (int) dayrange, amount of days to analyze before endtime')
             print ('-p            : basepath - default is in config file')
             print ('-l            : loggername')
+            print ('-w            : (int) amount of worker processes, default 1')
             print ('-------------------------------------')
             print ('Application:')
             print ('python3 filter.py -c ../conf/filter.cfg -j archive,second -d 3 -s LEMI025_28_0002_0001')
@@ -497,6 +668,11 @@ def main(argv):
             basepath = os.path.abspath(arg)
         elif opt in ("-l", "--loggername"):
             newloggername = arg
+        elif opt in ("-w", "--workers"):
+            try:
+                workers = max(1, int(arg))
+            except ValueError:
+                print (" Amount of workers could not be interpreted - using 1")
         elif opt in ("-x", "--sendlog"):
             sendlog = True
         elif opt in ("-D", "--debug"):
@@ -547,6 +723,11 @@ def main(argv):
         logpath = os.path.join(os.path.dirname(logpath),newloggername)
     outputformat = basics.get('outputformat')
     credentials = basics.get('dbcredentials',"cobsdb")
+    filterstate = basics.get('filterstate',None)
+    try:
+        maxreads = int(basics.get('maxreads',2))
+    except (TypeError, ValueError):
+        maxreads = 2
 
     print ("2. Activate logging scheme as selected in config")
     #sn = 'ALDEBARAN' # servername  get name from machine ...
@@ -565,7 +746,7 @@ def main(argv):
         print ("... failed")
         statusmsg[name] = '{}: DB connection failed'.format(sn)
 
-    statusmsg = apply_filter(db, statusmsg=statusmsg, groupdict=groupparameter, permanent=permanent, blacklist=blacklist, jobtype=jobtype, endtime=endtime, dayrange=dayrange, dbinputsensors=sensorlist, basepath=basepath, destination=destination, outputformat=outputformat, recentthreshold=recentthreshold, debug=debug)
+    statusmsg = apply_filter(db, statusmsg=statusmsg, groupdict=groupparameter, permanent=permanent, blacklist=blacklist, jobtype=jobtype, endtime=endtime, dayrange=dayrange, dbinputsensors=sensorlist, basepath=basepath, destination=destination, outputformat=outputformat, recentthreshold=recentthreshold, filterstate=filterstate, workers=workers, dbcredentials=credentials, maxreads=maxreads, debug=debug)
 
     if basics.get('https'):
         proxies['https'] = basics.get('https')
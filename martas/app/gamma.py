@@ -23,7 +23,8 @@ NAME="/srv/mqtt/DIGIBASE_16272059_0001/raw/DIGIBASE_"$SN"_0001.Chn"
 
 0  *  *  *  *  root  bash /home/pi/Software/gammascript.sh > /var/log/magpy/gamma.log
 
-4) use gamma.py to extract spectral data and store it in daily json structures
+4) use gamma.py to extract spectral data and store it in a spectral store (<SensorID>.spec, see
+   martas/core/spectralstore.py) or in daily json structures (config "storeformat : json")
 
 58 5   *  *  *  root  $PYTHON /home/pi/SCRIPTS/gamma.py -p /srv/mqtt/DIGIBASE_16272059_0001/raw/DIGIBASE_16272059_0001.Chn  -c /home/pi/SCRIPTS/gamma.cfg -j extract,cleanup -o /srv/mqtt/DIGIBASE_16272059_0001/raw/ > /var/log/magpy/digiextract.log  2>&1
 
@@ -31,6 +32,10 @@ NAME="/srv/mqtt/DIGIBASE_16272059_0001/raw/DIGIBASE_"$SN"_0001.Chn"
 
 30 6   *  *  *  root  $PYTHON /home/pi/SCRIPTS/gamma.py -p /srv/mqtt/DIGIBASE_16272059_0001/raw/ -j load,analyze -c /home/pi/SCRIPTS/gamma.cfg  > /var/log/magpy/digianalyse.log 2>&1
 
+5) existing daily json files can be converted into the spectral store
+
+$PYTHON gamma.py -p /srv/mqtt/DIGIBASE_16272059_0001/raw/ -j convert -o /srv/mqtt/DIGIBASE_16272059_0001/raw/ -s 2021-01-01
+
 """
 
 from __future__ import print_function
@@ -52,6 +57,7 @@ import numpy as np
 import filecmp, shutil
 import copy
 import glob
+from martas.core import spectralstore as ss
 
 from scipy.interpolate import interp1d
 from scipy import interpolate
@@ -413,6 +419,84 @@ def read_data_dict(path,format='JSON'):
         return {}
 
 
+def datadict_to_records(datadictionary):
+    """
+    DESCRIPTION
+        converts a data dictionary (read_linux_gamma, json files) into spectral store records
+    RETURNS
+        header dictionary, records
+    """
+    header = {k: v for k, v in datadictionary.items() if not k == 'DataContent'}
+    cont = datadictionary.get('DataContent', {})
+    times = cont.get('time', [])
+    specdata = cont.get('spectraldata', [])
+    channels = max([len(el.get('data', [])) for el in specdata] + [ss.DEFAULT_CHANNELS])
+    header['channels'] = channels
+    records = ss.make_records(times, [el.get('data', []) for el in specdata],
+                              starttimes=[el.get('starttime') for el in specdata],
+                              endtimes=[el.get('endtime') for el in specdata],
+                              samplingrates=[el.get('samplingrate') for el in specdata], channels=channels)
+    return header, records
+
+
+def write_spectral_store(datadictionary, path, debug=False):
+    """
+    DESCRIPTION
+        appends the spectra of a data dictionary to the spectral store <SensorID>.spec in path
+    RETURNS
+        date of the last spectrum (like write_data_dict) or False
+    """
+    try:
+        if os.path.isfile(path):
+            path = os.path.dirname(path)
+        header, records = datadict_to_records(datadictionary)
+        if not len(records):
+            return False
+        store = ss.SpectralStore(path, header.get('SensorID'), header=header, channels=header.get('channels'))
+        added = store.append(records)
+        if debug:
+            print (" Added {} of {} spectra to {}".format(added, len(records), store.datapath))
+        return records['time'][-1].astype(datetime).date()
+    except Exception as e:
+        print (" Writing spectral store failed: {}".format(e))
+        return False
+
+
+def find_spectral_store(path, sensorid=None):
+    """
+    DESCRIPTION
+        returns the spectral store of a directory or a .spec file - None if not existing
+    """
+    if os.path.isfile(path) and path.endswith('.spec'):
+        return ss.SpectralStore(os.path.dirname(path), os.path.basename(path)[:-5])
+    if os.path.isdir(path):
+        if sensorid and os.path.isfile(os.path.join(path, "{}.spec".format(sensorid))):
+            return ss.SpectralStore(path, sensorid)
+        if len(glob.glob(os.path.join(path, '*.spec'))) == 1:
+            return ss.SpectralStore(path)
+    return None
+
+
+def convert_json_files(loadlist, path, debug=False):
+    """
+    DESCRIPTION
+        converts daily json files into the spectral store in path
+    RETURNS
+        amount of added spectra
+    """
+    added = 0
+    for jsonpath in sorted(loadlist):
+        print ("Converting: ", jsonpath)
+        header, records = datadict_to_records(read_data_dict(jsonpath))
+        if not len(records):
+            continue
+        store = ss.SpectralStore(path, header.get('SensorID'), header=header, channels=header.get('channels'))
+        added += store.append(records)
+    if debug:
+        print (" -> added {} spectra".format(added))
+    return added
+
+
 def cleanup(path, deldate, backup=True, debug=False):
 
     fi = open(path, 'rt')
@@ -443,17 +527,16 @@ def cleanup(path, deldate, backup=True, debug=False):
                 fi.write(line)
     return True
 
-def create_datastream(datadictionary, resultlist, config={}):
+def create_datastream(header, timestamps, resultlist, config={}):
 
     datastream = DataStream()
-    datastream.header['SensorName'] = datadictionary.get('SensorName')
-    datastream.header['SensorID']  = datadictionary.get('SensorID')
+    datastream.header['SensorName'] = header.get('SensorName')
+    datastream.header['SensorID']  = header.get('SensorID')
     array = [[] for el in KEYLIST]
     roi = config.get('roi',[])
     energylist = config.get('energylist',[])
-    timestamps = times(datadictionary)
 
-    array[0] = [mdates.date2num(dparser.parse(el,fuzzy=True)) for el in timestamps]
+    array[0] = [mdates.date2num(el) for el in np.asarray(timestamps, dtype='datetime64[us]').astype(datetime)]
 
     for i,el in enumerate(roi):
         ar = []
@@ -478,16 +561,27 @@ def create_datastream(datadictionary, resultlist, config={}):
 def analyze_gamma_data(datadictionary, config={}, debug=False):
     """
     DESCRIPTION
-        main function for analyzing data. is calling singlespecanalysis for all timesteps
+        main function for analyzing data dictionaries (see analyze_spectra)
+    """
+    header, records = datadict_to_records(datadictionary)
+    return analyze_spectra(header, records, config=config, debug=debug)
+
+
+def analyze_spectra(header, records, config={}, debug=False):
+    """
+    DESCRIPTION
+        main function for analyzing spectral store records. is calling singlespecanalysis for all timesteps
     """
     resultlist=[]
-    timestamps = times(datadictionary)
-    for time in timestamps:
-        name, data = get_spectraldata(time,datadictionary)
+    timestamps = records['time']
+    counts = records['counts']
+    for idx, time in enumerate(timestamps):
+        name = "{}-{}".format(header.get('SensorName'), np.datetime_as_string(time, unit='s'))
+        data = counts[idx].astype(np.int64)
         if debug:
             print (" Obtained: ", name, data)
             print (" ---------------------------")
-        if time == timestamps[-1]:
+        if idx == len(timestamps)-1:
             sresult = singlespecanalysis(data,config=config,plot=True,name=name,debug=debug)
         else:
             sresult = singlespecanalysis(data,config=config,plot=False,name=name,debug=debug)
@@ -499,7 +593,7 @@ def analyze_gamma_data(datadictionary, config={}, debug=False):
         print (" ---------------------------")
         print (" All time steps finished")
         print (" ---------------------------")
-    datastream = create_datastream(datadictionary, resultlist,config=config)
+    datastream = create_datastream(header, timestamps, resultlist,config=config)
     return datastream
 
 def hl_envelopes_idx(s, dmin=1, dmax=1, split=False):
@@ -1282,8 +1376,8 @@ def main(argv):
             print ('-------------------------------------')
             print ('Options:')
             print ('-c (required) : path to a configuration file')
-            print ('-p            : path to a data file')
-            print ('-o            : path to export json in case of extract from raw')
+            print ('-p            : path to a data file, json file, spectral store or directory')
+            print ('-o            : export directory in case of extract from raw or convert')
             print ('-j            : override the joblist in conf')
             print ('-s            : startdate (load)')
             print ('-e            : enddate (load)')
@@ -1294,6 +1388,8 @@ def main(argv):
             print ('python3 gamma.py -p /home/leon/Cloud/Software/MagPyAnalysis/RadonGammaSpekLinux/data/DIGIBASE_16272059_0001.Chn -j extract,cleanup -o /home/leon/Cloud/Software/MagPyAnalysis/RadonGammaSpekLinux/ -D')
             print ('2) loading and analyzing data')
             print ('python3 gamma.py -p /home/leon/Cloud/Software/MagPyAnalysis/RadonGammaSpekLinux/DIGIBASE_16272059_0001_2021-05-15.json -j load,analyze -D')
+            print ('3) converting daily json files into a spectral store')
+            print ('python3 gamma.py -p /home/leon/Cloud/Software/MagPyAnalysis/RadonGammaSpekLinux/ -j convert -o /home/leon/Cloud/Software/MagPyAnalysis/RadonGammaSpekLinux/ -s 2021-01-01')
             sys.exit()
         elif opt in ("-c", "--config"):
             configpath = arg
@@ -1332,6 +1428,7 @@ def main(argv):
         print ("Configuration looks like:")
         print (conf)
 
+    header, records = {}, []
     # test inputpath
     # if json then eventually skip extract and use load
     if 'load' in joblist and 'extract' in joblist:
@@ -1343,14 +1440,18 @@ def main(argv):
             print ("Extract job:")
             print ("-----------------")
         datadictionary = read_linux_gamma(path,debug=debug)
+        if 'analyze' in joblist:
+            header, records = datadict_to_records(datadictionary)
         if conf:
             #datadictionary, jobs, export = interpreteConf(datadictionary, conf, jobs, export)
             pass
         if addaux: # defined in config
             # get auxiliary data paths from config file
             pass 
-        if export:
+        if export and conf.get('storeformat','spectral') == 'json':
             writesuccess = write_data_dict(datadictionary,export,debug=debug)
+        elif export:
+            writesuccess = write_spectral_store(datadictionary,export,debug=debug)
         if 'cleanup' in joblist and export and writesuccess:
             print (" data extracted and exported to json file - cleaning up old file")
             deldate = datetime(writesuccess.year, writesuccess.month, writesuccess.day)
@@ -1361,17 +1462,32 @@ def main(argv):
         if debug:
             print ("Loading data:")
             print ("-----------------")
+        store = find_spectral_store(path, sensorid=conf.get('sensorid'))
+        if store:
+            # slice the time range from the memory-mapped store
+            header = store.header
+            records = store.read(datetime(startdate.year, startdate.month, startdate.day),
+                                 datetime(enddate.year, enddate.month, enddate.day)+timedelta(days=1))
+        else:
+            if os.path.isdir(path):
+                loadlist = extract_paths(path,startdate,enddate,debug=debug)
+                datadictionary = read_data_dict_from_list(loadlist)
+            else:
+                datadictionary = read_data_dict(path)
+            header, records = datadict_to_records(datadictionary)
+        if debug:
+            print (" -> got {} spectral records".format(len(records)))
+
+    if 'convert' in joblist:
         if os.path.isdir(path):
             loadlist = extract_paths(path,startdate,enddate,debug=debug)
-            datadictionary = read_data_dict_from_list(loadlist)
         else:
-            datadictionary = read_data_dict(path)
-        if debug:
-            print (" -> got {} spectral records".format(length(datadictionary)))
-            print (datadictionary)
+            loadlist = [path]
+        storepath = export if export else path if os.path.isdir(path) else os.path.dirname(path)
+        convert_json_files(loadlist, storepath, debug=debug)
 
-    if 'analyze' in joblist and len(datadictionary) > 0:
-        datastream = analyze_gamma_data(datadictionary, config=conf, debug=debug)
+    if 'analyze' in joblist and len(records) > 0:
+        datastream = analyze_spectra(header, records, config=conf, debug=debug)
         sensid = datastream.header.get('SensorID')
         op = os.path.join(conf.get('streampath','/tmp'),sensid)
         fb = "{}_".format(sensid)
@@ -1498,6 +1614,8 @@ extractpath     :   /var/log/magpy/mm-monitor.log
 streampath      :   /srv/mqtt
 graphdir        :   /tmp
 dataformat      :   PYSTR
+# format of extracted spectra: spectral (default, <SensorID>.spec) or json (daily files)
+storeformat     :   spectral
 
 # timeranges to extract (can be overruled by options)
 # ---------------------------------------------------
@@ -34,16 +34,18 @@ from datetime import datetime, timezone
 import paho.mqtt.client as mqtt
 import json
 import socket
-from magpy.stream import DataStream
 from magpy.core import database
 from magpy.core import methods as mpmeth
 import magpy.opt.cred as mpcred
 import numpy as np
-import filecmp, shutil
 import subprocess
+from collections import deque
 
 from martas.core.methods import martaslog as ml
 from martas.core import methods as mm
+from martas.core import freshness as fr
+from martas.core.dirscan import DirectoryScanner
+from martas.core.logwatch import LogWatcher
 from martas.version import __version__
 
 """
@@ -112,13 +114,15 @@ def _testJobs(joblist, allowedjobs):
     return joblist
 
 
-def check_martas(testpath='/srv', threshold=600, jobname='JOB', statusdict=None, ignorelist=None, thresholddict=None, debug=False):
+def check_martas(testpath='/srv', threshold=600, jobname='JOB', statusdict=None, ignorelist=None, thresholddict=None, statefile=None, debug=False):
     """
     DESCRIPTION:
         Walk through all subdirs of /srv and check for latest files in all subdirs
         add active or inactive to a log file
         if log file not exists: just add data
         if existis: check for changes and create message with all changes
+        Directories are scanned incrementally (core/dirscan.py): unchanged directories
+        (mtime stored in statefile) are not listed again.
     """
     if not statusdict:
         statusdict = {}
@@ -128,10 +132,17 @@ def check_martas(testpath='/srv', threshold=600, jobname='JOB', statusdict=None,
         thresholddict = {}
     defaultthreshold = threshold
     # neglect archive, products and projects directories of MARCOS
-    dirs=[x[0] for x in os.walk(testpath) if not x[0].find("archive")>-1 and not x[0].find("products")>-1 and not x[0].find("projects")>-1]
-    for d in dirs:
-        ld = _latestfile(os.path.join(d,'*'),date=True)
-        lf = _latestfile(os.path.join(d,'*'))
+    scanner = DirectoryScanner(statefile, exclude=["archive", "products", "projects"])
+    latest = scanner.scan(testpath)
+    try:
+        scanner.save()
+    except OSError as e:
+        print ("Could not save scan state to {}: {}".format(statefile, e))
+    if debug:
+        print ("Scanned {} directories, {} unchanged".format(scanner.listed, scanner.reused))
+    for d in sorted(latest):
+        lf, ctime = latest[d]
+        ld = datetime.fromtimestamp(ctime)
         if os.path.isfile(lf):
             if debug:
                 print ("Ckecking {} ...".format(lf))
@@ -205,10 +216,14 @@ def check_datafile(testpath='/srv/products/raw', threshold=600, jobname='JOB', s
     return statusdict
 
 
-def check_marcos(db,threshold=600, statusdict=None,jobname='JOB',excludelist=None,acceptedoffsets=None,debug=False):
+def check_marcos(db,threshold=600, statusdict=None,jobname='JOB',excludelist=None,acceptedoffsets=None,dbcred=None,workers=4,debug=False):
     """
     DESCRIPTION
-        add text
+        check the actuality of all data tables. Existing tables and their latest timestamps
+        are read from the freshness index (DATAFRESHNESS, see core/freshness.py) with a single query.
+        Tables missing in the index and tables whose indexed time exceeds their threshold (their
+        writer might not update the index) are scanned in parallel (one connection per worker if
+        dbcred is provided) before they are reported. Scanned times are added to the index.
     """
     if not statusdict:
         statusdict = {}
@@ -217,32 +232,41 @@ def check_marcos(db,threshold=600, statusdict=None,jobname='JOB',excludelist=Non
     if not acceptedoffsets:
         acceptedoffsets = {}
 
-    testst = DataStream()
+    def table_threshold(table):
+        usedthreshold = threshold
+        for elem in acceptedoffsets:
+            if table.find(elem) > -1:
+                usedthreshold = acceptedoffsets[elem]
+        return usedthreshold
+
     offset = {}
     testname = '{}-DBactuality'.format(jobname)
     tables = []
-    lasttime = None
-    cursor = db.db.cursor()
+    lasttimes = {}
     ok = True
 
     if debug:
-        print ("1. Get all tables")
+        print ("1. Get all tables and the freshness index")
         print ("-----------------------------------")
-    tablessql = 'SHOW TABLES'
-    message = db._executesql(cursor,tablessql)
-    if message:
-        ok = False
-        print (message)
-    if ok:
-        tables = cursor.fetchall()
-        tables = [el[0] for el in tables]
-        if not len(tables) > 0:
-            print ('check table: no tables found - stopping')
+    tables, index = fr.read_freshness(db, debug=debug)
+    if tables is None:
+        # information_schema not accessible
+        cursor = db.db.cursor()
+        message = db._executesql(cursor,'SHOW TABLES')
+        if message:
             ok = False
-    else:
-        print ('check table: aborting')
-        #cursor.close()
+            print (message)
+            print ('check table: aborting')
+        else:
+            tables = [el[0] for el in cursor.fetchall()]
+        cursor.close()
+    if ok and not len(tables) > 0:
+        print ('check table: no tables found - stopping')
         ok = False
+    if index is None:
+        index = {}
+        if debug:
+            print ("Freshness index not available - scanning all tables")
 
     if ok:
         if debug:
@@ -253,7 +277,7 @@ def check_marcos(db,threshold=600, statusdict=None,jobname='JOB',excludelist=Non
         newtables = []
         for el in tables:
             drop = False
-            for ex in excludelist:
+            for ex in excludelist + [fr.FRESHNESS_TABLE]:
                 if el.startswith(ex):
                     drop = True
             if not drop:
@@ -268,38 +292,40 @@ def check_marcos(db,threshold=600, statusdict=None,jobname='JOB',excludelist=Non
             # classic problem of IWT
             print ("-----------------------------------")
         delsql = "DELETE FROM IWT_TILT01_0001_0001 WHERE time > NOW()"
-        if ok:
+        if 'IWT_TILT01_0001_0001' in tables:
+            cursor = db.db.cursor()
             message = db._executesql(cursor, delsql)
             if message:
                 print(message)
+            cursor.close()
         # eventually an execute is necessary here
 
     if ok:
         if debug:
             print ("4. Getting last input in each table")
             print ("-----------------------------------")
+        lasttimes = {table: index.get(table) for table in tables if fr.valid_lasttime(index.get(table))}
+        # missing, invalid and outdated looking index values are checked in the tables
+        stale = fr.stale_tables(tables, index, maxage=table_threshold)
+        if stale:
+            if debug:
+                print (' -> scanning {} tables not contained in the freshness index or outdated'.format(len(stale)))
+            connect = None
+            if dbcred:
+                connect = lambda: mm.connect_db(dbcred, exitonfailure=False, report=False)
+            scanned = fr.scan_lasttimes(db, stale, connect=connect, workers=workers, debug=debug)
+            lasttimes.update(scanned)
+            fr.store_scanned(db, scanned, index, debug=debug)
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
         for table in tables:
+            if not table in lasttimes:
+                continue
+            lastt = mpmeth.testtime(lasttimes.get(table))
+            # Get difference to current time
+            tdiff = np.abs((now-lastt).total_seconds())
+            offset[table] = tdiff
             if debug:
-                print (' -> running for {}'.format(table))
-            lastsql = 'SELECT time FROM {} ORDER BY time DESC LIMIT 1'.format(table)
-            message = db._executesql(cursor, lastsql)
-            if message:
-                print(message)
-            value = cursor.fetchall()
-            try:
-                lasttime = value[0][0]
-                timetest = True
-            except:
-                timetest = False
-                pass
-            if timetest:
-                lastt = mpmeth.testtime(lasttime)
-                # Get difference to current time
-                now = datetime.now(timezone.utc).replace(tzinfo=None)
-                tdiff = np.abs((now-lastt).total_seconds())
-                offset[table] = tdiff
-                if debug:
-                    print ("Difference: {}".format(tdiff))
+                print ("{}: difference {}".format(table, tdiff))
 
     if ok:
         if debug:
@@ -308,11 +334,8 @@ def check_marcos(db,threshold=600, statusdict=None,jobname='JOB',excludelist=Non
         statusdict[testname] = 'possible'
         for el in offset:
             # determine threshold
-            usedthreshold = threshold
+            usedthreshold = table_threshold(el)
             name = "{}-{}".format(testname,el.replace('_',''))
-            for elem in acceptedoffsets:
-                if el.find(elem) > -1:
-                    usedthreshold = acceptedoffsets[elem]
             if offset[el] > usedthreshold:
                 if debug:
                     print ("{} : data too old by {} seconds".format(el,offset[el]))
@@ -321,7 +344,6 @@ def check_marcos(db,threshold=600, statusdict=None,jobname='JOB',excludelist=Non
                 statusdict[name] = 'actual'
     else:
         statusdict[testname] = 'failure'
-    cursor.close()
 
     return statusdict
 
@@ -337,75 +359,60 @@ def dbsize():
 def check_logfile(logfilepath, tmpdir='/tmp', statusdict=None, jobname='JOB', testtype='new', logsearchmessage='Error', tolerance=20, debug=False):
     """
     DESCRIPTION:
-        read a log file and compare it with a copy in tmp (created in the last call)
+        read the lines added to a log file since the last call. Inode, offset and an incomplete
+        last line are stored in tmpdir (see core/logwatch.py) - only new bytes are read.
     """
-    # 1 Read log file
-    # 2 Read copy in tmp
-    # 3 Compare both files
+    # 1 Read state of the last call (nothing to check in the first call)
+    # 2 Read new lines only (rotation and truncation restart at the beginning)
+    # 3 Evaluate new lines
     # or
-    # 4 check for specific messages and occurrences (if not present in last 4 lines -> ignore)
-    # 5 Save log to tmp
+    # 4 check for specific messages and occurrences (last two lines or whole file)
+    # 5 Save state to tmp
     if not statusdict:
         statusdict = {}
 
-    def compare(f1,f2):
-        diff = []
-        with open(f1,'r') as f:
-            d=f.readlines()
-        with open(f2,'r') as f:
-            e=f.readlines()
-        lengthdiff = len(d)-len(e)
-        if lengthdiff > 0:
-            # new log is larger than old log
-            # else do not return a difference (because of logrotate)
-            diff = d[-lengthdiff:]
-        return diff
-
-    def last(f1, lines=None):
-        with open(f1,'r') as f:
-            d=f.readlines()
-        if not lines:
-            return d
-        if lines and len(d) > lines:
-            return d[-lines:]
-        elif lines and len(d) < lines:
-            return d
-        else:
-            return d
-
     testname = "{}-checklog".format(jobname)
-    tmplogfilename = "monitor-{}.tmp".format(os.path.basename(logfilepath))
-    tmplogfile = os.path.join(tmpdir,tmplogfilename)
+    statefilename = "monitor-{}.state".format(os.path.basename(logfilepath))
+    statefile = os.path.join(tmpdir,statefilename)
 
     if not os.path.isfile(logfilepath):
         statusdict[testname] = "failed to find logfile"
         return statusdict
 
-    if os.path.isfile(tmplogfile):
-        # temporary file existing - running comparison
-        res = filecmp.cmp(logfilepath, tmplogfile)
+    watcher = LogWatcher(logfilepath, statefile)
+    known = watcher.load()
+    # only the last three new lines and the amount of matching lines are kept
+    newlines = deque(maxlen=3)
+    amount = 0
+    testamount = 0
+    for line in watcher.new_lines():
+        amount += 1
+        newlines.append(line)
+        if logsearchmessage and line.find(logsearchmessage) > -1:
+            testamount += 1
+    if testamount > 0:
+        # 'contain' remembers findings of earlier runs until the log is rotated
+        watcher.flags['contain'] = True
+
+    if known:
         checkname = "{}-content".format(testname)
         statusdict[checkname] = "log file ok"
-        if res:
+        if amount == 0:
             if debug:
                 print ("Log file did not change")
         else:
             if debug:
-                print ("Log file changed")
-            diff = compare(logfilepath, tmplogfile)
-            if testtype == 'new' and len(diff) > 0:
-                statusdict[checkname] = "new content: {}".format(diff[-3:])
-            if testtype == 'repeat' and len(diff) > 0:
-                # change of file is not important, only content in diff
-                # analyse diff
-                if len(diff) >= tolerance:
-                    testamount = sum([el.find(logsearchmessage) > -1 for el in diff])
-                    if testamount >= tolerance:
-                        statusdict[checkname] = "CRITICAL: execute script"
+                print ("Log file changed: {} new lines".format(amount))
+            if testtype == 'new':
+                statusdict[checkname] = "new content: {}".format(list(newlines))
+            if testtype == 'repeat':
+                # change of file is not important, only content of new lines
+                if amount >= tolerance and testamount >= tolerance:
+                    statusdict[checkname] = "CRITICAL: execute script"
         if testtype == 'last':
             # just check last line - independent from changes
             #  REQUIRES logsearchmessage to be success
-            lines = last(logfilepath,2)
+            lines = watcher.tail(2)
             if any([el.find(logsearchmessage) > -1 for el in lines]):
                 if debug:
                     print ("Fine - found success message")
@@ -414,21 +421,18 @@ def check_logfile(logfilepath, tmpdir='/tmp', statusdict=None, jobname='JOB', te
         elif testtype == 'contain':
             # check all lines - independent from changes
             #  REQUIRES logsearchmessage to be success
-            lines = last(logfilepath)
-            if any([el.find(logsearchmessage) > -1 for el in lines]):
+            if watcher.flags.get('contain'):
                 if debug:
                     print ("Fine - found message {}".format(logsearchmessage))
             else:
                 statusdict[checkname] = "Did not find {} in {}".format(logsearchmessage.replace("_",""), os.path.basename(logfilepath).replace("_",""))
 
     else:
-        # Nothing to do ... create log file first
+        # Nothing to do ... create state first
         pass
 
-    # save logfile to tmp
-    shutil.copy(logfilepath,tmpdir) # copy the logfile to destination dir
-    tmplogtorename = os.path.join(tmpdir,os.path.basename(logfilepath))
-    os.rename(tmplogtorename, tmplogfile) # rename
+    # save state to tmp
+    watcher.save()
 
     return statusdict
 
@@ -605,6 +609,7 @@ def main(argv):
     execute = monitorconf.get('execute',None)
     spacewarning  = int(monitorconf.get('spacewarning', 80))
     spacecritical  = int(monitorconf.get('spacecritical', 90))
+    scanworkers  = int(monitorconf.get('scanworkers', 4))
 
     if execute == "/path/execute.sh":
         execute = None
@@ -637,7 +642,8 @@ def main(argv):
             if debug:
                 print ("Running martas job")
             try:
-                statusmsg = check_martas(testpath=basedirectory, threshold=defaultthreshold, jobname=testname, statusdict=statusmsg, ignorelist=ignorelist,thresholddict=thresholddict, debug=debug)
+                statefile = os.path.join(tmpdir if tmpdir else "/tmp", "monitor-scan-{}.json".format(jobname))
+                statusmsg = check_martas(testpath=basedirectory, threshold=defaultthreshold, jobname=testname, statusdict=statusmsg, ignorelist=ignorelist,thresholddict=thresholddict, statefile=statefile, debug=debug)
             except:
                 statusmsg[testname] = "error when running martas job monitoring - please check"
         elif 'datafile' in joblist:
@@ -652,7 +658,7 @@ def main(argv):
                 print ("Running marcos job")
             try:
                 db = mm.connect_db(dbcred)
-                statusmsg = check_marcos(db, threshold=defaultthreshold, jobname=testname, statusdict=statusmsg, excludelist=ignorelist,acceptedoffsets=thresholddict, debug=debug)
+                statusmsg = check_marcos(db, threshold=defaultthreshold, jobname=testname, statusdict=statusmsg, excludelist=ignorelist,acceptedoffsets=thresholddict, dbcred=dbcred, workers=scanworkers, debug=debug)
             except:
                 statusmsg[testname] = "error when running marcos job monitoring - please check"
         if 'logfile' in joblist:
@@ -720,6 +726,9 @@ dbcredentials   :   cobsdb
 # accepted age of data in file or database (in seconds)
 defaultthreshold   :   600
 
+# parallel connections for tables not contained in the freshness index (DATAFRESHNESS)
+scanworkers   :   4
+
 # sensors not too be checked
 ignorelist   :   BASELINE,QUAKES,IPS,PIERS,DATAINFO,SENSORS,STATIONS,DIDATA_WIC,FLAGS
 
@@ -116,7 +116,7 @@ shutdown -P +1
 
 # Define packges to be used (local refers to test environment)
 # ------------------------------------------------------------
-from magpy.stream import DataStream, read
+from magpy.stream import DataStream, read, KEYLIST
 from magpy.core import database
 from magpy.core.methods import is_number
 import magpy.opt.cred as mpcred
@@ -125,6 +125,7 @@ from martas.core.methods import martaslog as ml
 
 from datetime import datetime, timedelta, timezone
 import sys, getopt, os
+import numpy as np
 import paho.mqtt.client as mqtt
 import socket
 
@@ -160,10 +161,11 @@ class sp(object):
     #valuedict = {'sensorid':'ENV05_2_0001','timerange':1800,'key':'t1','value':5,'function':'average','state':'below','message':'on','switchcommand':'None'}
 
 
-def get_data(source, path, dbcredentials, sensorid, amount, startdate=None, debug=False):
+def get_data(source, path, dbcredentials, sensorid, amount, startdate=None, db=None, debug=False):
     """
     DESCRIPTION:
     read the appropriate amount of data from the data file, database or mqtt stream
+    an already connected database (db) is used if provided
     """
 
     data = DataStream()
@@ -189,8 +191,9 @@ def get_data(source, path, dbcredentials, sensorid, amount, startdate=None, debu
             if debug:
                 print (msg)
     elif source in ['db','DB','database','Database']:
-        db = mameth.connect_db(dbcredentials)
-        data = db.read(sensorid, starttime=starttime)
+        if not db:
+            db = mameth.connect_db(dbcredentials)
+        data = db.read(sensorid, starttime=starttime, endtime=endtime)
 
     if debug:
         print ("Got {} datapoints".format(data.length()[0]))
@@ -236,6 +239,115 @@ def get_test_value(data=DataStream(), key='x', function='average', debug=False):
     return (testvalue, msg)
 
 
+class DataWindowCache(object):
+    """
+    DESCRIPTION:
+        reads the data of each sensor only once for all parameter sets. The largest
+        timerange requested for a sensor is read (one database connection for all sensors)
+        and all tests are performed on slices of these arrays (see get_window_value).
+    APPLICATION:
+        cache = DataWindowCache(conf, para)
+        (window, msg) = cache.get(sensorid, timerange)
+        (testvalue, msg) = get_window_value(window, key, function)
+    """
+
+    def __init__(self, conf, para, debug=False):
+        self.source = conf.get('source')
+        self.path = conf.get('bufferpath')
+        self.dbcredentials = conf.get('dbcredentials')
+        self.debug = debug
+        self.enddate = conf.get('startdate')
+        # all parameter sets refer to the same end time
+        self.now = self.enddate if self.enddate else datetime.now(timezone.utc).replace(tzinfo=None)
+        self.amounts = {}
+        for valuedict in para.values():
+            sensorid = valuedict.get('sensorid')
+            try:
+                amount = int(valuedict.get('timerange'))
+            except (TypeError, ValueError):
+                continue
+            self.amounts[sensorid] = max(amount, self.amounts.get(sensorid, 0))
+        self.windows = {}
+        self.db = None
+
+    def _connect(self):
+        if self.db is None and self.source in ['db','DB','database','Database']:
+            self.db = mameth.connect_db(self.dbcredentials)
+        return self.db
+
+    def get(self, sensorid, amount):
+        """
+        DESCRIPTION:
+            returns a dictionary with times (datetime64[us]), the data stream and the start
+            and end of the requested time range, and a message
+        """
+        if not sensorid in self.windows:
+            largest = max(int(amount), self.amounts.get(sensorid, 0))
+            (data, msg) = get_data(self.source, self.path, self.dbcredentials, sensorid, largest, startdate=self.enddate, db=self._connect(), debug=self.debug)
+            times = np.array([], dtype='datetime64[us]')
+            if data.length()[0] > 0:
+                times = np.asarray(data.ndarray[0]).astype('datetime64[us]')
+            self.windows[sensorid] = ({'data': data, 'times': times}, msg)
+        window, msg = self.windows[sensorid]
+        window = dict(window)
+        window['starttime'] = np.datetime64(self.now - timedelta(seconds=int(amount)), 'us')
+        window['endtime'] = np.datetime64(self.now, 'us')
+        return (window, msg)
+
+
+def get_window_value(window, key='x', function='average', debug=False):
+    """
+    DESCRIPTION
+    Returns comparison value(e.g. mean, max etc) of a time window obtained from DataWindowCache
+    """
+    if debug:
+        print ("Obtaining test value for key {} with function {}".format(key,function))
+    testvalue = None
+    msg = ''
+    data = window.get('data')
+    times = window.get('times')
+    if not key in KEYLIST or not len(data.ndarray[KEYLIST.index(key)]) > 0:
+        print ("Requested key not found")
+        return (testvalue, 'failure')
+    start = np.searchsorted(times, window.get('starttime'), side='left')
+    end = np.searchsorted(times, window.get('endtime'), side='right')
+    try:
+        values = np.asarray(data.ndarray[KEYLIST.index(key)][start:end], dtype=float)
+    except (TypeError, ValueError):
+        return (testvalue, 'failure')
+    total = len(values)
+    values = values[~np.isnan(values)]
+    n = len(values)
+    if n == 0:
+        return (testvalue, 'no data in selected time range')
+    # like DataStream.mean: mean, median and stddev are NaN if less than 95 percent are valid
+    perc = n/total*100.
+    if function in ['mean','Mean','average', 'Average','Median','median','stddev','Stddev'] and perc < 95:
+        print ("{}: Too many nans in column {}, exceeding 5 percent ({:.1f})".format(function, key, 100-perc))
+        return (np.nan, msg)
+    if function in ['mean','Mean','average', 'Average','Median','median']:
+        if n < 3:
+            print ("not enough data points --- {} insignificant".format(function))
+        if function in ['mean','Mean','average', 'Average']:
+            testvalue = float(np.mean(values))
+        else:
+            testvalue = float(np.median(values))
+    elif function in ['max','Max']:
+        testvalue = float(np.max(values))
+    elif function in ['min','Min']:
+        testvalue = float(np.min(values))
+    elif function in ['stddev','Stddev']:
+        # population standard deviation of the valid values as returned by DataStream.mean(std=True)
+        testvalue = float(np.std(values))
+    else:
+        msg = 'selected test function not available'
+
+    if debug:
+        print (" ... got {}".format(testvalue))
+
+    return (testvalue, msg)
+
+
 def check_threshold(testvalue, threshold, state, debug=False):
     """
     DESCRIPTION:
@@ -410,6 +522,9 @@ def main(argv):
     except:
         print ("Could not import martas logging routines - check MARTAS directory path")
 
+    # Data of each sensor is read once (largest timerange) and shared by all parameter sets
+    cache = DataWindowCache(conf, para, debug=debug)
+
     # For each parameter
     for i in range(0,1000):
             valuedict = para.get(str(i),{})
@@ -417,7 +532,6 @@ def main(argv):
             if not valuedict == {}:
                 if debug:
                     print ("Checking parameterset {}".format(i))
-                data = DataStream()
                 testvalue = None
                 evaluate = {}
 
@@ -425,8 +539,8 @@ def main(argv):
                 if debug:
                     print ("Accessing data from {} at {}: Sensor {} - Amount: {} sec".format(conf.get('source'),conf.get('bufferpath'),valuedict.get('sensorid'),valuedict.get('timerange') ))
 
-                (data,msg1) = get_data(conf.get('source'), conf.get('bufferpath'), conf.get('dbcredentials'), valuedict.get('sensorid'),valuedict.get('timerange'), debug=debug , startdate=conf.get('startdate') )
-                (testvalue,msg2) = get_test_value( data, valuedict.get('key'), valuedict.get('function'), debug=debug) # Returns comparison value(e.g. mean, max etc)
+                (window,msg1) = cache.get(valuedict.get('sensorid'),valuedict.get('timerange'))
+                (testvalue,msg2) = get_window_value( window, valuedict.get('key'), valuedict.get('function'), debug=debug) # Returns comparison value(e.g. mean, max etc)
                 if not testvalue and travistestrun:
                     print ("Testrun for parameterset {} OK".format(i))
                 elif not testvalue and not testvalue == 0.0:
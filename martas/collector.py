@@ -8,25 +8,27 @@ written by Roman Leonhardt
 # Import packages
 # ###################################################################
 
-## Import MagPy
+import sys
+## Startup profiling (option --profile-startup) - enabled before all heavy imports
+from martas.core.startup import StartupProfiler
+profiler = StartupProfiler(enabled='--profile-startup' in sys.argv)
+
+## Import MagPy (magpy.core.database is imported for the db destination only)
 ## -----------------------------------------------------------
 
-from magpy.stream import DataStream, join_streams, KEYLIST, NUMKEYLIST, subtract_streams
-from magpy.core import database
+from magpy.stream import DataStream, KEYLIST
 from magpy.opt import cred as mpcred
 
 ## Import Twisted for websocket and logging functionality
+## (twisted.web is imported by the webserver process)
 from twisted.python import log
-from twisted.web.server import Site
-from twisted.web.static import File
-from twisted.internet import reactor
 
+import time
 import threading
 from multiprocessing import Process
 import struct
+import signal
 from datetime import datetime
-from matplotlib.dates import num2date
-import numpy as np
 import json
 import socket
 from io import StringIO
@@ -34,6 +36,10 @@ from io import StringIO
 ## Import specific MARTAS packages
 ## -----------------------------------------------------------
 from martas.core import methods as mm
+from martas.core.bufferwriter import get_pool
+from martas.core.collectorsupport import decode_payload, get_codec, SensorRegistry, DiffEngine, WebsocketBatcher
+from martas.core.dbsink import DatabaseSink
+from martas.core.pipeline import MessagePipeline
 from martas.version import __version__
 from martas.core.methods import martaslog as ml
 from martas.core.websocket_server import WebsocketServer
@@ -66,11 +72,10 @@ ws_available = True
 qos = 0
 streamdict = {}
 stream = DataStream()
-diffstruct = {}
 st = []
 senslst = []
-headdict = {} # store headerlines for all sensors (headerline are firstline for BIN files)
-headstream = {}
+# per sensor state: header line (first line of BIN files), header dictionary, codec, keys, counters
+registry = SensorRegistry()
 verifiedlocation = False
 destination = 'stdout'
 location = '/tmp'
@@ -80,11 +85,14 @@ stid = stationid
 webpath = './web'
 webport = 8080
 socketport = 5000
+# batched websocket mode (socketmode : batch) - None sends every sample as a single frame
+wsbatcher = None
 diffsens = "G823"
+diffengine = DiffEngine(sensors=diffsens)
 blacklist = []
 counter = 0
-diffcounter = 0
-prevlasttimestamp_prim = None
+pipeline = None
+dbsink = None
 
 ## SSL PSK tools
 def _ssl_setup_psk_callbacks(sslobj):
@@ -146,20 +154,44 @@ SSLPSKContext.sslobject_class = SSLPSKObject
 SSLPSKContext.sslsocket_class = SSLPSKSocket
 
 
-class protocolparameter(object):
-    def __init__(self):
-        self.identifier = {}
-        #self.counter = 0
-
-po = protocolparameter()
-
 ## WebServer Methods
 ## -----------------------------------------------------------
 def wsThread(wsserver):
     wsserver.set_fn_new_client(new_wsclient)
     wsserver.set_fn_message_received(message_received)
+    wsserver.set_fn_client_left(wsclient_left)
     wsserver.run_forever()
 
+def wsFlushThread(wsserver, batcher):
+    """
+    Batched websocket mode: sends the collected samples of every sensor once per interval.
+    Frames are created once for each client setting (rate, decimation, binary).
+    """
+    while True:
+        time.sleep(batcher.interval)
+        groups = {}
+        for client in list(wsserver.clients):
+            groups.setdefault(batcher.settings(client['id']), []).append(client)
+        frames = batcher.flush(list(groups.keys()))
+        for settings, clients in groups.items():
+            for frame in frames.get(settings, []):
+                wsserver.send_message_to_all(frame, binary=settings[2], clients=clients)
+
+def statusThread(interval):
+    """
+    Logs queue depth, drops and spills of the message pipeline and flush statistics
+    of the database sink every interval seconds.
+    """
+    while True:
+        time.sleep(interval)
+        if pipeline:
+            log.msg("Pipeline: {}".format(pipeline.summary()))
+        if dbsink:
+            stat = dbsink.status()
+            log.msg("DB: {} rows queued, {} flushes ({} rows, mean latency {:.3f} sec, max {:.3f} sec), {} failures, {} rows spilled, {} replayed, {} spill files".format(
+                stat.get('queuedrows'), stat.get('flushes'), stat.get('rows'), stat.get('meanlatency'), stat.get('maxlatency'),
+                stat.get('failures'), stat.get('spilled'), stat.get('replayed'), stat.get('spillfiles')))
+
 if ws_available:
     global wsserver
 
@@ -170,7 +202,14 @@ def new_wsclient(ws_client,server):
     #print(str(threading.enumerate()))
 
 def message_received(ws_client,server,message):
-    pass
+    # clients of the batched mode can select rate, decimation and binary frames
+    # e.g. {"rate": 2, "decimation": "mean", "binary": true}
+    if wsbatcher and not wsbatcher.set_client(ws_client['id'], message):
+        log.msg("websocket: could not interpret client message {}".format(message[:100]))
+
+def wsclient_left(ws_client,server):
+    if wsbatcher and ws_client:
+        wsbatcher.remove_client(ws_client['id'])
 
 def webProcess(webpath,webport):
     """
@@ -178,6 +217,9 @@ def webProcess(webpath,webport):
     When the main process is killed, also this child process is killed
     because of having it started as a daemon
     """
+    from twisted.web.server import Site
+    from twisted.web.static import File
+    from twisted.internet import reactor
     resource = File(webpath)
     print ("TESTING", webpath, resource)
     factory = Site(resource)
@@ -290,17 +332,36 @@ def analyse_meta(header,sensorid,debug=False):
     if debug:
         log.msg("Packing code: {}".format(packstr))
         log.msg("keylist: {}".format(keylist))
-    po.identifier[sensorid+':packingcode'] = packstr
-    po.identifier[sensorid+':keylist'] = keylist
-    po.identifier[sensorid+':elemlist'] = elemlist
-    po.identifier[sensorid+':unitlist'] = unitlist
-    po.identifier[sensorid+':multilist'] = multilist
+    registry.set_meta(sensorid, packstr, keylist, elemlist, unitlist, multilist)
+    set_codec(packstr,sensorid)
 
 
-def create_head_dict(header,sensorid):
+def set_codec(packstr,sensorid):
+    """
+    source:mqtt:
+    Precompile the binary codec used for buffer files from the header packing code
+    """
+    if isinstance(packstr, bytes):
+        packstr = packstr.decode()
+    # drop leading < and final B
+    if packstr.endswith('B'):
+        packcode = packstr.strip('<')[:-1]
+    else:
+        packcode = packstr.strip('<')
+    # temporary code - too be deleted when lemi protocol has been updated
+    if packcode.find('4cb6B8hb30f3Bc') >= 0:
+        packcode = '6hLffflll'
+    try:
+        registry.record(sensorid).codec = get_codec(packcode)
+    except struct.error:
+        log.msg("Packing code {} of {} not supported for file destination".format(packcode,sensorid))
+
+
+def create_head_dict(header,sensorid,station=None):
     """
     source:mqtt:
     Interprete header information
+    station: station id of the topic (default: global stid)
     """
     head_dict={}
     try:
@@ -336,7 +397,9 @@ def create_head_dict(header,sensorid):
     head_dict['SensorRevision'] = sensl[2]
     head_dict['SensorKeys'] = ','.join(keylist)
     head_dict['SensorElements'] = ','.join(elemlist)
-    head_dict['StationID'] = stid.upper()
+    if not station:
+        station = stid
+    head_dict['StationID'] = station.upper()
     # possible additional data in header (because in sensor.cfg)
     #head_dict['DataPier'] = ...
     #head_dict['SensorModule'] = ...
@@ -358,33 +421,19 @@ def create_head_dict(header,sensorid):
 def interprete_data(payload, sensorid):
     """
     source:mqtt:
+    returns a MagPy ndarray of the payload (see decode_data)
     """
-    # future: check for json payload first
+    return decode_data(payload, sensorid).to_ndarray()
 
-    lines = payload.split(';') # for multiple lines send within one payload
-    # allow for strings in payload !!
-    array = [[] for elem in KEYLIST]
-    keylist = po.identifier[sensorid+':keylist']
-    multilist = po.identifier[sensorid+':multilist']
-    for line in lines:
-        data = line.split(',')
-        timear = list(map(int,data[:7]))
-        #log.msg(timear)
-        time = datetime(timear[0],timear[1],timear[2],timear[3],timear[4],timear[5],timear[6])
-        array[0].append(time)
-        for idx, elem in enumerate(keylist):
-            try:
-                index = KEYLIST.index(elem)
-                if not elem.endswith('time'):
-                    if elem in NUMKEYLIST:
-                        array[index].append(float(data[idx+7])/float(multilist[idx]))
-                    else:
-                        array[index].append(data[idx+7])
-            except:
-                # might fail with list index out of range - take all others
-                pass
-
-    return np.asarray([np.asarray(elem) for elem in array],dtype=object)
+def decode_data(payload, sensorid):
+    """
+    source:mqtt:
+    decode a data payload in one pass - returns a PayloadBlock with a datetime64 time column
+    and a float64 value matrix (multipliers applied) shared by all destinations
+    """
+    # future: check for json payload first
+    rec = registry.get(sensorid)
+    return decode_payload(payload, rec.keylist, rec.multilist, rec.keymap)
 
 def merge_two_dicts(x, y):
         z = x.copy()   # start with x's keys and values
@@ -414,11 +463,28 @@ def on_connect(client, userdata, flags, rc, properties=None):
     client.subscribe(substring,qos=qos)
 
 def on_message(client, userdata, msg):
+    """
+    DESCRIPTION
+        paho network thread callback: only enqueue the message - processing is done
+        by the worker threads of the message pipeline (process_message).
+        Messages of one sensor are always handled by the same worker.
+    """
     if not stationid in ['all','All','ALL']:
         if not msg.topic.startswith(stationid):
             return
+    if pipeline:
+        key = msg.topic.replace('meta','').replace('data','').replace('dict','')
+        pipeline.put(msg.topic, msg.payload, msg.qos, key=key)
+    else:
+        process_message(msg)
 
-    if not pyversion.startswith('2'):
+
+def process_message(msg):
+    """
+    DESCRIPTION
+        interprete a single MQTT message (meta, dict or data) and send it to all destinations
+    """
+    if not pyversion.startswith('2') and isinstance(msg.payload, bytes):
        msg.payload= msg.payload.decode('ascii')
 
     global qos
@@ -427,25 +493,19 @@ def on_message(client, userdata, msg):
     global debug
     global stid
     global senslst
-    global diffstruct
-    digit = 0
-    arrayinterpreted = False
-    wsarrayinterpreted = False
-    diarrayinterpreted = False
-    siarrayinterpreted = False
-    soarrayinterpreted = False
-    dbarrayinterpreted = False
+    block = None  # decoded payload shared by all destinations
     if stationid in ['all','All','ALL']:
-        stid = msg.topic.split('/')[0]
+        msgstid = msg.topic.split('/')[0]
     else:
-        stid = stationid
+        msgstid = stationid
+    stid = msgstid
     try:
         sensorind = msg.topic.split('/')[1]
         sensorid = sensorind.replace('meta','').replace('data','').replace('dict','')
     except:
         # Above will fail if msg.topic does not contain /
         # TODO (previous version was without 1, first occurrence -> the following line should work as well although the code above is more general)
-        sensorid = msg.topic.replace(stid,"",1).replace('/','').replace('meta','').replace('data','').replace('dict','')
+        sensorid = msg.topic.replace(msgstid,"",1).replace('/','').replace('meta','').replace('data','').replace('dict','')
     # define a new data stream for each non-existing sensor
     if not instrument == '':
         if not sensorid.find(instrument) > -1:
@@ -482,14 +542,17 @@ def on_message(client, userdata, msg):
                     print ("Interpretation error for {}".format(msg.topic))
                     return
                 #print (payload, sensorid, headerline)
-                headdict[sensorid] = headerline
-                headstream[sensorid] = create_head_dict(headerline,sensorid)
-                headstream[sensorid] = merge_two_dicts(headstream[sensorid], headerdictionary)
+                rec = registry.record(sensorid)
+                rec.headerline = headerline
+                rec.header = merge_two_dicts(create_head_dict(headerline,sensorid,station=msgstid), headerdictionary)
                 msg.topic = msg.topic+'/data'
-                for el in identdic:
-                    po.identifier[el] = identdic[el]
+                registry.update_identifiers(identdic)
+                if sensorid+':packingcode' in identdic:
+                    set_codec(identdic[sensorid+':packingcode'],sensorid)
 
-    metacheck = po.identifier.get(sensorid+':packingcode','')
+    # single registry lookup per message
+    rec = registry.get(sensorid)
+    metacheck = rec.packingcode if rec else ''
 
 
     ## ################################################################################
@@ -498,15 +561,16 @@ def on_message(client, userdata, msg):
         log.msg("Found basic header:{}".format(str(msg.payload)))
         log.msg("Quality of Service (QOS):{}".format(str(msg.qos)))
         analyse_meta(str(msg.payload),sensorid,debug=debug)
-        if not sensorid in headdict:
-            headdict[sensorid] = msg.payload
+        rec = registry.record(sensorid)
+        if rec.headerline is None:
+            rec.headerline = msg.payload
             # create stream.header dictionary and it here
-            headstream[sensorid] = create_head_dict(str(msg.payload),sensorid)
+            rec.header = create_head_dict(str(msg.payload),sensorid,station=msgstid)
             if debug:
-                log.msg("New headdict: {}".format(headdict))
-    elif msg.topic.endswith('dict') and sensorid in headdict:
+                log.msg("New header line for {}: {}".format(sensorid, rec.headerline))
+    elif msg.topic.endswith('dict') and rec and rec.headerline is not None:
         #log.msg("Found Dictionary:{}".format(str(msg.payload)))
-        head_dict = headstream[sensorid]
+        head_dict = rec.header
         for elem in str(msg.payload).split(','):
             keyvaluespair = elem.split(':')
             try:
@@ -515,8 +579,12 @@ def on_message(client, userdata, msg):
             except:
                 pass
         if debug:
-            log.msg("Dictionary now looks like {}".format(headstream[sensorid]))
+            log.msg("Dictionary now looks like {}".format(rec.header))
     elif msg.topic.endswith('data'):  # or readable json
+        if profiler.enabled and not profiler.reported:
+            profiler.mark("first data message ({})".format(sensorid))
+            log.msg(profiler.report())
+            profiler.disable()
         #if readable json -> create stream.ndarray and set arrayinterpreted :
         #    log.msg("Found data:", str(msg.payload), metacheck)
         if not metacheck == '':
@@ -527,174 +595,98 @@ def on_message(client, userdata, msg):
                 #    log.msg(sensorid, metacheck, msg.payload)  # payload can be split
                 # Check whether header is already identified
                 # -------------------
-                if sensorid in headdict:
-                    header = headdict.get(sensorid)
-                    if sys.version_info >= (3,0):
-                        metacheck = metacheck.decode()
-                    if metacheck.endswith('B'):
-                        packcode = metacheck.strip('<')[:-1] # drop leading < and final B
-                    else:
-                        packcode = metacheck.strip('<') # drop leading <
+                codec = rec.codec
+                if rec.headerline and codec:
+                    header = rec.headerline
                     # temporary code - too be deleted when lemi protocol has been updated
-                    if packcode.find('4cb6B8hb30f3Bc') >= 0:
-                        header = header.replace('<4cb6B8hb30f3BcBcc5hL 169\n','6hLffflll {}'.format(struct.calcsize('<6hLffflll')))
-                        packcode = '6hLffflll' 
-                    arrayelem = msg.payload.split(';')
-                    for ar in arrayelem:
-                        datearray = ar.split(',')
-                        # identify string values in packcode
-                        # -------------------
-                        # convert packcode numbers
-                        cpack = []
-                        for c in packcode:
-                            if c.isdigit():
-                                digit = int(c)
-                            else:
-                                cpack.extend([c] * digit)
-                                digit=1
-                        cpackcode = "".join(cpack)
-                        for i in range(len(cpackcode)):
-                            if cpackcode[-i] == 's':
-                                datearray[-i] = datearray[-i]
-                            elif cpackcode[-i] == 'f':
-                                datearray[-i] = float(datearray[-i])
-                            else:
-                                datearray[-i] = int(float(datearray[-i]))
-                        # pack data using little endian byte order
-                        data_bin = struct.pack('<'+packcode,*datearray)
-                        # Check whether destination path has been verified already
-                        # -------------------
-                        if not verifiedlocation:
-                            if not location in [None,''] and os.path.exists(location):
-                                verifiedlocation = True
-                            else:
-                                log.msg("File: destination location {} is not accessible".format(location))
-                                log.msg("      -> please use option l (e.g. -l '/my/path') to define") 
-                        if verifiedlocation:
-                            filename = "{}-{:02d}-{:02d}".format(datearray[0],datearray[1],datearray[2])
+                    if header.find('4cb6B8hb30f3Bc') >= 0:
+                        header = header.replace('<4cb6B8hb30f3BcBcc5hL 169\n','6hLffflll {}'.format(codec.size))
+                    # Check whether destination path has been verified already
+                    # -------------------
+                    if not verifiedlocation:
+                        if not location in [None,''] and os.path.exists(location):
+                            verifiedlocation = True
+                        else:
+                            log.msg("File: destination location {} is not accessible".format(location))
+                            log.msg("      -> please use option l (e.g. -l '/my/path') to define")
+                    if verifiedlocation:
+                        # pack all lines of the payload using little endian byte order
+                        try:
+                            groups = codec.pack_payload(msg.payload)
+                        except (struct.error, ValueError, IndexError) as e:
+                            log.msg("File: could not pack data of {}: {}".format(sensorid, e))
+                            rec.errors += 1
+                            groups = []
+                        for filename, data_bin in groups:
                             mm.data_to_file(location, sensorid, filename, data_bin, header)
-            if 'websocket' in destination:
-                if not wsarrayinterpreted:
-                    stream.ndarray = interprete_data(msg.payload, sensorid)
-                    #streamdict[sensorid] = stream.ndarray  # to store data from different sensors
-                    wsarrayinterpreted = True
-                for idx,dt in enumerate(stream.ndarray[0]):
-                    msecSince1970 = int((dt - datetime(1970,1,1)).total_seconds()*1000)
-                    datastring = ','.join([str(val[idx]) for i,val in enumerate(stream.ndarray) if len(val) > 0 and not i == 0])
+            if any(dest in destination for dest in ['websocket','diff','stdout','db','stringio']):
+                block = decode_payload(msg.payload, rec.keylist, rec.multilist, rec.keymap)
+            rec.touch(len(block) if block is not None else 0)
+            if 'websocket' in destination and wsbatcher:
+                wsbatcher.add(sensorid, block)
+            elif 'websocket' in destination:
+                for msecSince1970, datastring in zip(block.msec().tolist(), block.rows()):
                     if debug:
                         print ("Sending {}: {},{} to webserver".format(sensorid, msecSince1970,datastring))
                     wsserver.send_message_to_all("{}: {},{}".format(sensorid,msecSince1970,datastring))
             if 'diff' in destination:
                 """
                 How does it work:
-                - add AMOUNT of recent data to array for each fitting sensor
-                - create dictionary with data streams of length "cover" - default is 5 
-                - subtract all stream 
+                - the newest samples of each selected sensor are kept in a ring buffer
+                - new samples are matched to the closest sample of the partner sensor
+                - the difference is published as Diff_* sensor, meta information every 6th sample
                 """
-                global diffcounter # used to send meta information not every step
-                global prevlasttimestamp_prim
-                cover = 5
-                if sensorid.find(diffsens) >= 0:
-                    st = diffstruct.get(sensorid, DataStream())
-                    ar = interprete_data(msg.payload, sensorid)
-                    ds = DataStream(header={"SensorID": sensorid}, ndarray=ar)
-                    st = join_streams(ds,st)
-                    st = st.cut(cover, 1, 0)
-                    diffstruct[sensorid] = st
-                if len(diffstruct) >= 2:
-                    names = sorted(diffstruct.keys())
-                    lasttimestamp_prim = diffstruct.get(names[0]).timerange()[1]
-                    #print (lasttimestamp_prim, prevlasttimestamp_prim)
-                    for i,name in enumerate(names):
-                        if i > 0:
-                            prim = diffstruct.get(names[i-1])
-                            seco = diffstruct.get(name)
-                            if len(prim) >= cover and len(seco) >= cover:
-                                # Sub has been verified - please note: has half of the original resolution - why?
-                                if not lasttimestamp_prim == prevlasttimestamp_prim:
-                                    try:
-                                        sub = subtract_streams(prim, seco)
-                                        primname = prim.header.get("SensorID", "TEST_unkown").split("_")[1]
-                                        seconame = seco.header.get("SensorID", "TEST_unkown").split("_")[1]
-                                        diffname = "Diff_{}{}_0001".format(primname, seconame)
-                                        keys = sub._get_key_headers(numerical=True)
-                                        ilst = [KEYLIST.index(key) for key in keys]
-                                        # get data line for pub
-                                        time = sub.ndarray[0][-1]
-                                        timestr = ",".join(str(t) for t in [time.year, time.month, time.day, time.hour, time.minute, time.second, time.microsecond])
-                                        val = [sub.ndarray[i][-1] for i in ilst]
-                                        if len(val) > 1:
-                                            valstr = ",".join(int(val * 1000))
-                                        else:
-                                            valstr = int(val[0] * 1000)
-                                        data = "{},{}".format(timestr, valstr)
-                                        # print (data)
-                                        topic = "{}/{}".format(stid, diffname)
-                                        diffcounter += 1
-                                        client.publish(topic + "/data", data, qos=qos)
-                                        if diffcounter > 5:
-                                            # now get a new sensorid name
-                                            # get head line for pub
-                                            keystr = "[{}]".format(",".join(keys))
-                                            headtemplate = headdict.get(names[0])
-                                            headtemplatelist = headtemplate.split()
-                                            if keystr == headtemplatelist[3]:
-                                                # then use column names and units from data header and add delta to names
-                                                try:
-                                                    keynamestr = "[{}]".format(",".join(["delta_{}".format(el) for el in headtemplatelist[4].replace("[","").replace("]","").split(",")]))
-                                                except:
-                                                    keynamestr = keystr
-                                                unit = headtemplatelist[5]
-                                            else:
-                                                #use keys as names and arbitrary units
-                                                unit = "[{}]".format(",".join(['arb'] * len(keys)))
-                                                keynamestr = keystr
-
-                                            # takeunits =  ### take from st[0]
-                                            packcode = "6hL{}".format("".join(['l'] * len(keys)))
-                                            multi = "[{}]".format(",".join(['1000'] * len(keys)))
-                                            head = "# MagPyBin {} {} {} {} {} {} {}".format(diffname, keystr, keynamestr, unit,
-                                                                                            multi, packcode,
-                                                                                            struct.calcsize('<' + packcode))
-                                            client.publish(topic + "/meta", head, qos=qos)
-                                            diffcounter = 0
-                                        prevlasttimestamp_prim = lasttimestamp_prim
-                                        if debug:
-                                            print(" -> diff {} published: {}".format(diffname, data))
-                                    except:
-                                        print (" -> diff failed")
+                for diff in diffengine.add(sensorid, block):
+                    try:
+                        time = diff.time.astype(datetime)
+                        timestr = ",".join(str(t) for t in [time.year, time.month, time.day, time.hour, time.minute, time.second, time.microsecond])
+                        valstr = ",".join(str(int(round(val * 1000))) for val in diff.values.tolist())
+                        data = "{},{}".format(timestr, valstr)
+                        topic = "{}/{}".format(stid, diff.name)
+                        client.publish(topic + "/data", data, qos=qos)
+                        if diff.count % 6 == 1:
+                            # get head line for pub
+                            keystr = "[{}]".format(",".join(diff.keys))
+                            headtemplate = registry.get(diff.prim).headerline
+                            headtemplatelist = headtemplate.split()
+                            if keystr == headtemplatelist[3]:
+                                # then use column names and units from data header and add delta to names
+                                try:
+                                    keynamestr = "[{}]".format(",".join(["delta_{}".format(el) for el in headtemplatelist[4].replace("[","").replace("]","").split(",")]))
+                                except:
+                                    keynamestr = keystr
+                                unit = headtemplatelist[5]
+                            else:
+                                #use keys as names and arbitrary units
+                                unit = "[{}]".format(",".join(['arb'] * len(diff.keys)))
+                                keynamestr = keystr
+                            packcode = "6hL{}".format("".join(['l'] * len(diff.keys)))
+                            multi = "[{}]".format(",".join(['1000'] * len(diff.keys)))
+                            head = "# MagPyBin {} {} {} {} {} {} {}".format(diff.name, keystr, keynamestr, unit,
+                                                                            multi, packcode,
+                                                                            struct.calcsize('<' + packcode))
+                            client.publish(topic + "/meta", head, qos=qos)
+                        if debug:
+                            print(" -> diff {} published: {}".format(diff.name, data))
+                    except:
+                        print (" -> diff failed")
             if 'stdout' in destination:
-                if not soarrayinterpreted:
-                    stream.ndarray = interprete_data(msg.payload, sensorid)
-                    #streamdict[sensorid] = stream.ndarray  # to store data from different sensors
-                    soarrayinterpreted = True
-                for idx,dt in enumerate(stream.ndarray[0]):
-                    datastring = ','.join([str(val[idx]) for i,val in enumerate(stream.ndarray) if len(val) > 0 and not i == 0])
+                for dt, datastring in zip(block.datetimes(), block.rows()):
                     log.msg("{}: {},{}".format(sensorid, dt, datastring))
             elif 'db' in destination:
-                if not dbarrayinterpreted:
-                    stream.ndarray = interprete_data(msg.payload, sensorid)
-                    #streamdict[sensorid] = stream.ndarray  # to store data from different sensors
-                    dbarrayinterpreted = True
-                # create a stream.header
+                # queue data for the background database sink
                 if debug:
-                    log.msg(stream.ndarray)
-                stream.header = headstream[sensorid]
-                if debug:
-                    log.msg("writing header: {}".format(headstream[sensorid]))
+                    log.msg("queuing {} rows of {} with header: {}".format(len(block), sensorid, rec.header))
                 if revision != 'free':
-                    db.write(stream,tablename="{}_{}".format(sensorid,'0001'))
+                    dbsink.put(sensorid, "{}_{}".format(sensorid,'0001'), rec.header, block)
                 else:
-                    db.write(stream)
+                    dbsink.put(sensorid, None, rec.header, block)
             elif 'stringio' in destination:
-                if not siarrayinterpreted:
-                    stream.ndarray = interprete_data(msg.payload, sensorid)
-                    #streamdict[sensorid] = stream.ndarray  # to store data from different sensors
-                    siarrayinterpreted = True
-                for idx,dt in enumerate(stream.ndarray[0]):
+                for dt, datastring in zip(block.datetimes(), block.rows()):
                     date = datetime.strftime(dt,"%Y-%m-%d %H:%M:%S.%f")
                     linelist = list(map(str,[dt,date]))
-                    linelist.extend([str(val[idx]) for i,val in enumerate(stream.ndarray) if len(val) > 0 and not i == 0])
+                    if datastring:
+                        linelist.append(datastring)
                     line = ','.join(linelist)
                     eol = '\r\n'
                     output.write(line+eol)
@@ -733,13 +725,14 @@ def on_message(client, userdata, msg):
     if msg.topic.endswith('meta') and 'websocket' in destination:
         # send header info for each element (# sensorid   nr   key   elem   unit)
         analyse_meta(str(msg.payload),sensorid)
-        for (i,void) in enumerate(po.identifier[sensorid+':keylist']):
+        rec = registry.get(sensorid)
+        for (i,void) in enumerate(rec.keylist):
             jsonstr={}
             jsonstr['sensorid'] = sensorid
             jsonstr['nr'] = i
-            jsonstr['key'] = po.identifier[sensorid+':keylist'][i]
-            jsonstr['elem'] = po.identifier[sensorid+':elemlist'][i]
-            jsonstr['unit'] = po.identifier[sensorid+':unitlist'][i]
+            jsonstr['key'] = rec.keylist[i]
+            jsonstr['elem'] = rec.elemlist[i]
+            jsonstr['unit'] = rec.unitlist[i]
             payload = json.dumps(jsonstr)
             wsserver.send_message_to_all('# '+payload)
 
@@ -783,8 +776,6 @@ def main(argv):
     global debug
     debug = False
     global output
-    global headstream
-    headstream = {}
     global topic_identifiers
     topic_identifiers = {}
     global class_reference
@@ -808,7 +799,7 @@ def main(argv):
 
     usagestring = 'collector.py -b <broker> -p <port> -t <timeout> -o <topic> -i <instrument> -d <destination> -v <revision> -l <location> -c <credentials> -r <dbcred> -q <qos> -u <user> -P <password> -s <source> -f <offset> -m <marcos> -n <number> -e <telegramconf> -a <addlib>'
     try:
-        opts, args = getopt.getopt(argv,"hb:p:t:o:i:d:vl:c:r:q:u:P:s:f:m:n:e:a:U",["broker=","port=","timeout=","topic=","instrument=","destination=","revision=","location=","credentials=","dbcred=","qos=","debug=","user=","password=","source=","offset=","marcos=","number=","telegramconf=","addlib="])
+        opts, args = getopt.getopt(argv,"hb:p:t:o:i:d:vl:c:r:q:u:P:s:f:m:n:e:a:U",["broker=","port=","timeout=","topic=","instrument=","destination=","revision=","location=","credentials=","dbcred=","qos=","debug=","user=","password=","source=","offset=","marcos=","number=","telegramconf=","addlib=","profile-startup"])
     except getopt.GetoptError:
         print ('Check your options:')
         print (usagestring)
@@ -859,6 +850,7 @@ def main(argv):
             print ('-e                             provide a path to telegram configuration for ')
             print ('                               sending critical log changes.')
             print ('-a                             additional MQTT translation library ')
+            print ('--profile-startup              report import times and startup milestones')
             print ('------------------------------------------------------')
             print ('Examples:')
             print ('1. Basic')
@@ -988,8 +980,12 @@ def main(argv):
             addlib = arg.split(',')
         elif opt in ("-U", "--debug"):
             debug = True
+        elif opt == "--profile-startup":
+            pass # evaluated when importing - see profiler
 
+    profiler.mark("configuration loaded")
     diffsens = conf.get('differencesensors',"G823")
+    diffengine.configure(conf, sensors=diffsens)
     if debug:
         print ("collector starting with the following parameters:")
         print ("Logs: {}; Broker: {}; Topic/StationID: {}; QOS: {}; MQTTport: {}; MQTTuser: {}; MQTTcredentials: {}; Data destination: {}; Filepath: {}; DB credentials: {}; Offsets: {}".format(logging, broker, stationid, qos, port, user, credentials, destination, location, dbcred, offset))
@@ -1045,16 +1041,34 @@ def main(argv):
             log.msg('destination "file" requires a valid path provided as location')
             log.msg(' ... aborting ...')
             sys.exit()
+        # buffer files are kept open by the writer pool - flush and fsync policy from marcos.cfg
+        get_pool().configure(conf)
+        if debug:
+            log.msg("File: flushing every {} sec or {} bytes, fsync policy: {}".format(get_pool().flushinterval, get_pool().flushbytes, get_pool().fsync))
     if 'websocket' in destination:
         if ws_available:
             # 0.0.0.0 makes the websocket accessable from anywhere
             global wsserver
-            wsserver = WebsocketServer(socketport, host='0.0.0.0')
+            try:
+                wsqueue = int(conf.get('socketqueue', 1000))
+                wslag = float(conf.get('socketmaxlag', 30))
+            except (TypeError, ValueError):
+                log.msg('socketqueue/socketmaxlag could not be extracted from marcos config file - using defaults')
+                wsqueue, wslag = 1000, 30.
+            wsserver = WebsocketServer(socketport, host='0.0.0.0', maxqueue=wsqueue, maxlag=wslag)
             wsThr = threading.Thread(target=wsThread,args=(wsserver,))
             # start websocket-server in a thread as daemon, so the entire Python program exits
             wsThr.daemon = True
             log.msg('starting WEBSOCKET on port '+str(socketport))
             wsThr.start()
+            if conf.get('socketmode', 'sample') == 'batch':
+                global wsbatcher
+                wsbatcher = WebsocketBatcher()
+                wsbatcher.configure(conf)
+                flushThr = threading.Thread(target=wsFlushThread, args=(wsserver, wsbatcher))
+                flushThr.daemon = True
+                flushThr.start()
+                log.msg('websocket: batched mode every {} sec (rate, decimation, binary: {})'.format(wsbatcher.interval, wsbatcher.defaults))
             # start webserver as process, also as daemon (kills process, when main program ends)
             webPr = Process(target=webProcess, args=(webpath,webport))
             webPr.daemon = True
@@ -1072,6 +1086,7 @@ def main(argv):
         else:
             try:
                 global db
+                from magpy.core import database
                 if debug:
                     log.msg("Connecting database {} at host {} with user {}".format(mpcred.lc(dbcred,'db'),mpcred.lc(dbcred,'host'),mpcred.lc(dbcred,'user')))
                 #db = mysql.connect(host=mpcred.lc(dbcred,'host'),user=mpcred.lc(dbcred,'user'),passwd=mpcred.lc(dbcred,'passwd'),db=mpcred.lc(dbcred,'db'))
@@ -1081,6 +1096,22 @@ def main(argv):
                 log.msg('database {} at host {} with user {} could not be connected'.format(mpcred.lc(dbcred,'db'),mpcred.lc(dbcred,'host'),mpcred.lc(dbcred,'user')))
                 log.msg(' ... aborting ...')
                 sys.exit()
+            # batched writes in a background thread
+            global dbsink
+            dbsink = DatabaseSink(db, dbcredentials=dbcred, debug=debug)
+            dbsink.configure(conf)
+            dbsink.start()
+            log.msg("DB: flushing every {} sec or {} rows, spill path {}".format(dbsink.flushinterval, dbsink.flushrows, dbsink.spillpath))
+
+    # periodic status report of the queues
+    try:
+        statusinterval = float(conf.get('statusinterval', 600))
+    except (TypeError, ValueError):
+        statusinterval = 600.
+    if statusinterval > 0:
+        statusThr = threading.Thread(target=statusThread, args=(statusinterval,))
+        statusThr.daemon = True
+        statusThr.start()
 
     if debug:
         log.msg("Option u: debug mode switched on ...")
@@ -1088,11 +1119,30 @@ def main(argv):
         log.msg("Destination: {} {}".format(destination, location))
 
     if source == 'mqtt':
+        # message processing is done by worker threads - the paho network loop only enqueues
+        global pipeline
+        pipeline = MessagePipeline(process_message, report=log.msg)
+        pipeline.configure(conf)
+        if 'diff' in destination and pipeline.workers > 1:
+            # differences combine data of several sensors
+            log.msg("Pipeline: destination diff requires a single worker - ignoring collectorworkers")
+            pipeline.workers = 1
+        pipeline.start()
+        log.msg("Pipeline: {} worker(s), queue size {}, overflow policy {}".format(pipeline.workers, pipeline.maxsize, pipeline.overflow))
         mqttversion = int(conf.get("mqttversion", 2))
         mqttcert = conf.get("mqttcert", "")
         mqttpsk = conf.get("mqttpsk", "")
+        # the client is also used by worker threads for publishing differences
+        global client
         client = connectclient(broker, port, timeout, credentials, user, password, qos, mqttcert=mqttcert, mqttpsk=mqttpsk, mqttversion=mqttversion, destinationid=dbcred, debug=debug) # dbcred is used for clientid
-        client.loop_forever()
+        profiler.mark("mqtt client created")
+        # SIGTERM (e.g. systemctl stop) exits like SIGINT so that queued messages are processed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            client.loop_forever()
+        finally:
+            log.msg("Pipeline: processing queued messages before shutdown ({})".format(pipeline.summary()))
+            pipeline.stop()
 
     elif source == 'wamp':
         log.msg("Not yet supported! -> check autobahn import, crossbario")
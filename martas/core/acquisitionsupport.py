@@ -19,6 +19,7 @@ import socket # for hostname identification
 import string # for ascii selection
 from datetime import datetime, timedelta
 from twisted.python import log
+from martas.core.bufferwriter import get_pool
 
 SENSORELEMENTS =  ['sensorid','port','baudrate','bytesize','stopbits', 'parity','mode','init','rate','stack','protocol','name','serialnumber','revision','path','pierid','ptime','sensorgroup','sensordesc']
 
@@ -154,38 +155,8 @@ def timeToArray(timestring):
         return []
 
 def dataToFile(outputdir, sensorid, filedate, bindata, header):
-    # File Operations
-    try:
-        #hostname = socket.gethostname()
-        path = os.path.join(outputdir,sensorid)
-        # outputdir defined in main options class
-        if not os.path.exists(path):
-            os.makedirs(path)
-    except:
-        print ("buffer {}: bufferdirectory could not be created - check permissions".format(sensorid))
-    try:
-        savefile = os.path.join(path, sensorid+'_'+filedate+".bin")
-        if sys.version_info>(3,0,0):
-            if not os.path.isfile(savefile):
-                with open(savefile, "wb") as myfile:
-                    head = "{}{}".format(header,"\n")
-                    myfile.write(head.encode('utf-8'))
-                    myfile.write(bindata)
-                    myfile.write("\n".encode('utf-8'))
-            else:
-                with open(savefile, "ab") as myfile:
-                    myfile.write(bindata)
-                    myfile.write("\n".encode('utf-8'))
-        else:
-            if not os.path.isfile(savefile):
-                with open(savefile, "wb") as myfile:
-                    myfile.write(header + "\n")
-                    myfile.write("{}{}".format(bindata,"\n"))
-            else:
-                with open(savefile, "a") as myfile:
-                    myfile.write("{}{}".format(bindata,"\n"))
-    except:
-        print("buffer {}: Error while saving file".format(sensorid))
+    # File Operations - handles are kept open by the buffer writer pool
+    get_pool().write(outputdir, sensorid, filedate, bindata, header="{}{}".format(header, "\n"))
 
 
 def dataToCSV(outputdir, sensorid, filedate, asciidata, header):
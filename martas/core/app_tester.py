@@ -61,11 +61,86 @@ def create_teststream(startdate=datetime(2022, 11, 22)):
     teststream.header['DataComponents'] = 'XYZ'
     return teststream
 
+class FakeDataBank(object):
+    """
+    stands in for database.DataBank.read (both ends inclusive, additional sql condition)
+    """
+
+    def __init__(self, times, values):
+        self.times = np.asarray(times)
+        self.values = np.asarray(values)
+        self.reads = 0
+
+    def read(self, table, starttime=None, endtime=None, sql=None):
+        self.reads += 1
+        sel = np.ones(len(self.times), dtype=bool)
+        if starttime:
+            sel &= self.times >= starttime
+        if endtime:
+            sel &= self.times <= endtime
+        if sql:
+            sel &= self.times < datetime.fromisoformat(sql.split('"')[1])
+        array = [[] for el in DataStream().KEYLIST]
+        array[0] = self.times[sel]
+        array[1] = self.values[sel]
+        return DataStream(header={'DataID': table}, ndarray=np.asarray(array, dtype=object))
+
+
 class TestArchive(unittest.TestCase):
     """
     Test environment for all methods
     """
 
+    def test_get_chunkrows(self):
+        self.assertEqual(archive.get_chunkrows(''), 500000)
+        self.assertEqual(archive.get_chunkrows(1000), 1000)
+        self.assertEqual(archive.get_chunkrows(0), None)
+        self.assertTrue(archive.is_appendable('append', 'PYASCII'))
+        # PYCDF rewrites the whole file on every append, replace merges existing files
+        self.assertFalse(archive.is_appendable('overwrite', 'PYCDF'))
+        self.assertFalse(archive.is_appendable('replace', 'PYSTR'))
+
+    def test_day_spool(self):
+        # slices of a day written to a spool file are combined into one stream
+        start = datetime(2022, 11, 22)
+        times = [start + timedelta(seconds=i) for i in range(86401)]
+        db = FakeDataBank(times, np.arange(86401.))
+        spool = archive.DaySpool('/tmp/archive_spooltest')
+        for slicestart, sliceend, stream in archive.read_chunks(db, 'Test_0001_0001', start, start + timedelta(days=1), chunkrows=10000):
+            spool.add(stream)
+        self.assertTrue(spool.chunks > 8)
+        self.assertEqual(spool.rows, 86401)
+        day = spool.finish()
+        self.assertTrue(spool.file.closed)
+        self.assertEqual(day.length()[0], 86401)
+        self.assertEqual(list(day.ndarray[1]), list(np.arange(86401.)))
+        self.assertEqual(day.header.get('DataID'), 'Test_0001_0001')
+        # columns missing in some chunks are filled
+        first = create_teststream()
+        second = create_teststream(startdate=datetime(2022, 11, 23))
+        second.ndarray[7] = np.asarray([])
+        joined = archive.join_chunks([first, second])
+        self.assertEqual(joined.length()[0], 2880)
+        self.assertEqual(len(joined.ndarray[7]), 2880)
+        self.assertTrue(np.isnan(joined.ndarray[7][-1]))
+        shutil.rmtree('/tmp/archive_spooltest')
+
+    def test_read_chunks(self):
+        # one day of 1 Hz data read in slices of about 10000 rows
+        start = datetime(2022, 11, 22)
+        times = [start + timedelta(seconds=i) for i in range(86401)]
+        db = FakeDataBank(times, np.arange(86401.))
+        rows = []
+        for slicestart, sliceend, stream in archive.read_chunks(db, 'Test_0001_0001', start, start + timedelta(days=1), chunkrows=10000):
+            self.assertTrue(stream.length()[0] <= 10001)
+            rows.extend(stream.ndarray[1])
+        # every row once, including both ends of the day
+        self.assertEqual(rows, list(np.arange(86401.)))
+        self.assertTrue(db.reads > 8)
+        slices = list(archive.read_chunks(db, 'Test_0001_0001', start, start + timedelta(days=1), chunkrows=None))
+        self.assertEqual(len(slices), 1)
+        self.assertEqual(slices[0][2].length()[0], 86401)
+
     def test_create_datelist(self):
         dl = archive.create_datelist(startdate='', depth=10, debug=True)
         self.assertEqual(len(dl), 10)
@@ -288,6 +363,38 @@ class TestFilter(unittest.TestCase):
         statusmsg = filter.apply_filter(db, statusmsg={}, groupdict=groupparameterdict, permanent=permanent, blacklist=blacklist, jobtype='realtime', endtime=datetime.now(), dayrange=2, dbinputsensors=sensorlist, basepath=basepath, destination=destination, outputformat=outputformat, recentthreshold=recentthreshold, debug=True)
         statusmsg = filter.apply_filter(db, statusmsg={}, groupdict=groupparameterdict, permanent=permanent, blacklist=blacklist, jobtype='archive', endtime=datetime.now(), dayrange=2, dbinputsensors=sensorlist, basepath=basepath, destination=destination, outputformat=outputformat, recentthreshold=recentthreshold, debug=True)
 
+    def test_filter_state(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'filterstate.json')
+            self.assertEqual(filter.read_filter_state(path), {})
+            filter.write_filter_state(path, {'LEMI036_1_0002_0001': {'lastoutput': '2022-11-22T00:40:00'}})
+            state = filter.read_filter_state(path)
+            self.assertEqual(state.get('LEMI036_1_0002_0001').get('lastoutput'), '2022-11-22T00:40:00')
+
+    def test_incremental_filter(self):
+        # one hour of synthetic 10 Hz data filtered in a single batch run and incrementally
+        startdate = datetime(2022, 11, 22)
+        n = 36000
+        array = [[] for el in DataStream().KEYLIST]
+        array[0] = np.asarray([startdate + timedelta(milliseconds=100*i) for i in range(n)])
+        array[1] = 20000. + 10.*np.sin(np.arange(n)/600.) + np.cos(np.arange(n)/7.)
+        stream = DataStream(header={'SensorID': 'Test_0001_0001'}, ndarray=np.asarray(array, dtype=object))
+        filtertype, filterwidth, resample_period, noresample = filter.filter_parameters({'filtertype': 'gaussian', 'filterwidth': 3.33333333, 'resample_period': 1})
+        self.assertEqual(resample_period, 1)
+        batch = stream.filter(filter_type=filtertype, filter_width=filterwidth, missingdata='conservative', resample_period=resample_period, noresample=noresample)
+        lastoutput = startdate + timedelta(minutes=40)
+        raw = stream.trim(starttime=filter.incremental_start(lastoutput, filterwidth, resample_period))
+        inc = filter.incremental_filter(raw, lastoutput, filtertype=filtertype, filterwidth=filterwidth, resample_period=resample_period, noresample=noresample)
+        self.assertTrue(len(inc) > 1000)
+        btimes = np.asarray(batch.ndarray[0], dtype='datetime64[us]')
+        itimes = np.asarray(inc.ndarray[0], dtype='datetime64[us]')
+        self.assertTrue(itimes[0] > np.datetime64(lastoutput, 'us'))
+        common, bidx, iidx = np.intersect1d(btimes, itimes, return_indices=True)
+        # every incremental sample is part of the batch output and has the same value
+        self.assertEqual(len(common), len(itimes))
+        np.testing.assert_allclose(inc.ndarray[1][iidx].astype(float), batch.ndarray[1][bidx].astype(float), rtol=0, atol=1e-6)
+
 class TestThreshold(unittest.TestCase):
 
     def test_assign_parameterlist(self):
@@ -307,6 +414,41 @@ class TestThreshold(unittest.TestCase):
         (evaluate, msg) = threshold.check_threshold(testvalue, 20000, "above", debug=True)
         self.assertTrue(evaluate)
 
+    def test_get_window_value(self):
+        # windows of the cache need to give the same results as get_test_value on trimmed streams
+        data = create_teststream()
+        x = 20000. + 50.*np.sin(np.arange(1440)/30.) + np.arange(1440)/10.
+        x[::60] = np.nan
+        data.ndarray[1] = x
+        times = np.asarray(data.ndarray[0]).astype('datetime64[us]')
+        enddate = datetime(2022, 11, 22, 23, 0)
+        para = {'1': {'sensorid': 'Test_0002_0001', 'timerange': 36000}, '2': {'sensorid': 'Test_0002_0001', 'timerange': 3600}}
+        cache = threshold.DataWindowCache({'source': 'file', 'bufferpath': '/tmp', 'startdate': enddate}, para)
+        self.assertEqual(cache.amounts.get('Test_0002_0001'), 36000)
+        # avoid reading: the largest window is already cached
+        cache.windows['Test_0002_0001'] = ({'data': data, 'times': times}, '')
+        for timerange in [36000, 3600, 600]:
+            (window, msg) = cache.get('Test_0002_0001', timerange)
+            trimmed = data.copy().trim(starttime=enddate-timedelta(seconds=timerange), endtime=enddate, include=True)
+            for function in ['average', 'median', 'max', 'min', 'stddev']:
+                (expected, msg1) = threshold.get_test_value(trimmed, key='x', function=function)
+                (testvalue, msg2) = threshold.get_window_value(window, key='x', function=function)
+                if np.isnan(expected):
+                    # too many NaNs in the window
+                    self.assertTrue(np.isnan(testvalue), msg="{} of {} sec".format(function, timerange))
+                else:
+                    self.assertAlmostEqual(testvalue, expected, places=6, msg="{} of {} sec".format(function, timerange))
+        (testvalue, msg) = threshold.get_window_value(window, key='x', function='unknown')
+        self.assertEqual(msg, 'selected test function not available')
+        # only NaNs (t2) or no data in the time range
+        (testvalue, msg) = threshold.get_window_value(window, key='t2', function='average')
+        self.assertIsNone(testvalue)
+        window['starttime'] = np.datetime64('2023-01-01T00:00:00', 'us')
+        window['endtime'] = np.datetime64('2023-01-02T00:00:00', 'us')
+        (testvalue, msg) = threshold.get_window_value(window, key='x', function='max')
+        self.assertIsNone(testvalue)
+        self.assertEqual(msg, 'no data in selected time range')
+
 
     def test_interprete_status(self):
         conf = mameth.get_conf(os.path.join('..', 'conf', 'threshold.cfg'))
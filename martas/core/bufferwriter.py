@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Persistent writer pool for MARTAS/MARCOS buffer files.
+
+    Every record used to open, append and close the daily buffer file of a
+    sensor. The writer pool keeps one open, buffered handle per sensor and
+    day instead. Files are rolled when the file date of incoming records changes
+    (i.e. at midnight), buffered data is flushed on a time interval or after a byte
+    budget, and the fsync policy can be selected.
+
+    The pool is used by methods.data_to_file and therefore by the collector
+    'file' destination and all protocol libraries.
+
+    Configuration (martas.cfg or marcos.cfg, all optional):
+        bufferflushinterval  :  2        # seconds between flushes
+        bufferflushbytes     :  32768    # flush once this amount of bytes is pending
+        bufferfsync          :  none     # none, flush (fsync on every flush) or close
+        buffermaxidle        :  3600     # close handles without writes for this amount of seconds
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+| BufferWriterPool |  __init__  |  2.0.2 |      yes |                                  | -      |          |
+| BufferWriterPool |  configure |  2.0.2 |      yes |                                  | -      | acquisition, collector |
+| BufferWriterPool |  write     |  2.0.2 |      yes |                                  | -      | data_to_file |
+| BufferWriterPool |  flush_due |  2.0.2 |      yes |  called by flusher thread        | -      |          |
+| BufferWriterPool |  flush     |  2.0.2 |      yes |                                  | -      |          |
+| BufferWriterPool |  close     |  2.0.2 |      yes |                                  | -      |          |
+|                 |  get_pool  |  2.0.2   |      yes |                                  | -      | methods  |
+
+"""
+
+import os
+import time
+import atexit
+import threading
+import unittest
+
+FSYNC_POLICIES = ['none', 'flush', 'close']
+
+
+class _BufferFile(object):
+    """
+    DESCRIPTION
+        open handle of a single daily buffer file
+    """
+    __slots__ = ('path', 'filedate', 'handle', 'pending', 'lastflush', 'lastwrite')
+
+    def __init__(self, path, filedate, handle):
+        self.path = path
+        self.filedate = filedate
+        self.handle = handle
+        self.pending = 0
+        self.lastflush = time.time()
+        self.lastwrite = self.lastflush
+
+
+class BufferWriterPool(object):
+    """
+    DESCRIPTION
+        Keeps one open, buffered file handle per sensor and file date.
+        Thread safe - active protocols are running in their own threads.
+    VARIABLES
+        flushinterval  (float) seconds after which pending data is flushed
+        flushbytes     (int) amount of pending bytes triggering a flush
+        fsync          (string) 'none': leave syncing to the OS,
+                                'flush': fsync after every flush,
+                                'close': fsync when closing/rolling a file
+        maxidle        (float) handles without writes for maxidle seconds are closed
+    """
+
+    def __init__(self, flushinterval=2.0, flushbytes=32768, fsync='none', maxidle=3600.0):
+        self.flushinterval = 2.0
+        self.flushbytes = 32768
+        self.fsync = 'none'
+        self.maxidle = 3600.0
+        self.files = {}
+        self.verifieddirs = set()
+        self.lock = threading.RLock()
+        self.flusher = None
+        self.running = False
+        self.configure(flushinterval=flushinterval, flushbytes=flushbytes, fsync=fsync, maxidle=maxidle)
+
+    def configure(self, conf=None, flushinterval=None, flushbytes=None, fsync=None, maxidle=None):
+        """
+        DESCRIPTION
+            update flush parameters either directly or from a martas/marcos configuration dictionary
+        """
+        if conf:
+            flushinterval = conf.get('bufferflushinterval', flushinterval)
+            flushbytes = conf.get('bufferflushbytes', flushbytes)
+            fsync = conf.get('bufferfsync', fsync)
+            maxidle = conf.get('buffermaxidle', maxidle)
+        try:
+            if flushinterval not in [None, '', '-']:
+                self.flushinterval = max(0.0, float(flushinterval))
+            if flushbytes not in [None, '', '-']:
+                self.flushbytes = max(0, int(flushbytes))
+            if maxidle not in [None, '', '-']:
+                self.maxidle = max(0.0, float(maxidle))
+        except (TypeError, ValueError):
+            print("bufferwriter: invalid flush parameters - keeping {} sec and {} bytes".format(self.flushinterval, self.flushbytes))
+        if fsync not in [None, '', '-']:
+            fsync = str(fsync).strip().lower()
+            if fsync in FSYNC_POLICIES:
+                self.fsync = fsync
+            else:
+                print("bufferwriter: unknown fsync policy {} - use one of {}".format(fsync, FSYNC_POLICIES))
+
+    def _open(self, outputdir, sensorid, filedate, header):
+        path = os.path.join(outputdir, sensorid)
+        if path not in self.verifieddirs:
+            try:
+                if not os.path.exists(path):
+                    os.makedirs(path)
+                self.verifieddirs.add(path)
+            except:
+                print("buffer {}: bufferdirectory could not be created - check permissions".format(sensorid))
+        savefile = os.path.join(path, "{}_{}.bin".format(sensorid, filedate))
+        # append mode positions the handle at the end of the file - an empty file needs a header
+        handle = open(savefile, "ab", buffering=max(self.flushbytes, 1024) + 1)
+        bf = _BufferFile(savefile, filedate, handle)
+        if handle.tell() == 0 and header:
+            if not isinstance(header, bytes):
+                header = header.encode('utf-8')
+            handle.write(header)
+            bf.pending += len(header)
+        return bf
+
+    def _flush(self, bf):
+        bf.handle.flush()
+        if self.fsync == 'flush':
+            os.fsync(bf.handle.fileno())
+        bf.pending = 0
+        bf.lastflush = time.time()
+
+    def _close(self, bf):
+        try:
+            bf.handle.flush()
+            if self.fsync in ['flush', 'close']:
+                os.fsync(bf.handle.fileno())
+        finally:
+            bf.handle.close()
+
+    def _start_flusher(self):
+        if self.running or self.flushinterval <= 0:
+            return
+        self.running = True
+        self.flusher = threading.Thread(target=self._flush_loop, name="BufferWriterFlush")
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def _flush_loop(self):
+        while self.running:
+            time.sleep(max(self.flushinterval, 0.1))
+            try:
+                self.flush_due()
+            except Exception as e:
+                print("bufferwriter: flush failed - {}".format(e))
+
+    def write(self, outputdir, sensorid, filedate, bindata, header=None, eol=b"\n"):
+        """
+        DESCRIPTION
+            append bindata (followed by eol) to the buffer file
+            outputdir/sensorid/sensorid_filedate.bin
+            header is written verbatim if the file is new
+        RETURNS
+            True if data has been handed over to the file handle
+        """
+        key = (outputdir, sensorid)
+        with self.lock:
+            try:
+                bf = self.files.get(key)
+                if bf and not bf.filedate == filedate:
+                    # new day: roll the file
+                    del self.files[key]
+                    self._close(bf)
+                    bf = None
+                if not bf:
+                    bf = self._open(outputdir, sensorid, filedate, header)
+                    self.files[key] = bf
+                    self._start_flusher()
+                bf.handle.write(bindata)
+                if eol:
+                    bf.handle.write(eol)
+                bf.pending += len(bindata) + len(eol)
+                bf.lastwrite = time.time()
+                if bf.pending >= self.flushbytes or bf.lastwrite - bf.lastflush >= self.flushinterval:
+                    self._flush(bf)
+            except:
+                print("buffer {}: Error while saving file".format(sensorid))
+                self._discard(key)
+                return False
+        return True
+
+    def _discard(self, key):
+        bf = self.files.pop(key, None)
+        if bf:
+            try:
+                bf.handle.close()
+            except:
+                pass
+
+    def flush_due(self):
+        """
+        DESCRIPTION
+            flush all handles whose flush interval has passed and close idle handles
+        """
+        now = time.time()
+        with self.lock:
+            for key in list(self.files.keys()):
+                bf = self.files.get(key)
+                try:
+                    if bf.pending > 0 and now - bf.lastflush >= self.flushinterval:
+                        self._flush(bf)
+                    if self.maxidle > 0 and now - bf.lastwrite >= self.maxidle:
+                        del self.files[key]
+                        self._close(bf)
+                except:
+                    print("buffer {}: Error while flushing file".format(key[1]))
+                    self._discard(key)
+
+    def flush(self):
+        """
+        DESCRIPTION
+            flush all open handles
+        """
+        with self.lock:
+            for key in list(self.files.keys()):
+                try:
+                    self._flush(self.files.get(key))
+                except:
+                    print("buffer {}: Error while flushing file".format(key[1]))
+                    self._discard(key)
+
+    def close(self):
+        """
+        DESCRIPTION
+            flush and close all open handles
+        """
+        with self.lock:
+            self.running = False
+            for key in list(self.files.keys()):
+                bf = self.files.pop(key)
+                try:
+                    self._close(bf)
+                except:
+                    print("buffer {}: Error while closing file".format(key[1]))
+
+    def openfiles(self):
+        """
+        DESCRIPTION
+            returns a dictionary with currently opened files and their pending bytes
+        """
+        with self.lock:
+            return {bf.path: bf.pending for bf in self.files.values()}
+
+
+_pool = None
+
+
+def get_pool():
+    """
+    DESCRIPTION
+        returns the process wide buffer writer pool
+    """
+    global _pool
+    if _pool is None:
+        _pool = BufferWriterPool()
+        atexit.register(_pool.close)
+    return _pool
+
+
+class TestBufferWriterPool(unittest.TestCase):
+    """
+    Test environment for the buffer writer pool
+    """
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.pool = BufferWriterPool(flushinterval=0, flushbytes=1000000)
+
+    def tearDown(self):
+        import shutil
+        self.pool.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_write(self):
+        self.pool.write(self.tmpdir, "TEST_1234_0001", "2025-05-14", b"abc", header="# MagPyBin TEST\n")
+        self.pool.write(self.tmpdir, "TEST_1234_0001", "2025-05-14", b"def", header="# MagPyBin TEST\n")
+        self.pool.flush()
+        with open(os.path.join(self.tmpdir, "TEST_1234_0001", "TEST_1234_0001_2025-05-14.bin"), "rb") as f:
+            cont = f.read()
+        self.assertEqual(cont, b"# MagPyBin TEST\nabc\ndef\n")
+
+    def test_roll(self):
+        self.pool.write(self.tmpdir, "TEST_1234_0001", "2025-05-14", b"abc", header="head\n")
+        self.pool.write(self.tmpdir, "TEST_1234_0001", "2025-05-15", b"def", header="head\n", eol=b"")
+        self.assertEqual(len(self.pool.openfiles()), 1)
+        self.pool.close()
+        with open(os.path.join(self.tmpdir, "TEST_1234_0001", "TEST_1234_0001_2025-05-14.bin"), "rb") as f:
+            self.assertEqual(f.read(), b"head\nabc\n")
+        with open(os.path.join(self.tmpdir, "TEST_1234_0001", "TEST_1234_0001_2025-05-15.bin"), "rb") as f:
+            self.assertEqual(f.read(), b"head\ndef")
+
+    def test_append_existing(self):
+        self.pool.write(self.tmpdir, "TEST_1234_0001", "2025-05-14", b"abc", header="head\n")
+        self.pool.close()
+        pool = BufferWriterPool(flushinterval=0)
+        pool.write(self.tmpdir, "TEST_1234_0001", "2025-05-14", b"def", header="head\n")
+        pool.close()
+        with open(os.path.join(self.tmpdir, "TEST_1234_0001", "TEST_1234_0001_2025-05-14.bin"), "rb") as f:
+            self.assertEqual(f.read(), b"head\nabc\ndef\n")
+
+    def test_configure(self):
+        self.pool.configure({'bufferflushinterval': '5', 'bufferfsync': 'close', 'bufferflushbytes': 4096})
+        self.assertEqual(self.pool.flushinterval, 5.0)
+        self.assertEqual(self.pool.flushbytes, 4096)
+        self.assertEqual(self.pool.fsync, 'close')
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,963 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Support methods for the MQTT collector of MARCOS.
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+|  PayloadBlock   |  __init__  |  2.0.2 |      yes |                                  | -      |          |
+|  PayloadBlock   |  datetimes |  2.0.2 |      yes |  cached datetime objects         | -      | collector |
+|  PayloadBlock   |  msec      |  2.0.2 |      yes |  milliseconds since 1970         | -      | collector |
+|  PayloadBlock   |  to_ndarray |  2.0.2 |     yes |  MagPy ndarray, cached           | -      | collector |
+|  PayloadBlock   |  rows      |  2.0.2 |      yes |  value strings per sample        | -      | collector |
+|                 |  decode_payload |  2.0.2 | yes |  vectorized payload decoder      | -      | collector |
+|                 |  key_map   |  2.0.2 |      yes |  payload column map per sensor   | -      |          |
+|                 |  array_to_datetime64 | 2.0.2 | yes |                             | -      |          |
+|  StructCodec    |  __init__  |  2.0.2 |      yes |                                  | -      |          |
+|  StructCodec    |  pack      |  2.0.2 |      yes |                                  | -      |          |
+|  StructCodec    |  pack_many |  2.0.2 |      yes |  contiguous buffer of records    | -      |          |
+|  StructCodec    |  pack_payload |  2.0.2 |   yes |  records grouped by file date    | -      | collector |
+|                 |  get_codec |  2.0.2   |      yes |  cached StructCodec              | -      | collector |
+|  SensorRegistry |  get       |  2.0.2   |      yes |  one lookup per message          | -      | collector |
+|  SensorRegistry |  record    |  2.0.2   |      yes |  get or create record            | -      | collector |
+|  SensorRegistry |  set_meta  |  2.0.2   |      yes |  header line information         | -      | collector |
+|  SensorRegistry |  update_identifiers | 2.0.2 | yes |  'sensorid:attribute' dicts      | -      | collector |
+|  SensorRegistry |  snapshot  |  2.0.2   |      yes |  plain copy for monitoring       | -      | collector |
+|  RingBuffer     |  append    |  2.0.2   |      yes |  fixed size sample buffer        | -      |          |
+|  RingBuffer     |  nearest   |  2.0.2   |      yes |  sample within time tolerance    | -      |          |
+|  DiffEngine     |  configure |  2.0.2   |      yes |                                  | -      | collector |
+|  DiffEngine     |  add       |  2.0.2   |      yes |  incremental differences         | -      | collector |
+|                 |  decimate  |  2.0.2   |      yes |  min/max envelope or mean        | -      |          |
+|                 |  pack_binary_frame | 2.0.2 | yes |  int64 ms + float32 values       | -      |          |
+| WebsocketBatcher | configure |  2.0.2   |      yes |                                  | -      | collector |
+| WebsocketBatcher | add       |  2.0.2   |      yes |  collect samples of a sensor     | -      | collector |
+| WebsocketBatcher | set_client |  2.0.2  |      yes |  client specific settings (json) | -      | collector |
+| WebsocketBatcher | flush     |  2.0.2   |      yes |  frames per client setting       | -      | collector |
+
+"""
+
+import re
+import json
+import time
+import struct
+import threading
+import unittest
+import numpy as np
+from magpy.stream import KEYLIST, NUMKEYLIST
+
+KEYINDEX = {key: idx for idx, key in enumerate(KEYLIST)}
+NUMKEYS = frozenset(NUMKEYLIST)
+
+TIMELIMITS = [(1, 12), (1, 31), (0, 23), (0, 59), (0, 60), (0, 999999)]
+
+
+def array_to_datetime64(tar):
+    """
+    DESCRIPTION
+        converts a (n,7) integer array of year, month, day, hour, minute, second, microsecond
+        into a datetime64[us] column
+    """
+    tar = np.asarray(tar, dtype=np.int64)
+    for i, (low, high) in enumerate(TIMELIMITS):
+        col = tar[:, i + 1]
+        if col.size and (col.min() < low or col.max() > high):
+            raise ValueError("time element {} out of range".format(i + 1))
+    years = (tar[:, 0] - 1970).astype('datetime64[Y]')
+    months = years.astype('datetime64[M]') + (tar[:, 1] - 1).astype('timedelta64[M]')
+    days = months.astype('datetime64[D]') + (tar[:, 2] - 1).astype('timedelta64[D]')
+    if np.any(days.astype('datetime64[M]') != months):
+        raise ValueError("day is out of range for month")
+    usec = ((tar[:, 3] * 60 + tar[:, 4]) * 60 + tar[:, 5]) * 1000000 + tar[:, 6]
+    return days.astype('datetime64[us]') + usec.astype('timedelta64[us]')
+
+
+class PayloadBlock(object):
+    """
+    DESCRIPTION
+        decoded content of a MARTAS data payload (one or more ; separated lines)
+        times:    datetime64[us] column
+        keys:     data keys in KEYLIST order
+        columns:  list of columns aligned with keys (float64 for numerical keys, str otherwise)
+        numkeys:  numerical keys
+        numdata:  float64 matrix (samples x numkeys), multipliers already applied
+    """
+    __slots__ = ('times', 'keys', 'columns', 'keyindices', 'numkeys', 'numdata', '_datetimes', '_ndarray')
+
+    def __init__(self, times, keys, columns, keyindices=None):
+        if keyindices is None:
+            keyindices = [KEYINDEX[key] for key in keys]
+        order = sorted(range(len(keys)), key=keyindices.__getitem__)
+        self.times = times
+        self.keys = [keys[i] for i in order]
+        self.columns = [columns[i] for i in order]
+        self.keyindices = [keyindices[i] for i in order]
+        self.numkeys = [key for key in self.keys if key in NUMKEYS]
+        numcols = [col for key, col in zip(self.keys, self.columns) if key in NUMKEYS]
+        if numcols:
+            self.numdata = np.column_stack(numcols)
+        else:
+            self.numdata = np.empty((len(times), 0))
+        self._datetimes = None
+        self._ndarray = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def datetimes(self):
+        if self._datetimes is None:
+            self._datetimes = self.times.astype(object)
+        return self._datetimes
+
+    def msec(self):
+        return self.times.astype('datetime64[ms]').astype(np.int64)
+
+    def rows(self):
+        """
+        DESCRIPTION
+            returns a list with comma separated value strings for each sample
+        """
+        if not self.columns:
+            return [''] * len(self.times)
+        return [','.join(row) for row in zip(*[map(str, col.tolist()) for col in self.columns])]
+
+    def to_ndarray(self):
+        """
+        DESCRIPTION
+            MagPy DataStream ndarray (object array with KEYLIST layout)
+        """
+        if self._ndarray is None:
+            array = [np.asarray([]) for elem in KEYLIST]
+            array[0] = np.asarray(self.datetimes())
+            for idx, col in zip(self.keyindices, self.columns):
+                array[idx] = col
+            self._ndarray = np.asarray(array, dtype=object)
+        return self._ndarray
+
+
+def key_map(keylist, multilist):
+    """
+    DESCRIPTION
+        payload column map of a sensor - computed once by SensorRegistry.set_meta
+    RETURNS
+        list of (column index, key, divisor, KEYLIST index) for all usable keys of keylist
+        (the first occurrence of duplicate keys, time keys and numerical keys without
+        multiplier are skipped)
+    """
+    keymap = []
+    seen = set()
+    for idx, key in enumerate(keylist):
+        if key.endswith('time') or key not in KEYINDEX or key in seen:
+            continue
+        divisor = 1.0
+        if key in NUMKEYS:
+            if idx >= len(multilist):
+                continue
+            divisor = float(multilist[idx])
+        seen.add(key)
+        keymap.append((idx + 7, key, divisor, KEYINDEX[key]))
+    return keymap
+
+
+def decode_payload(payload, keylist, multilist, keymap=None):
+    """
+    DESCRIPTION
+        decodes a MARTAS data payload in one pass.
+        Lines are separated by ';', elements by ','. The first seven elements contain
+        the time, all following elements correspond to keylist and are divided by multilist.
+        keymap (see key_map, SensorRecord.keymap) avoids rebuilding the column map for
+        every payload.
+    RETURNS
+        a PayloadBlock
+    """
+    if keymap is None:
+        keymap = key_map(keylist, multilist)
+    lines = [line for line in payload.split(';') if line.strip()]
+    nlines = len(lines)
+    if nlines == 0:
+        return PayloadBlock(np.asarray([], dtype='datetime64[us]'), [], [])
+    ncol = lines[0].count(',') + 1
+    fields = ','.join(lines).split(',')
+    if not len(fields) == nlines * ncol:
+        return _decode_lines(lines, keymap)
+    used = [el for el in keymap if el[0] < ncol]
+    try:
+        # fast path - all elements numerical
+        mat = np.array(fields, dtype=np.float64).reshape(nlines, ncol)
+        strmat = None
+    except ValueError:
+        mat = None
+        strmat = np.array(fields).reshape(nlines, ncol)
+    if mat is not None:
+        times = array_to_datetime64(mat[:, :7])
+        sel = [el for el in used if el[1] in NUMKEYS]
+        colidx = [el[0] for el in sel]
+        divisors = np.asarray([el[2] for el in sel], dtype=np.float64)
+        values = mat[:, colidx] / divisors
+        keys = [el[1] for el in sel]
+        keyindices = [el[3] for el in sel]
+        columns = [values[:, i] for i in range(len(keys))]
+        # string keys containing numbers
+        strsel = [el for el in used if el[1] not in NUMKEYS]
+        if strsel:
+            strmat = np.array(fields).reshape(nlines, ncol)
+            for colidx, key, divisor, keyindex in strsel:
+                keys.append(key)
+                keyindices.append(keyindex)
+                columns.append(strmat[:, colidx])
+    else:
+        times = array_to_datetime64(strmat[:, :7].astype(np.int64))
+        keys = []
+        keyindices = []
+        columns = []
+        for colidx, key, divisor, keyindex in used:
+            if key in NUMKEYS:
+                columns.append(strmat[:, colidx].astype(np.float64) / divisor)
+            else:
+                columns.append(strmat[:, colidx])
+            keys.append(key)
+            keyindices.append(keyindex)
+    return PayloadBlock(times, keys, columns, keyindices)
+
+
+def _decode_lines(lines, keymap):
+    """
+    line by line decoding for payloads with varying amount of elements per line
+    - elements which are not available in all lines are skipped
+    """
+    rows = [line.split(',') for line in lines]
+    ncol = min(len(row) for row in rows)
+    times = array_to_datetime64([list(map(int, row[:7])) for row in rows])
+    keys = []
+    keyindices = []
+    columns = []
+    for colidx, key, divisor, keyindex in keymap:
+        if colidx >= ncol:
+            continue
+        if key in NUMKEYS:
+            columns.append(np.asarray([float(row[colidx]) for row in rows]) / divisor)
+        else:
+            columns.append(np.asarray([row[colidx] for row in rows]))
+        keys.append(key)
+        keyindices.append(keyindex)
+    return PayloadBlock(times, keys, columns, keyindices)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+def _field_converters(packcode):
+    """
+    DESCRIPTION
+        returns a list of converter functions, one for each field of the packcode
+    """
+    converters = []
+    for count, code in re.findall(r'(\d*)([a-zA-Z?])', packcode):
+        count = int(count) if count else 1
+        if code == 'x':
+            continue
+        elif code in ['s', 'p']:
+            # a count defines the string length of a single field
+            converters.append(_to_bytes)
+        elif code == 'c':
+            converters.extend([_to_bytes] * count)
+        elif code in ['f', 'd', 'e']:
+            converters.extend([float] * count)
+        else:
+            converters.extend([_to_int] * count)
+    return converters
+
+
+class StructCodec(object):
+    """
+    DESCRIPTION
+        precompiled binary codec for a MagPyBin packcode (e.g. 6hLffflll)
+        used to create buffer file records from data payloads
+    """
+    __slots__ = ('packcode', 'struct', 'size', 'converters', 'nfields')
+
+    def __init__(self, packcode):
+        if isinstance(packcode, bytes):
+            packcode = packcode.decode('ascii')
+        self.packcode = packcode.lstrip('<')
+        self.struct = struct.Struct('<' + self.packcode)
+        self.size = self.struct.size
+        self.converters = _field_converters(self.packcode)
+        self.nfields = len(self.converters)
+
+    def convert(self, elements):
+        if not len(elements) == self.nfields:
+            raise struct.error("expected {} elements for packcode {}, got {}".format(self.nfields, self.packcode, len(elements)))
+        return [conv(el) for conv, el in zip(self.converters, elements)]
+
+    def pack(self, elements):
+        return self.struct.pack(*self.convert(elements))
+
+    def pack_many(self, lines, sep=b"\n"):
+        """
+        DESCRIPTION
+            packs a list of comma separated data lines into one contiguous buffer
+        """
+        pack = self.struct.pack
+        convert = self.convert
+        return sep.join([pack(*convert(line.split(','))) for line in lines])
+
+    def pack_payload(self, payload, sep=b"\n"):
+        """
+        DESCRIPTION
+            packs a ; separated data payload
+        RETURNS
+            a list of (filedate, buffer) tuples - records are grouped by the date
+            of their first three elements so that payloads covering midnight are split
+        """
+        pack = self.struct.pack
+        groups = []
+        filedate = None
+        records = []
+        for line in payload.split(';'):
+            if not line.strip():
+                continue
+            values = self.convert(line.split(','))
+            linedate = "{}-{:02d}-{:02d}".format(values[0], values[1], values[2])
+            if not linedate == filedate:
+                if records:
+                    groups.append((filedate, sep.join(records)))
+                filedate = linedate
+                records = []
+            records.append(pack(*values))
+        if records:
+            groups.append((filedate, sep.join(records)))
+        return groups
+
+
+_codecs = {}
+
+
+def get_codec(packcode):
+    """
+    DESCRIPTION
+        returns a cached StructCodec for the given packcode
+    """
+    codec = _codecs.get(packcode)
+    if codec is None:
+        codec = StructCodec(packcode)
+        _codecs[packcode] = codec
+    return codec
+
+
+class SensorRecord(object):
+    """
+    DESCRIPTION
+        state of a single sensor as obtained from meta, dict and data messages
+    """
+    __slots__ = ('sensorid', 'packingcode', 'keylist', 'elemlist', 'unitlist', 'multilist', 'keyindices',
+                 'keymap', 'codec', 'headerline', 'header', 'lastseen', 'messages', 'rows', 'errors')
+
+    def __init__(self, sensorid):
+        self.sensorid = sensorid
+        self.packingcode = ''
+        self.keylist = []
+        self.elemlist = []
+        self.unitlist = []
+        self.multilist = np.asarray([], dtype=np.float64)
+        self.keyindices = np.asarray([], dtype=np.int64)
+        self.keymap = []
+        self.codec = None
+        self.headerline = None
+        self.header = None
+        self.lastseen = 0.0
+        self.messages = 0
+        self.rows = 0
+        self.errors = 0
+
+    def touch(self, rows=0):
+        """
+        DESCRIPTION
+            update last-seen time and counters for an incoming message
+        """
+        self.lastseen = time.time()
+        self.messages += 1
+        self.rows += rows
+
+
+class SensorRegistry(object):
+    """
+    DESCRIPTION
+        Holds one SensorRecord per sensor id. Records are created under a lock,
+        attributes of a record are only changed by the worker handling the sensor.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.records = {}
+
+    def __contains__(self, sensorid):
+        return sensorid in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, sensorid):
+        """
+        DESCRIPTION
+            returns the record of sensorid or None
+        """
+        return self.records.get(sensorid)
+
+    def record(self, sensorid):
+        """
+        DESCRIPTION
+            returns the record of sensorid - creates a new one if not existing
+        """
+        rec = self.records.get(sensorid)
+        if rec is None:
+            with self.lock:
+                rec = self.records.get(sensorid)
+                if rec is None:
+                    rec = SensorRecord(sensorid)
+                    self.records[sensorid] = rec
+        return rec
+
+    def sensors(self):
+        with self.lock:
+            return list(self.records.keys())
+
+    def set_meta(self, sensorid, packingcode, keylist, elemlist, unitlist, multilist):
+        """
+        DESCRIPTION
+            store the information of a MagPyBin header line
+        """
+        rec = self.record(sensorid)
+        rec.keylist = list(keylist)
+        rec.elemlist = list(elemlist)
+        rec.unitlist = list(unitlist)
+        rec.multilist = np.asarray(multilist, dtype=np.float64)
+        # KEYLIST indices and payload column map are computed once per header, not per message
+        rec.keyindices = np.asarray([KEYINDEX.get(key, -1) for key in rec.keylist], dtype=np.int64)
+        rec.keymap = key_map(rec.keylist, rec.multilist)
+        # packingcode last - a record with packingcode is considered to be complete
+        rec.packingcode = packingcode
+        return rec
+
+    def update_identifiers(self, identdic):
+        """
+        DESCRIPTION
+            update records from a dictionary with 'sensorid:attribute' keys as
+            provided by additional libraries (e.g. lorawanserver)
+        """
+        meta = {}
+        for el in identdic:
+            if not el.find(':') > 0:
+                continue
+            sensorid, attribute = el.rsplit(':', 1)
+            meta.setdefault(sensorid, {})[attribute] = identdic[el]
+        for sensorid in meta:
+            cont = meta[sensorid]
+            rec = self.record(sensorid)
+            self.set_meta(sensorid, cont.get('packingcode', rec.packingcode), cont.get('keylist', rec.keylist),
+                          cont.get('elemlist', rec.elemlist), cont.get('unitlist', rec.unitlist),
+                          cont.get('multilist', rec.multilist))
+        return list(meta.keys())
+
+    def snapshot(self):
+        """
+        DESCRIPTION
+            returns a dictionary with plain python copies of all records, e.g. for monitoring
+        """
+        snap = {}
+        with self.lock:
+            records = list(self.records.values())
+        for rec in records:
+            packingcode = rec.packingcode
+            if isinstance(packingcode, bytes):
+                packingcode = packingcode.decode('ascii', 'ignore')
+            snap[rec.sensorid] = {'packingcode': packingcode, 'keylist': list(rec.keylist),
+                                  'elemlist': list(rec.elemlist), 'unitlist': list(rec.unitlist),
+                                  'multilist': rec.multilist.tolist(), 'header': dict(rec.header) if rec.header else {},
+                                  'lastseen': rec.lastseen, 'messages': rec.messages, 'rows': rec.rows,
+                                  'errors': rec.errors}
+        return snap
+
+
+class RingBuffer(object):
+    """
+    DESCRIPTION
+        fixed size buffer of the most recent samples of a sensor
+        times:   int64 microseconds since 1970
+        values:  float64 matrix (size x len(keys))
+    """
+    __slots__ = ('keys', 'size', 'times', 'values', 'pos', 'count')
+
+    def __init__(self, keys, size=5):
+        self.keys = list(keys)
+        self.size = max(1, int(size))
+        self.times = np.zeros(self.size, dtype=np.int64)
+        self.values = np.full((self.size, len(self.keys)), np.nan)
+        self.pos = 0
+        self.count = 0
+
+    def append(self, times, values):
+        """
+        DESCRIPTION
+            append samples (times as datetime64 or int64 microseconds)
+        """
+        times = np.asarray(times)
+        if np.issubdtype(times.dtype, np.datetime64):
+            times = times.astype('datetime64[us]').astype(np.int64)
+        n = len(times)
+        if n == 0:
+            return
+        if n > self.size:
+            times = times[-self.size:]
+            values = values[-self.size:]
+            n = self.size
+        idx = (self.pos + np.arange(n)) % self.size
+        self.times[idx] = times
+        self.values[idx] = values
+        self.pos = (self.pos + n) % self.size
+        self.count = min(self.count + n, self.size)
+
+    def newest(self):
+        """
+        RETURNS
+            time and values of the most recent sample
+        """
+        i = (self.pos - 1) % self.size
+        return self.times[i], self.values[i]
+
+    def nearest(self, t, tolerance):
+        """
+        RETURNS
+            values of the sample closest to t (microseconds) or None if not within tolerance
+        """
+        if self.count == 0:
+            return None
+        delta = np.abs(self.times[:self.count] - t)
+        i = int(delta.argmin())
+        if delta[i] > tolerance:
+            return None
+        return self.values[i]
+
+
+class _DiffPair(object):
+    __slots__ = ('prim', 'seco', 'name', 'keys', 'pidx', 'sidx', 'lasttime', 'emitted')
+
+    def __init__(self, prim, seco):
+        self.prim = prim
+        self.seco = seco
+        primname = (prim.split('_') + ['unknown'])[1]
+        seconame = (seco.split('_') + ['unknown'])[1]
+        self.name = "Diff_{}{}_0001".format(primname, seconame)
+        self.keys = None
+        self.pidx = None
+        self.sidx = None
+        self.lasttime = None
+        self.emitted = 0
+
+    def align(self, pbuf, sbuf):
+        """
+        determine common keys and their column indices in both buffers
+        """
+        self.keys = [key for key in pbuf.keys if key in sbuf.keys]
+        self.pidx = [pbuf.keys.index(key) for key in self.keys]
+        self.sidx = [sbuf.keys.index(key) for key in self.keys]
+
+
+class DiffResult(object):
+    """
+    DESCRIPTION
+        a single difference sample
+    """
+    __slots__ = ('name', 'prim', 'seco', 'keys', 'time', 'values', 'count')
+
+    def __init__(self, name, prim, seco, keys, time, values, count):
+        self.name = name
+        self.prim = prim
+        self.seco = seco
+        self.keys = keys
+        self.time = time
+        self.values = values
+        self.count = count
+
+
+class DiffEngine(object):
+    """
+    DESCRIPTION
+        Incremental differences of sensor pairs. The newest samples of each sensor are kept
+        in a RingBuffer. Whenever a sensor provides new data, its newest sample is matched to the
+        closest sample of the partner sensor (within tolerance) and the difference is returned.
+        Costs per message are independent of the amount of collected data.
+    VARIABLES
+        sensors    (string or list) name fragments of sensors to be used (e.g. G823)
+        pairs      (list) explicit pairs [(primary, secondary),...] - default: sorted neighbours
+        size       (int) amount of samples in each ring buffer
+        tolerance  (float) maximal time difference of matched samples in seconds
+    """
+
+    def __init__(self, sensors='G823', pairs=None, size=5, tolerance=0.5):
+        self.sensors = []
+        self.pairs = []
+        self.fixedpairs = False
+        self.size = size
+        self.tolerance = int(tolerance * 1000000)
+        self.buffers = {}
+        self.configure(sensors=sensors, pairs=pairs)
+
+    def configure(self, conf=None, sensors=None, pairs=None, size=None, tolerance=None):
+        """
+        DESCRIPTION
+            set parameters directly or from a marcos configuration dictionary
+            (differencesensors, differencepairs, differencebuffer, differencetolerance)
+        """
+        if conf:
+            sensors = conf.get('differencesensors', sensors)
+            pairs = conf.get('differencepairs', pairs)
+            size = conf.get('differencebuffer', size)
+            tolerance = conf.get('differencetolerance', tolerance)
+        if sensors not in [None, '', '-']:
+            if not isinstance(sensors, (list, tuple)):
+                sensors = str(sensors).split(',')
+            self.sensors = [el.strip() for el in sensors if el.strip()]
+        if pairs not in [None, '', '-']:
+            if not isinstance(pairs, (list, tuple)):
+                pairs = str(pairs).split(',')
+            pairlist = []
+            for pair in pairs:
+                if isinstance(pair, str):
+                    pair = pair.split('-')
+                if len(pair) == 2:
+                    pairlist.append(_DiffPair(pair[0].strip(), pair[1].strip()))
+            self.pairs = pairlist
+            self.fixedpairs = True
+        try:
+            if size not in [None, '', '-']:
+                self.size = max(1, int(size))
+            if tolerance not in [None, '', '-']:
+                self.tolerance = int(float(tolerance) * 1000000)
+        except (TypeError, ValueError):
+            pass
+
+    def selected(self, sensorid):
+        if self.fixedpairs:
+            return any(sensorid in [pair.prim, pair.seco] for pair in self.pairs)
+        return any(sensorid.find(el) >= 0 for el in self.sensors)
+
+    def _register(self, sensorid, keys):
+        self.buffers[sensorid] = RingBuffer(keys, size=self.size)
+        if not self.fixedpairs:
+            # neighbouring pairs of sorted sensor ids - only rebuilt when a new sensor appears
+            names = sorted(self.buffers.keys())
+            old = {(pair.prim, pair.seco): pair for pair in self.pairs}
+            self.pairs = [old.get((a, b), _DiffPair(a, b)) for a, b in zip(names[:-1], names[1:])]
+        for pair in self.pairs:
+            if sensorid in [pair.prim, pair.seco]:
+                pair.keys = None
+
+    def add(self, sensorid, block):
+        """
+        DESCRIPTION
+            add a decoded PayloadBlock of sensorid
+        RETURNS
+            list of DiffResults for all pairs containing sensorid
+        """
+        if not self.selected(sensorid) or len(block) == 0:
+            return []
+        buf = self.buffers.get(sensorid)
+        if buf is None or not buf.keys == block.numkeys:
+            self._register(sensorid, block.numkeys)
+            buf = self.buffers.get(sensorid)
+        buf.append(block.times, block.numdata)
+        t, row = buf.newest()
+        results = []
+        for pair in self.pairs:
+            if sensorid == pair.prim:
+                other = self.buffers.get(pair.seco)
+            elif sensorid == pair.seco:
+                other = self.buffers.get(pair.prim)
+            else:
+                continue
+            if other is None:
+                continue
+            match = other.nearest(t, self.tolerance)
+            if match is None or (pair.lasttime is not None and t <= pair.lasttime):
+                continue
+            if pair.keys is None:
+                pair.align(self.buffers[pair.prim], self.buffers[pair.seco])
+            if not pair.keys:
+                continue
+            if sensorid == pair.prim:
+                values = row[pair.pidx] - match[pair.sidx]
+            else:
+                values = match[pair.pidx] - row[pair.sidx]
+            pair.lasttime = t
+            pair.emitted += 1
+            results.append(DiffResult(pair.name, pair.prim, pair.seco, pair.keys,
+                                      np.datetime64(int(t), 'us'), values, pair.emitted))
+        return results
+
+
+def decimate(times, values, buckets, method='minmax'):
+    """
+    DESCRIPTION
+        reduces samples to the given amount of buckets (equal sample counts per bucket)
+        method minmax: two samples per bucket (first time with minima, last time with maxima)
+        method mean:   one sample per bucket (mean time and values)
+    VARIABLES
+        times    (int64 array) milliseconds
+        values   (float matrix) samples x columns
+    """
+    n = len(times)
+    buckets = int(buckets)
+    limit = 2 * buckets if method == 'minmax' else buckets
+    if buckets < 1 or n <= limit:
+        return times, values
+    starts = np.unique(np.linspace(0, n, buckets + 1).astype(np.int64)[:-1])
+    if method == 'mean':
+        counts = np.diff(np.append(starts, n))
+        t = np.add.reduceat(times, starts) // counts
+        v = np.add.reduceat(values, starts, axis=0) / counts[:, None]
+        return t, v
+    ends = np.append(starts[1:], n) - 1
+    t = np.column_stack((times[starts], times[ends])).ravel()
+    v = np.empty((2 * len(starts), values.shape[1]), dtype=values.dtype)
+    v[0::2] = np.minimum.reduceat(values, starts, axis=0)
+    v[1::2] = np.maximum.reduceat(values, starts, axis=0)
+    return t, v
+
+
+def pack_binary_frame(sensorid, times, values):
+    """
+    DESCRIPTION
+        compact binary websocket frame (little endian):
+        uint16 length of sensorid, sensorid (utf-8), zero padding to a multiple of 8 bytes,
+        uint32 samples, uint32 columns, int64 milliseconds[samples], float32 values[samples x columns]
+    """
+    name = sensorid.encode('utf-8')
+    head = struct.pack('<H', len(name)) + name
+    head += b'\x00' * (-len(head) % 8)
+    values = np.ascontiguousarray(values, dtype='<f4')
+    return b''.join([head, struct.pack('<II', values.shape[0], values.shape[1]),
+                     np.ascontiguousarray(times, dtype='<i8').tobytes(), values.tobytes()])
+
+
+class WebsocketBatcher(object):
+    """
+    DESCRIPTION
+        Collects the samples of all sensors and creates one websocket frame per sensor
+        and interval. Optionally the samples are decimated to a target rate (samples per second
+        and sensor) and sent as binary frames. Clients can select their own settings by sending
+        a json message like {"rate": 1, "decimation": "mean", "binary": true}.
+        Text frames contain one line "sensorid: msec,value1,value2" per sample.
+    VARIABLES
+        interval    (float) seconds between frames
+        rate        (float) maximal samples per second and sensor (0: all samples)
+        decimation  (string) minmax or mean
+        binary      (bool) use binary frames (see pack_binary_frame)
+    """
+
+    def __init__(self, interval=1.0, rate=0, decimation='minmax', binary=False):
+        self.interval = interval
+        self.defaults = (float(rate), decimation, bool(binary))
+        self.clients = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def configure(self, conf):
+        """
+        DESCRIPTION
+            read socketinterval, socketrate, socketdecimation and socketbinary from a marcos configuration
+        """
+        rate, decimation, binary = self.defaults
+        try:
+            if not conf.get('socketinterval', '') in ['', '-']:
+                self.interval = max(0.05, float(conf.get('socketinterval')))
+            if not conf.get('socketrate', '') in ['', '-']:
+                rate = max(0., float(conf.get('socketrate')))
+        except (TypeError, ValueError):
+            pass
+        if conf.get('socketdecimation', '') in ['minmax', 'mean']:
+            decimation = conf.get('socketdecimation')
+        if not conf.get('socketbinary', '') in ['', '-']:
+            binary = str(conf.get('socketbinary')).strip() in ['True', 'true', '1', 'yes']
+        self.defaults = (rate, decimation, binary)
+
+    def set_client(self, clientid, message):
+        """
+        DESCRIPTION
+            client specific settings from a json message - returns False if not understood
+        """
+        try:
+            request = json.loads(message)
+            rate, decimation, binary = self.clients.get(clientid, self.defaults)
+            rate = max(0., float(request.get('rate', rate)))
+            decimation = request.get('decimation', decimation)
+            if decimation not in ['minmax', 'mean']:
+                return False
+            binary = bool(request.get('binary', binary))
+        except (ValueError, TypeError, AttributeError):
+            return False
+        self.clients[clientid] = (rate, decimation, binary)
+        return True
+
+    def remove_client(self, clientid):
+        self.clients.pop(clientid, None)
+
+    def settings(self, clientid):
+        return self.clients.get(clientid, self.defaults)
+
+    def add(self, sensorid, block):
+        """
+        DESCRIPTION
+            add the numerical data of a PayloadBlock
+        """
+        if len(block) == 0 or not block.numkeys:
+            return
+        with self.lock:
+            entry = self.pending.get(sensorid)
+            if entry is None or not entry[0] == block.numkeys:
+                entry = (block.numkeys, [], [])
+                self.pending[sensorid] = entry
+            entry[1].append(block.msec())
+            entry[2].append(block.numdata)
+
+    def flush(self, settingslist=None):
+        """
+        DESCRIPTION
+            returns a dictionary {settings: [frames]} for the requested client settings
+            (default: the configured defaults) and clears the collected samples.
+            Frames are created once per setting and shared by all clients using it.
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        if settingslist is None:
+            settingslist = [self.defaults]
+        frames = {settings: [] for settings in settingslist}
+        for sensorid, (keys, timelist, valuelist) in pending.items():
+            times = np.concatenate(timelist)
+            values = np.concatenate(valuelist)
+            for settings in frames:
+                rate, decimation, binary = settings
+                t, v = times, values
+                if rate > 0:
+                    t, v = decimate(times, values, max(1, int(round(rate * self.interval))), decimation)
+                if binary:
+                    frames[settings].append(pack_binary_frame(sensorid, t, v))
+                else:
+                    lines = ["{}: {},{}".format(sensorid, ms, ",".join(map(str, row)))
+                             for ms, row in zip(t.tolist(), v.tolist())]
+                    frames[settings].append("\n".join(lines))
+        return frames
+
+
+class TestCollectorSupport(unittest.TestCase):
+    """
+    Test environment for collector support methods
+    """
+
+    def test_decode_payload(self):
+        payload = "2025,5,14,10,0,0,100000,12345,-2300,4500;2025,5,14,10,0,0,200000,12346,-2301,4502"
+        block = decode_payload(payload, ['x', 'y', 'z'], [1000, 1000, 1000])
+        self.assertEqual(len(block), 2)
+        self.assertEqual(block.keys, ['x', 'y', 'z'])
+        self.assertAlmostEqual(block.numdata[1, 0], 12.346)
+        self.assertEqual(block.datetimes()[1].microsecond, 200000)
+        self.assertEqual(block.msec()[0], 1747216800100)
+
+    def test_decode_payload_strings(self):
+        payload = "2025,5,14,10,0,0,0,215,ok;2025,5,14,10,0,1,0,216,ok"
+        block = decode_payload(payload, ['t1', 'str1'], [10, 1])
+        self.assertEqual(block.keys, ['t1', 'str1'])
+        self.assertEqual(block.columns[1][0], 'ok')
+        self.assertEqual(block.rows()[1], '21.6,ok')
+        ar = block.to_ndarray()
+        self.assertEqual(len(ar[KEYLIST.index('t1')]), 2)
+
+    def test_struct_codec(self):
+        codec = get_codec('6hLffflll')
+        self.assertEqual(codec.size, struct.calcsize('<6hLffflll'))
+        self.assertEqual(codec.nfields, 13)
+        groups = codec.pack_payload("2025,5,14,23,59,59,900000,1.5,2.5,3.5,4,5,6;2025,5,15,0,0,0,0,1.5,2.5,3.5,4.0,5,6")
+        self.assertEqual([el[0] for el in groups], ['2025-05-14', '2025-05-15'])
+        self.assertEqual(len(groups[0][1]), codec.size)
+        self.assertEqual(codec.struct.unpack(groups[1][1])[10], 4)
+        self.assertIs(get_codec('6hLffflll'), codec)
+
+    def test_sensor_registry(self):
+        registry = SensorRegistry()
+        rec = registry.set_meta('TEST_1234_0001', b'<6hLlllB', ['x', 'y', 'var1'], ['X', 'Y', 'V'], ['nT', 'nT', 'V'], [100, 100, 1])
+        self.assertIs(registry.get('TEST_1234_0001'), rec)
+        self.assertEqual(rec.keyindices.tolist(), [KEYLIST.index('x'), KEYLIST.index('y'), KEYLIST.index('var1')])
+        self.assertEqual([el[:2] for el in rec.keymap], [(7, 'x'), (8, 'y'), (9, 'var1')])
+        block = decode_payload("2025,5,14,10,0,0,0,100,200,3", rec.keylist, rec.multilist, rec.keymap)
+        self.assertEqual(block.to_ndarray()[KEYLIST.index('var1')].tolist(), [3.0])
+        registry.update_identifiers({'LORA_1_0001:packingcode': '<6hLlB', 'LORA_1_0001:keylist': ['t1'], 'LORA_1_0001:multilist': [10]})
+        self.assertEqual(registry.get('LORA_1_0001').multilist.tolist(), [10.0])
+        rec.touch(rows=3)
+        snap = registry.snapshot()
+        self.assertEqual(snap['TEST_1234_0001']['rows'], 3)
+        self.assertEqual(snap['TEST_1234_0001']['packingcode'], '<6hLlllB')
+
+    def test_ring_buffer(self):
+        buf = RingBuffer(['f'], size=3)
+        buf.append(np.arange(5, dtype=np.int64) * 1000000, np.arange(5, dtype=np.float64).reshape(5, 1))
+        self.assertEqual(buf.count, 3)
+        self.assertEqual(buf.newest()[1][0], 4.0)
+        self.assertEqual(buf.nearest(2100000, 200000)[0], 2.0)
+        self.assertIsNone(buf.nearest(1000000, 200000))
+
+    def test_diff_engine(self):
+        engine = DiffEngine(sensors='GSM90', tolerance=0.3)
+        a = decode_payload("2025,5,14,10,0,0,0,48000000;2025,5,14,10,0,1,0,48000100", ['f'], [1000])
+        b = decode_payload("2025,5,14,10,0,1,100000,47999000", ['f'], [1000])
+        self.assertEqual(engine.add('GSM90_1_0001', a), [])
+        res = engine.add('GSM90_2_0001', b)
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0].name, 'Diff_12_0001')
+        self.assertAlmostEqual(res[0].values[0], 1.1)
+        self.assertEqual(engine.add('OTHER_1_0001', b), [])
+
+    def test_decimate(self):
+        times = np.arange(100, dtype=np.int64) * 100
+        values = np.sin(np.arange(100) / 10.).reshape(100, 1)
+        t, v = decimate(times, values, 5, 'minmax')
+        self.assertEqual(len(t), 10)
+        self.assertAlmostEqual(v[:, 0].max(), values.max())
+        self.assertAlmostEqual(v[:, 0].min(), values.min())
+        t, v = decimate(times, values, 5, 'mean')
+        self.assertEqual(t.tolist(), [950, 2950, 4950, 6950, 8950])
+        t, v = decimate(times[:4], values[:4], 5, 'minmax')
+        self.assertEqual(len(t), 4)
+
+    def test_websocket_batcher(self):
+        batcher = WebsocketBatcher(interval=1.0)
+        block = decode_payload("2025,5,14,10,0,0,0,1,2;2025,5,14,10,0,0,500000,3,4", ['x', 'y'], [1, 1])
+        batcher.add('TEST_1_0001', block)
+        self.assertTrue(batcher.set_client(7, '{"rate": 1, "decimation": "mean", "binary": true}'))
+        self.assertFalse(batcher.set_client(8, 'hello'))
+        frames = batcher.flush([batcher.defaults, batcher.settings(7)])
+        text = frames[batcher.defaults][0]
+        self.assertEqual(text.split("\n")[1], "TEST_1_0001: 1747216800500,3.0,4.0")
+        binary = frames[batcher.settings(7)][0]
+        self.assertEqual(struct.unpack_from('<II', binary, 16), (1, 2))
+        self.assertEqual(np.frombuffer(binary, dtype='<f4', offset=32).tolist(), [2.0, 3.0])
+        self.assertEqual(batcher.flush(), {batcher.defaults: []})
+
+    def test_array_to_datetime64(self):
+        with self.assertRaises(ValueError):
+            array_to_datetime64([[2025, 2, 30, 0, 0, 0, 0]])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
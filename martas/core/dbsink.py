@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Batched database sink for the collector 'db' destination.
+
+    Decoded payloads (see collectorsupport.PayloadBlock) are queued per data table
+    and written by a background thread. A flush is triggered when either the
+    amount of queued rows exceeds flushrows or flushinterval seconds have passed.
+    All tables of one flush are written as multi-row REPLACE statements which are committed
+    together. The first batch of each table (and batches after header changes or with new keys)
+    is written by MagPy's DataBank.write so that the table and its SENSORS/DATAINFO information
+    are created and updated - DataBank.write commits these batches itself.
+
+    After each successful flush the latest timestamp of every table is written to the
+    freshness index DATAFRESHNESS (see freshness.py) used by the monitor.
+
+    If the database is slow or not reachable, batches are spilled to disk (json lines)
+    and replayed with the next successful flush. After a failed write the connection is
+    checked (ping with reconnect) or reopened with the database credentials before the next
+    write, so that the sink recovers from database restarts.
+
+    Configuration (marcos.cfg, all optional):
+        dbflushinterval  :  5                      # seconds
+        dbflushrows      :  2000                   # queued rows triggering a flush
+        dbmaxqueue       :  200000                 # rows kept in memory before spilling
+        dbspillpath      :  /tmp/marcos_dbspill    # directory for spilled batches
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+|  DatabaseSink   |  __init__  |  2.0.2 |      yes |                                  | -      |          |
+|  DatabaseSink   |  configure |  2.0.2 |       -  |                                  | -      | collector |
+|  DatabaseSink   |  start     |  2.0.2 |       -  |                                  | -      | collector |
+|  DatabaseSink   |  put       |  2.0.2 |      yes |  called by on_message            | -      | collector |
+|  DatabaseSink   |  flush     |  2.0.2 |      yes |  spill and replay                | -      |          |
+|  DatabaseSink   |  stop      |  2.0.2 |       -  |                                  | -      | collector |
+|  DatabaseSink   |  status    |  2.0.2 |      yes |  queue depth, flush latency      | -      | collector |
+
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+import unittest
+import numpy as np
+from magpy.stream import DataStream, KEYLIST
+from martas.core.collectorsupport import PayloadBlock
+from martas.core.freshness import update_freshness
+
+
+class _TableQueue(object):
+    """
+    DESCRIPTION
+        queued data of a single data table
+    """
+    __slots__ = ('tablename', 'header', 'blocks', 'rows')
+
+    def __init__(self, tablename, header):
+        self.tablename = tablename
+        self.header = header
+        self.blocks = []
+        self.rows = 0
+
+
+class DatabaseSink(object):
+    """
+    DESCRIPTION
+        background writer collecting decoded data blocks per table and writing
+        them in transaction grouped batches
+    VARIABLES
+        db              a MagPy DataBank - exclusively used by the sink thread
+        flushinterval   (float) seconds between flushes
+        flushrows       (int) amount of queued rows triggering a flush
+        maxqueue        (int) rows kept in memory - further data is spilled to disk
+        spillpath       (string) directory for spilled batches
+        dbcredentials   (string) credentials for reopening the connection after failures
+    """
+
+    def __init__(self, db, flushinterval=5.0, flushrows=2000, maxqueue=200000, spillpath='/tmp/marcos_dbspill', dbcredentials=None, debug=False):
+        self.db = db
+        self.dbcredentials = dbcredentials
+        self.reconnect = False
+        self.spillcount = 0
+        self.flushinterval = flushinterval
+        self.flushrows = flushrows
+        self.maxqueue = maxqueue
+        self.spillpath = spillpath
+        self.debug = debug
+        self.queues = {}
+        self.queuedrows = 0
+        self.columns = {}        # verified columns of existing tables
+        self.headers = {}        # last header written by DataBank.write
+        self.lock = threading.Lock()
+        self.writelock = threading.Lock()
+        self.trigger = threading.Event()
+        self.thread = None
+        self.running = False
+        self.stats = {'flushes': 0, 'rows': 0, 'failures': 0, 'spilled': 0, 'replayed': 0, 'reconnects': 0,
+                      'lastlatency': 0.0, 'maxlatency': 0.0, 'meanlatency': 0.0, 'lastflush': None}
+
+    def configure(self, conf):
+        """
+        DESCRIPTION
+            read sink parameters from a marcos configuration dictionary
+        """
+        try:
+            if not conf.get('dbflushinterval', '') in ['', '-']:
+                self.flushinterval = float(conf.get('dbflushinterval'))
+            if not conf.get('dbflushrows', '') in ['', '-']:
+                self.flushrows = int(conf.get('dbflushrows'))
+            if not conf.get('dbmaxqueue', '') in ['', '-']:
+                self.maxqueue = int(conf.get('dbmaxqueue'))
+        except (TypeError, ValueError):
+            print("dbsink: invalid flush parameters - using {} sec and {} rows".format(self.flushinterval, self.flushrows))
+        if not conf.get('dbspillpath', '') in ['', '-']:
+            self.spillpath = conf.get('dbspillpath').strip()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="DatabaseSink")
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """
+        DESCRIPTION
+            stop the sink thread and write all remaining data
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.trigger.set()
+        if self.thread:
+            self.thread.join(timeout=max(30.0, self.flushinterval * 2))
+        self.flush()
+
+    def put(self, sensorid, tablename, header, block):
+        """
+        DESCRIPTION
+            queue a decoded PayloadBlock for table tablename
+            (tablename None: table is determined by DataBank.write)
+        """
+        if not len(block):
+            return
+        key = tablename if tablename else sensorid
+        spill = None
+        with self.lock:
+            if self.queuedrows + len(block) > self.maxqueue:
+                spill = (key, header, block)
+            else:
+                queue = self.queues.get(key)
+                if queue is None:
+                    queue = _TableQueue(tablename, header)
+                    self.queues[key] = queue
+                queue.header = header
+                queue.blocks.append(block)
+                queue.rows += len(block)
+                self.queuedrows += len(block)
+                if self.queuedrows >= self.flushrows:
+                    self.trigger.set()
+        if spill:
+            queue = _TableQueue(tablename, header)
+            queue.blocks.append(block)
+            queue.rows = len(block)
+            self._spill([queue])
+
+    def status(self):
+        """
+        DESCRIPTION
+            returns queue depth and flush statistics
+        """
+        with self.lock:
+            stat = dict(self.stats)
+            stat['queuedrows'] = self.queuedrows
+            stat['queuedtables'] = {key: self.queues[key].rows for key in self.queues}
+        stat['spillfiles'] = len(self._spillfiles())
+        return stat
+
+    def _run(self):
+        while self.running:
+            self.trigger.wait(self.flushinterval)
+            self.trigger.clear()
+            if not self.running:
+                break
+            try:
+                self.flush()
+            except Exception as e:
+                print("dbsink: flush failed - {}".format(e))
+
+    def flush(self):
+        """
+        DESCRIPTION
+            write all queued data within one transaction
+        """
+        with self.writelock:
+            return self._flush()
+
+    def _flush(self):
+        with self.lock:
+            queues = [q for q in self.queues.values() if q.rows > 0]
+            self.queues = {}
+            self.queuedrows = 0
+        if not queues:
+            self._replay()
+            return True
+        t0 = time.time()
+        success = self._write(queues)
+        latency = time.time() - t0
+        with self.lock:
+            self.stats['lastlatency'] = latency
+            self.stats['maxlatency'] = max(self.stats['maxlatency'], latency)
+            if success:
+                rows = sum([q.rows for q in queues])
+                self.stats['flushes'] += 1
+                self.stats['rows'] += rows
+                n = self.stats['flushes']
+                self.stats['meanlatency'] += (latency - self.stats['meanlatency']) / n
+                self.stats['lastflush'] = t0
+            else:
+                self.stats['failures'] += 1
+        if success:
+            if self.debug:
+                print("dbsink: wrote {} tables in {:.3f} sec".format(len(queues), latency))
+            self._replay()
+        else:
+            self._spill(queues)
+        return success
+
+    def _table_columns(self, cursor, tablename):
+        columns = self.columns.get(tablename)
+        if columns is None:
+            cursor.execute("SHOW COLUMNS FROM {}".format(tablename))
+            columns = set([el[0] for el in cursor.fetchall()])
+            self.columns[tablename] = columns
+        return columns
+
+    def _stream(self, header, blocks):
+        stream = DataStream()
+        stream.header = dict(header)
+        if len(blocks) == 1:
+            stream.ndarray = blocks[0].to_ndarray()
+        else:
+            array = [np.asarray([]) for el in KEYLIST]
+            array[0] = np.concatenate([b.datetimes() for b in blocks])
+            for idx, key in enumerate(blocks[0].keys):
+                array[KEYLIST.index(key)] = np.concatenate([b.columns[idx] for b in blocks])
+            stream.ndarray = np.asarray(array, dtype=object)
+        return stream
+
+    def _rows(self, blocks):
+        rows = []
+        for block in blocks:
+            times = [el.replace('T', ' ') for el in np.datetime_as_string(block.times, unit='us').tolist()]
+            cols = [times] + [col.tolist() for col in block.columns]
+            for row in zip(*cols):
+                # NaN is written as NULL
+                rows.append([None if v != v else v for v in row])
+        return rows
+
+    def _groups(self, queue):
+        """
+        split the queued blocks of a table into groups with identical keys
+        """
+        groups = []
+        for block in queue.blocks:
+            if groups and groups[-1][0] == block.keys:
+                groups[-1][1].append(block)
+            else:
+                groups.append((block.keys, [block]))
+        return groups
+
+    def _reconnect(self):
+        """
+        DESCRIPTION
+            check the connection after a failed write (e.g. database restart) - ping with
+            reconnect, or open a new connection with the credentials
+        """
+        try:
+            self.db.db.ping(True)
+            self.reconnect = False
+            return True
+        except Exception:
+            pass
+        if self.dbcredentials:
+            from martas.core import methods as mm
+            db = mm.connect_db(self.dbcredentials, exitonfailure=False, report=False)
+            if db:
+                self.db = db
+                self.reconnect = False
+                with self.lock:
+                    self.stats['reconnects'] += 1
+                print("dbsink: reconnected to database")
+                return True
+        return False
+
+    def _write(self, queues):
+        if self.reconnect and not self._reconnect():
+            return False
+        db = self.db
+        cursor = None
+        lasttimes = {}
+        try:
+            cursor = db.db.cursor()
+            for queue in queues:
+                tablename = queue.tablename
+                dataid = tablename if tablename else queue.header.get('DataID')
+                ends = [block.times.max() for block in queue.blocks if len(block)]
+                if dataid and ends:
+                    lasttimes[dataid] = max(ends).astype('datetime64[us]').astype(object)
+                headerid = repr(sorted(queue.header.items()))
+                for keys, blocks in self._groups(queue):
+                    direct = tablename and self.headers.get(tablename) == headerid
+                    if direct:
+                        tablecolumns = self._table_columns(cursor, tablename)
+                        direct = all([key in tablecolumns for key in keys])
+                    if direct:
+                        columns = ['time'] + list(keys)
+                        sql = "REPLACE INTO {} ({}) VALUES ({})".format(tablename, ','.join(columns), ','.join(['%s'] * len(columns)))
+                        cursor.executemany(sql, self._rows(blocks))
+                    else:
+                        # creates tables and updates SENSORS/DATAINFO
+                        stream = self._stream(queue.header, blocks)
+                        if tablename:
+                            db.write(stream, tablename=tablename)
+                            self.headers[tablename] = headerid
+                            self.columns.pop(tablename, None)
+                        else:
+                            db.write(stream)
+            db.db.commit()
+            # freshness index for the monitor (separate transaction, failures are not critical)
+            update_freshness(db, lasttimes)
+            return True
+        except Exception as e:
+            print("dbsink: writing to database failed - {}".format(e))
+            try:
+                db.db.rollback()
+            except Exception:
+                pass
+            # use DataBank.write again for the next batch of each table
+            self.headers = {}
+            self.columns = {}
+            self.reconnect = True
+            return False
+        finally:
+            if cursor:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+
+    def _spillfiles(self):
+        if not os.path.isdir(self.spillpath):
+            return []
+        return sorted([os.path.join(self.spillpath, f) for f in os.listdir(self.spillpath) if f.endswith('.json')])
+
+    def _spill(self, queues):
+        """
+        DESCRIPTION
+            save batches as json lines - one file per batch
+        """
+        try:
+            if not os.path.isdir(self.spillpath):
+                os.makedirs(self.spillpath)
+            with self.lock:
+                self.spillcount += 1
+                count = self.spillcount
+            fname = os.path.join(self.spillpath, "dbspill_{:.6f}_{:06d}.json".format(time.time(), count))
+            rows = 0
+            with open(fname, 'w') as f:
+                for queue in queues:
+                    for block in queue.blocks:
+                        cont = {'tablename': queue.tablename, 'header': queue.header, 'keys': block.keys,
+                                'times': np.datetime_as_string(block.times, unit='us').tolist(),
+                                'columns': [col.tolist() for col in block.columns]}
+                        f.write(json.dumps(cont) + "\n")
+                        rows += len(block)
+            with self.lock:
+                self.stats['spilled'] += rows
+            print("dbsink: spilled {} rows to {}".format(rows, fname))
+        except Exception as e:
+            print("dbsink: spilling data failed - data lost - {}".format(e))
+
+    def _replay(self):
+        """
+        DESCRIPTION
+            write spilled batches after the database became available again
+        """
+        for fname in self._spillfiles():
+            queues = {}
+            try:
+                with open(fname, 'r') as f:
+                    for line in f:
+                        cont = json.loads(line)
+                        block = PayloadBlock(np.asarray(cont.get('times'), dtype='datetime64[us]'), cont.get('keys'),
+                                             [np.asarray(col) for col in cont.get('columns')])
+                        key = (cont.get('tablename'), repr(sorted(cont.get('header').items())))
+                        queue = queues.get(key)
+                        if queue is None:
+                            queue = _TableQueue(cont.get('tablename'), cont.get('header'))
+                            queues[key] = queue
+                        queue.blocks.append(block)
+                        queue.rows += len(block)
+            except Exception as e:
+                print("dbsink: could not read spill file {} - {}".format(fname, e))
+                continue
+            if not self._write(list(queues.values())):
+                break
+            os.remove(fname)
+            with self.lock:
+                self.stats['replayed'] += sum([q.rows for q in queues.values()])
+
+
+class _FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.result = []
+
+    def execute(self, sql, params=None):
+        if self.connection.down:
+            raise Exception("MySQL server has gone away")
+        if sql.startswith("SHOW COLUMNS FROM"):
+            self.result = [(el,) for el in self.connection.columns]
+
+    def executemany(self, sql, rows):
+        if self.connection.down:
+            raise Exception("MySQL server has gone away")
+        self.connection.statements.append((sql, list(rows)))
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class _FakeConnection(object):
+
+    def __init__(self):
+        self.down = False
+        self.columns = ['time', 'x', 'y', 'flag', 'typ', 'comment']
+        self.statements = []
+        self.commits = 0
+        self.pings = 0
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+    def ping(self, reconnect=False):
+        if self.down:
+            raise Exception("Can't connect to MySQL server")
+        self.pings += 1
+
+
+class _FakeDataBank(object):
+    """
+    stands in for magpy.core.database.DataBank
+    """
+
+    def __init__(self):
+        self.db = _FakeConnection()
+        self.written = []
+
+    def write(self, stream, tablename=None):
+        if self.db.down:
+            raise Exception("MySQL server has gone away")
+        self.written.append((tablename, stream.length()[0]))
+
+
+class TestDatabaseSink(unittest.TestCase):
+    """
+    Test environment for the database sink
+    """
+
+    def _block(self, start, n=10):
+        times = np.datetime64('2025-01-01T00:00:00', 'us') + (start + np.arange(n)) * np.timedelta64(1, 's')
+        return PayloadBlock(times, ['x', 'y'], [np.arange(n, dtype=float), np.full(n, np.nan)])
+
+    def _replaces(self, db):
+        return [el for el in db.db.statements if el[0].startswith('REPLACE INTO')]
+
+    def test_batching(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = _FakeDataBank()
+            sink = DatabaseSink(db, flushrows=25, spillpath=tmpdir)
+            header = {'SensorID': 'TEST_1_0001', 'DataID': 'TEST_1_0001_0001'}
+            sink.put('TEST_1_0001', 'TEST_1_0001_0001', header, self._block(0))
+            sink.put('TEST_1_0001', 'TEST_1_0001_0001', header, self._block(10))
+            self.assertFalse(sink.trigger.is_set())
+            self.assertEqual(sink.status().get('queuedrows'), 20)
+            # the first batch creates the table by DataBank.write
+            self.assertTrue(sink.flush())
+            self.assertEqual(db.written, [('TEST_1_0001_0001', 20)])
+            # further batches are multi-row REPLACE statements, NaN is written as NULL
+            sink.put('TEST_1_0001', 'TEST_1_0001_0001', header, self._block(20))
+            sink.put('TEST_1_0001', 'TEST_1_0001_0001', header, self._block(30, n=20))
+            self.assertTrue(sink.trigger.is_set())
+            self.assertTrue(sink.flush())
+            replaces = self._replaces(db)
+            self.assertEqual(len(replaces), 1)
+            self.assertTrue(replaces[0][0].startswith('REPLACE INTO TEST_1_0001_0001 (time,x,y)'))
+            self.assertEqual(len(replaces[0][1]), 30)
+            self.assertEqual(replaces[0][1][0], ['2025-01-01 00:00:20.000000', 0.0, None])
+            self.assertEqual(len(db.written), 1)
+            stat = sink.status()
+            self.assertEqual(stat.get('rows'), 50)
+            self.assertEqual(stat.get('queuedrows'), 0)
+
+    def test_spill_and_replay(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = _FakeDataBank()
+            sink = DatabaseSink(db, spillpath=tmpdir, maxqueue=15)
+            header = {'SensorID': 'TEST_1_0001', 'DataID': 'TEST_1_0001_0001'}
+            sink.put('TEST_1_0001', 'TEST_1_0001_0001', header, self._block(0))
+            self.assertTrue(sink.flush())
+            # database restart: the batch is spilled
+            db.db.down = True
+            sink.put('TEST_1_0001', 'TEST_1_0001_0001', header, self._block(10))
+            self.assertFalse(sink.flush())
+            # queue limit exceeded: spilled directly
+            sink.put('TEST_1_0001', 'TEST_1_0001_0001', header, self._block(20))
+            sink.put('TEST_1_0001', 'TEST_1_0001_0001', header, self._block(30))
+            stat = sink.status()
+            self.assertEqual(stat.get('spillfiles'), 2)
+            self.assertEqual(stat.get('spilled'), 20)
+            self.assertTrue(sink.reconnect)
+            # database available again: ping reconnects and spilled data is replayed
+            db.db.down = False
+            self.assertTrue(sink.flush())
+            stat = sink.status()
+            self.assertEqual(stat.get('spillfiles'), 0)
+            self.assertEqual(stat.get('replayed'), 20)
+            self.assertEqual(db.db.pings, 1)
+            self.assertFalse(sink.reconnect)
+            rows = sum([len(el[1]) for el in self._replaces(db)]) + sum([el[1] for el in db.written])
+            self.assertEqual(rows, 40)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Server side decimation of plot traces (used by web/pages/pMARTAS and pMARCOS).
+
+    Each trace is reduced to a point budget derived from the size of the graph (point_budget).
+    Method "minmax" keeps the minimum and the maximum sample of each time bucket (two points per
+    pixel column), so spikes remain visible. Buckets are aligned to multiples of the bucket width
+    in time, thus completed buckets never change: the DecimationCache keeps the points of
+    completed buckets per (trace, window, budget) and only decimates samples of the current
+    and new buckets on updates. Method "lttb" (largest triangle three buckets) selects visually
+    representative points; its results are cached until new samples arrive.
+    All methods are vectorized with NumPy (lttb loops over the output points only).
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+|                 |  point_budget |  2.0.2 |    yes |  points per trace from graph size | -     | pMARTAS, pMARCOS |
+|                 |  minmax_indices |  2.0.2 |  yes |  min and max of consecutive groups | -    |          |
+|                 |  lttb_indices |  2.0.2 |    yes |                                  | -      |          |
+|                 |  decimate_trace |  2.0.2 |  yes |  minmax, lttb or none            | -      |          |
+| DecimationCache |  get       |  2.0.2 |      yes |  incremental minmax              | -      | pMARTAS, pMARCOS |
+
+"""
+
+import threading
+import unittest
+from collections import OrderedDict
+import numpy as np
+
+
+def point_budget(width=1200, height=450, rows=1, pointsperpixel=2, minimum=100, maximum=4000):
+    """
+    DESCRIPTION
+        amount of points per trace for a graph of width x height pixels with rows subplots.
+        Subplots lower than 150 pixels get a proportionally smaller budget.
+    """
+    rowheight = float(height) / max(1, int(rows))
+    scale = min(1.0, rowheight / 150.)
+    return int(min(maximum, max(minimum, width * pointsperpixel * scale)))
+
+
+def _microseconds(times):
+    return np.asarray(times, dtype='datetime64[us]').astype(np.int64)
+
+
+def minmax_indices(ids, values):
+    """
+    DESCRIPTION
+        indices (in time order) of the minimum and maximum of each group of consecutive equal ids.
+        NaN values are ignored, groups without valid values are dropped.
+    """
+    n = len(values)
+    if not n:
+        return np.array([], dtype=np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(ids)) + 1))
+    group = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, n)))
+    invalid = np.isnan(values)
+    # lexsort: primary key group, secondary key value -> first element of each group is its extremum
+    imin = np.lexsort((np.where(invalid, np.inf, values), group))[starts]
+    imax = np.lexsort((np.where(invalid, np.inf, -values), group))[starts]
+    idx = np.unique(np.concatenate((imin, imax)))
+    return idx[~invalid[idx]]
+
+
+def lttb_indices(x, y, threshold):
+    """
+    DESCRIPTION
+        largest triangle three buckets - indices of threshold representative points
+        (x and y are float arrays without NaN)
+    """
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / float(threshold - 2)
+    idx = np.empty(threshold, dtype=np.int64)
+    idx[0] = 0
+    a = 0
+    for i in range(threshold - 2):
+        start = int(np.floor(i * every)) + 1
+        end = int(np.floor((i + 1) * every)) + 1
+        nextend = min(int(np.floor((i + 2) * every)) + 1, n)
+        if end >= nextend:
+            avgx, avgy = x[n - 1], y[n - 1]
+        else:
+            avgx, avgy = x[end:nextend].mean(), y[end:nextend].mean()
+        area = np.abs((x[a] - avgx) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avgy - y[a]))
+        a = start + int(np.argmax(area))
+        idx[i + 1] = a
+    idx[-1] = n - 1
+    return idx
+
+
+def decimate_trace(times, values, budget, method='minmax'):
+    """
+    DESCRIPTION
+        reduce a trace to about budget points
+    VARIABLES
+        times    datetime64 array (chronological)
+        values   numerical array
+        method   'minmax', 'lttb' or 'none'
+    RETURNS
+        times, values
+    """
+    times = np.asarray(times)
+    values = np.asarray(values)
+    if method in [None, '', 'none', 'None'] or len(times) <= budget or values.dtype.kind not in 'fiu':
+        return times, values
+    values = values.astype(float)
+    if method == 'lttb':
+        valid = np.flatnonzero(~np.isnan(values))
+        sel = valid[lttb_indices(_microseconds(times[valid]).astype(float), values[valid], int(budget))]
+        return times[sel], values[sel]
+    t = _microseconds(times)
+    width = max(1, int(np.ceil((t[-1] - t[0] + 1) / float(max(1, int(budget) // 2)))))
+    idx = minmax_indices(t // width, values)
+    return times[idx], values[idx]
+
+
+class DecimationCache(object):
+    """
+    DESCRIPTION
+        decimated traces per (key, window, budget) which are updated incrementally
+    VARIABLES
+        method      'minmax', 'lttb' or 'none'
+        maxentries  (int) amount of cached traces (least recently used are dropped)
+    APPLICATION
+        cache = DecimationCache('minmax')
+        times, columns = livebuffer.last(seconds=600)
+        x, y = cache.get(('LEMI036_1_0002', 'x'), times, columns['x'], 600, budget)
+    """
+
+    def __init__(self, method='minmax', maxentries=64):
+        self.method = method
+        self.maxentries = maxentries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxentries:
+            self.entries.popitem(last=False)
+
+    def get(self, key, times, values, window, budget):
+        """
+        DESCRIPTION
+            decimated trace of the raw samples (times, values) of a window of window seconds
+        RETURNS
+            times (datetime64[us]), values
+        """
+        times = np.asarray(times, dtype='datetime64[us]')
+        values = np.asarray(values)
+        if not len(times) or self.method in [None, '', 'none', 'None'] or values.dtype.kind not in 'fiu':
+            return times, values
+        values = values.astype(float)
+        t = times.astype(np.int64)
+        fullkey = (key, window, budget)
+        with self.lock:
+            entry = self.entries.get(fullkey)
+            if not self.method == 'minmax':
+                if entry and entry['last'] == t[-1] and entry['first'] == t[0]:
+                    return entry['x'], entry['y']
+                x, y = decimate_trace(times, values, budget, method=self.method)
+                self._store(fullkey, {'first': t[0], 'last': t[-1], 'x': x, 'y': y})
+                return x, y
+
+            # fixed bucket width for (window, budget): bucket borders do not move with time
+            width = max(1, int(np.ceil(window * 1000000. / max(1, int(budget) // 2))))
+            if entry is None or t[-1] < entry['last']:
+                entry = {'x': np.array([], dtype=np.int64), 'y': np.array([], dtype=float), 'done': None}
+            start = 0
+            if entry['done'] is not None:
+                start = int(np.searchsorted(t, (entry['done'] + 1) * width, side='left'))
+            newt = t[start:]
+            newv = values[start:]
+            ids = newt // width
+            idx = minmax_indices(ids, newv)
+            x = np.concatenate((entry['x'], newt[idx]))
+            y = np.concatenate((entry['y'], newv[idx]))
+            # drop buckets before the window
+            inside = x >= t[0]
+            x, y = x[inside], y[inside]
+            if len(ids):
+                # points of completed buckets are kept, the current bucket is recomputed next time
+                current = int(ids[-1])
+                complete = x // width < current
+                entry = {'x': x[complete], 'y': y[complete], 'done': current - 1}
+            entry['last'] = t[-1]
+            self._store(fullkey, entry)
+            return x.astype('datetime64[us]'), y
+
+
+class TestDecimation(unittest.TestCase):
+    """
+    Test environment for the decimation methods
+    """
+
+    def _data(self, n=10000):
+        times = np.datetime64('2025-01-01T00:00:00', 'us') + np.arange(n) * np.timedelta64(100000, 'us')
+        values = np.sin(np.arange(n) / 300.)
+        values[5000] = 10.
+        values[100] = np.nan
+        return times, values
+
+    def test_point_budget(self):
+        self.assertEqual(point_budget(1000, 450, 1), 2000)
+        self.assertEqual(point_budget(1000, 450, 6), 1000)
+
+    def test_minmax(self):
+        times, values = self._data()
+        x, y = decimate_trace(times, values, 200)
+        self.assertTrue(len(x) <= 202)
+        self.assertIn(10., y)
+        self.assertTrue(np.all(np.diff(x) > np.timedelta64(0, 'us')))
+        self.assertFalse(np.any(np.isnan(y)))
+
+    def test_lttb(self):
+        times, values = self._data()
+        x, y = decimate_trace(times, values, 300, method='lttb')
+        self.assertEqual(len(x), 300)
+        self.assertEqual(x[0], times[0])
+        self.assertEqual(x[-1], times[-1])
+        self.assertIn(10., y)
+
+    def test_incremental(self):
+        times, values = self._data()
+        cache = DecimationCache('minmax')
+        cache.get('a', times[:6000], values[:6000], 1000, 200)
+        x1, y1 = cache.get('a', times[:8000], values[:8000], 1000, 200)
+        x2, y2 = DecimationCache('minmax').get('a', times[:8000], values[:8000], 1000, 200)
+        self.assertTrue(np.array_equal(x1, x2))
+        self.assertTrue(np.array_equal(y1, y2))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Incremental scanner for the newest file of every directory (used by monitor.check_martas).
+
+    Each directory is read with a single os.scandir pass. The directory mtime, the list of
+    subdirectories and the newest file are kept in a state file between runs. If the mtime of a
+    directory did not change (no files added, removed or renamed), the directory is not listed
+    again and only its newest file is checked with a single stat (buffer files are appended).
+    Excluded directories (e.g. archive) are not entered at all.
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+| DirectoryScanner |  scan     |  2.0.2 |      yes |  newest file per directory       | -      | monitor  |
+| DirectoryScanner |  load     |  2.0.2 |      yes |  read state file                 | -      | monitor  |
+| DirectoryScanner |  save     |  2.0.2 |      yes |  write state file                | -      | monitor  |
+
+"""
+
+import os
+import json
+import time
+import unittest
+
+
+class DirectoryScanner(object):
+    """
+    DESCRIPTION
+        finds the newest file (ctime) of every directory below a base path
+    VARIABLES
+        statefile   (string) json file to keep the state between runs (None: memory only)
+        exclude     (list) directories containing one of these strings in their path are skipped
+    APPLICATION
+        scanner = DirectoryScanner('/tmp/monitor-scan.json', exclude=['archive'])
+        for directory, (path, ctime) in scanner.scan('/srv').items():
+            ...
+        scanner.save()
+    """
+
+    def __init__(self, statefile=None, exclude=None):
+        self.statefile = statefile
+        self.exclude = list(exclude) if exclude else []
+        self.state = {}
+        self.listed = 0
+        self.reused = 0
+        if statefile:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.statefile, 'r') as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+
+    def save(self):
+        if not self.statefile:
+            return
+        tmpfile = self.statefile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(self.state, f)
+        os.replace(tmpfile, self.statefile)
+
+    def _excluded(self, path):
+        return any(path.find(ex) > -1 for ex in self.exclude)
+
+    def _list(self, path):
+        """
+        one scandir pass: subdirectories and the newest file
+        """
+        subdirs = []
+        latest, latestctime = None, None
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif entry.is_file():
+                        ctime = entry.stat().st_ctime
+                        if latestctime is None or ctime > latestctime:
+                            latest, latestctime = entry.name, ctime
+                except OSError:
+                    # file removed while scanning
+                    pass
+        self.listed += 1
+        return subdirs, latest, latestctime
+
+    def scan(self, basepath):
+        """
+        DESCRIPTION
+            scan basepath and all (not excluded) subdirectories
+        RETURNS
+            dictionary {directory: (newest file, ctime)}
+        """
+        result = {}
+        visited = set()
+        stack = [basepath]
+        while stack:
+            path = stack.pop()
+            if self._excluded(path):
+                continue
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            visited.add(path)
+            cached = self.state.get(path)
+            latest, ctime = None, None
+            if cached and cached.get('mtime') == mtime:
+                subdirs, latest = cached.get('subdirs', []), cached.get('latest')
+                if latest:
+                    try:
+                        ctime = os.stat(os.path.join(path, latest)).st_ctime
+                        self.reused += 1
+                    except OSError:
+                        cached = None
+            else:
+                cached = None
+            if not cached:
+                try:
+                    subdirs, latest, ctime = self._list(path)
+                except OSError:
+                    continue
+            self.state[path] = {'mtime': mtime, 'subdirs': subdirs, 'latest': latest}
+            if latest:
+                result[path] = (os.path.join(path, latest), ctime)
+            stack.extend(os.path.join(path, sub) for sub in subdirs)
+        # forget directories which disappeared below basepath
+        prefix = os.path.join(basepath, '')
+        for path in list(self.state.keys()):
+            if (path == basepath or path.startswith(prefix)) and path not in visited:
+                del self.state[path]
+        return result
+
+
+class TestDirectoryScanner(unittest.TestCase):
+    """
+    Test environment for the directory scanner
+    """
+
+    def test_scan(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            base = os.path.join(tmpdir, 'srv')
+            os.makedirs(os.path.join(base, 'SENSOR_1'))
+            os.makedirs(os.path.join(base, 'archive', 'OLD'))
+            for name in ['SENSOR_1_2025-01-01.bin', 'SENSOR_1_2025-01-02.bin']:
+                with open(os.path.join(base, 'SENSOR_1', name), 'w') as f:
+                    f.write('x')
+                time.sleep(0.01)
+            with open(os.path.join(base, 'archive', 'OLD', 'a.bin'), 'w') as f:
+                f.write('x')
+            statefile = os.path.join(tmpdir, 'state.json')
+            scanner = DirectoryScanner(statefile, exclude=['archive'])
+            result = scanner.scan(base)
+            sensordir = os.path.join(base, 'SENSOR_1')
+            self.assertEqual(list(result.keys()), [sensordir])
+            self.assertTrue(result[sensordir][0].endswith('2025-01-02.bin'))
+            scanner.save()
+            # second run: unchanged directories are not listed again
+            scanner = DirectoryScanner(statefile, exclude=['archive'])
+            self.assertEqual(scanner.scan(base), result)
+            self.assertEqual(scanner.listed, 0)
+            self.assertEqual(scanner.reused, 1)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Frame synchronisation for fixed length binary/serial protocols.
+
+    Incoming serial chunks are copied once into a preallocated bytearray. Complete
+    frames are returned as memoryview slices of this buffer (no copies) and can be
+    unpacked directly with struct.Struct.unpack_from. Frames are identified by a start
+    tag (e.g. LEMI) and/or an end tag (e.g. POS1). If a frame does not match, the
+    assembler searches the next tag (resync) and discards the bytes in between.
+
+    Returned frames are only valid until the next call of feed.
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+| FrameAssembler  |  __init__  |  2.0.2 |      yes |                                  | -      |          |
+| FrameAssembler  |  feed      |  2.0.2 |      yes |  returns complete frames         | -      | lemiprotocol, pos1protocol |
+| FrameAssembler  |  reset     |  2.0.2 |      yes |                                  | -      | lemiprotocol |
+| FrameAssembler  |  status    |  2.0.2 |      yes |  frames, resyncs, discarded      | -      |          |
+
+"""
+
+import struct
+import unittest
+
+
+class FrameAssembler(object):
+    """
+    DESCRIPTION
+        assembles fixed length frames from a stream of chunks
+    VARIABLES
+        framelength  (int) length of a frame in bytes
+        starttag     (bytes) every frame starts with starttag
+        endtag       (bytes) every frame ends with endtag
+        capacity     (int) initial buffer size (default 16 frames)
+    APPLICATION
+        assembler = FrameAssembler(153, starttag=b'L036')
+        record = struct.Struct('<4cB6B8hb30f3BcB')
+        for frame in assembler.feed(chunk):
+            values = record.unpack_from(frame)
+    """
+
+    def __init__(self, framelength, starttag=None, endtag=None, capacity=None):
+        self.framelength = int(framelength)
+        self.starttag = bytes(starttag) if starttag else b''
+        self.endtag = bytes(endtag) if endtag else b''
+        if not capacity:
+            capacity = 16 * self.framelength
+        self.buffer = bytearray(max(int(capacity), 2 * self.framelength))
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.frames = 0
+        self.resyncs = 0
+        self.discarded = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reset(self):
+        """
+        DESCRIPTION
+            drop all buffered bytes
+        """
+        self.discarded += self.end - self.start
+        self.start = 0
+        self.end = 0
+
+    def _append(self, data):
+        n = len(data)
+        if self.end + n > len(self.buffer):
+            pending = self.end - self.start
+            if pending + n > len(self.buffer):
+                # chunk larger than the buffer: use a new buffer - previously returned views stay valid
+                newbuffer = bytearray(2 * (pending + n))
+                newbuffer[:pending] = self.view[self.start:self.end]
+                self.buffer = newbuffer
+                self.view = memoryview(newbuffer)
+            else:
+                # move the incomplete frame to the front
+                self.buffer[:pending] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = pending
+        self.buffer[self.end:self.end + n] = data
+        self.end += n
+
+    def _discard(self, n):
+        self.discarded += n
+        self.start += n
+        self.resyncs += 1
+
+    def _resync(self):
+        """
+        skip to the next possible frame start - returns False if more data is required
+        """
+        if self.starttag:
+            idx = self.buffer.find(self.starttag, self.start + 1, self.end)
+            if idx < 0:
+                # keep a possible partial tag at the end
+                keep = min(len(self.starttag) - 1, self.end - self.start - 1)
+                self._discard(self.end - self.start - keep)
+                return False
+            self._discard(idx - self.start)
+        else:
+            idx = self.buffer.find(self.endtag, self.start, self.end)
+            if idx < 0:
+                self._discard(self.end - self.start)
+                return False
+            self._discard(idx + len(self.endtag) - self.start)
+        return True
+
+    def feed(self, data):
+        """
+        DESCRIPTION
+            add a chunk of data
+        RETURNS
+            list of complete frames (memoryview, valid until the next call of feed)
+        """
+        self._append(data)
+        frames = []
+        fl = self.framelength
+        buf = self.buffer
+        tl = len(self.starttag)
+        el = len(self.endtag)
+        while self.end - self.start >= fl:
+            s = self.start
+            if tl and not buf.startswith(self.starttag, s):
+                if not self._resync():
+                    break
+                continue
+            if tl and self.end - s >= fl + tl and not buf.startswith(self.starttag, s + fl):
+                # the following frame does not start at the expected position: bytes were lost
+                idx = buf.find(self.starttag, s + 1, s + fl)
+                if idx >= 0:
+                    self._discard(idx - s)
+                    continue
+            if el and not buf.startswith(self.endtag, s + fl - el):
+                # lost or additional bytes within the frame
+                if not tl:
+                    idx = buf.find(self.endtag, s, s + fl)
+                    if idx >= 0:
+                        self._discard(idx + el - s)
+                        continue
+                if not self._resync():
+                    break
+                continue
+            frames.append(self.view[s:s + fl])
+            self.start = s + fl
+            self.frames += 1
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        return frames
+
+    def status(self):
+        """
+        DESCRIPTION
+            returns counters for monitoring
+        """
+        return {'frames': self.frames, 'resyncs': self.resyncs, 'discarded': self.discarded, 'pending': len(self)}
+
+
+class TestFrameAssembler(unittest.TestCase):
+    """
+    Test environment for the frame assembler
+    """
+
+    def test_starttag(self):
+        record = struct.Struct('<4sH')
+        frames = [record.pack(b'L036', i) for i in range(5)]
+        stream = b''.join(frames)
+        assembler = FrameAssembler(6, starttag=b'L036', capacity=12)
+        values = []
+        # garbage at the beginning and odd chunk sizes
+        chunks = [b'xx' + stream[:4], stream[4:13], stream[13:]]
+        for chunk in chunks:
+            for frame in assembler.feed(chunk):
+                values.append(record.unpack_from(frame)[1])
+        self.assertEqual(values, [0, 1, 2, 3, 4])
+        self.assertEqual(assembler.status()['discarded'], 2)
+        self.assertEqual(assembler.status()['pending'], 0)
+
+    def test_lost_bytes(self):
+        assembler = FrameAssembler(6, starttag=b'L0')
+        frames = assembler.feed(b'L0abcdL0abL0efgh')
+        self.assertEqual([bytes(f) for f in frames], [b'L0abcd', b'L0efgh'])
+        self.assertEqual(assembler.resyncs, 1)
+
+    def test_endtag(self):
+        assembler = FrameAssembler(4, endtag=b'\x00')
+        frames = assembler.feed(b'12\x00abc\x00de')
+        frames = [bytes(f) for f in frames] + [bytes(f) for f in assembler.feed(b'f\x00')]
+        self.assertEqual(frames, [b'abc\x00', b'def\x00'])
+        self.assertEqual(assembler.discarded, 3)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,454 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Freshness index of data tables.
+
+    The table DATAFRESHNESS contains the timestamp of the latest record of every data table
+    (DataID). It is updated by all writers (collector db destination, filter, file_download)
+    so that the monitor can read the actuality of all tables together with the list of existing
+    tables in a single query. If the index is missing or incomplete, the latest timestamps
+    are obtained by scanning the data tables in parallel (one connection per worker) and
+    written to the index.
+    Not all writers update the index (e.g. basevalue or other MagPy installations). Index values
+    which look outdated are therefore scanned again before they are reported (stale_tables).
+    Scanned values never lower newer index values (store_scanned).
+
+        CREATE TABLE DATAFRESHNESS (DataID VARCHAR(100) PRIMARY KEY, LastTime DATETIME(6), Updated DATETIME)
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+|                 |  create_freshness_table | 2.0.2 | yes |                            | -      |          |
+|                 |  update_freshness | 2.0.2 | yes  |  upsert latest times             | -      | dbsink, filter, file_download |
+|                 |  update_freshness_from_stream | 2.0.2 | - |                        | -      | filter, file_download |
+|                 |  read_freshness | 2.0.2 |  yes  |  tables and latest times         | -      | monitor, pMARCOS |
+|                 |  scan_lasttimes | 2.0.2 |  yes  |  parallel fallback scan          | -      | monitor  |
+|                 |  union_lasttimes | 2.0.2 | yes  |  batched MAX(time) unions        | -      | pMARCOS  |
+|                 |  stale_tables | 2.0.2 |   yes  |  missing, invalid or outdated    | -      | monitor, pMARCOS |
+|                 |  store_scanned | 2.0.2 |  yes  |  write scans without lowering    | -      | monitor, pMARCOS |
+|                 |  valid_lasttime | 2.0.2 | yes  |                                  | -      | monitor  |
+
+"""
+
+import threading
+import unittest
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+FRESHNESS_TABLE = 'DATAFRESHNESS'
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def create_freshness_table(db):
+    """
+    DESCRIPTION
+        create the freshness index if not existing
+    """
+    cursor = db.db.cursor()
+    try:
+        cursor.execute("CREATE TABLE IF NOT EXISTS {} (DataID VARCHAR(100) NOT NULL PRIMARY KEY, "
+                       "LastTime DATETIME(6), Updated DATETIME)".format(FRESHNESS_TABLE))
+        db.db.commit()
+    finally:
+        cursor.close()
+
+
+def update_freshness(db, lasttimes, replace=False, cursor=None, debug=False):
+    """
+    DESCRIPTION
+        write latest timestamps into the freshness index
+    VARIABLES
+        lasttimes   (dict) {DataID: datetime}
+        replace     (bool) overwrite existing values (default: keep the later timestamp)
+        cursor      use an existing cursor and transaction (no commit)
+    RETURNS
+        True if successful
+    """
+    rows = [(dataid, lasttime, _utcnow()) for dataid, lasttime in lasttimes.items() if dataid and lasttime]
+    if not rows:
+        return True
+    if replace:
+        update = "LastTime=VALUES(LastTime)"
+    else:
+        update = "LastTime=GREATEST(COALESCE(LastTime, VALUES(LastTime)), VALUES(LastTime))"
+    sql = "INSERT INTO {} (DataID, LastTime, Updated) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE {}, Updated=VALUES(Updated)".format(FRESHNESS_TABLE, update)
+    owncursor = cursor is None
+    for attempt in range(2):
+        cur = db.db.cursor() if owncursor else cursor
+        try:
+            cur.executemany(sql, rows)
+            if owncursor:
+                db.db.commit()
+            return True
+        except Exception as e:
+            if debug:
+                print("freshness: update failed - {}".format(e))
+            if attempt == 0 and owncursor:
+                # most likely the index does not exist yet
+                try:
+                    create_freshness_table(db)
+                    continue
+                except Exception:
+                    pass
+            return False
+        finally:
+            if owncursor:
+                cur.close()
+    return False
+
+
+def update_freshness_from_stream(db, stream, tablename=None, debug=False):
+    """
+    DESCRIPTION
+        update the freshness index with the last timestamp of a (MagPy) DataStream written to tablename
+        (default: DataID of the stream header)
+    """
+    if not tablename:
+        tablename = stream.header.get('DataID')
+    try:
+        lasttime = stream.end()
+    except Exception:
+        lasttime = None
+    if not tablename or not lasttime:
+        return False
+    return update_freshness(db, {tablename: lasttime}, debug=debug)
+
+
+def read_freshness(db, debug=False):
+    """
+    DESCRIPTION
+        read all existing tables and the latest timestamps of the freshness index with a single query
+    RETURNS
+        tables (list), lasttimes (dict) - lasttimes is None if the index is not available,
+        tables is None if even information_schema is not accessible
+    """
+    cursor = db.db.cursor()
+    try:
+        try:
+            cursor.execute("SELECT t.TABLE_NAME, f.LastTime FROM information_schema.TABLES t "
+                           "LEFT JOIN {} f ON f.DataID = t.TABLE_NAME "
+                           "WHERE t.TABLE_SCHEMA = DATABASE()".format(FRESHNESS_TABLE))
+            result = cursor.fetchall()
+            tables = [el[0] for el in result]
+            lasttimes = {el[0]: el[1] for el in result if el[1] is not None}
+            return tables, lasttimes
+        except Exception as e:
+            if debug:
+                print("freshness: index not available - {}".format(e))
+        try:
+            cursor.execute("SELECT TABLE_NAME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()")
+            return [el[0] for el in cursor.fetchall()], None
+        except Exception as e:
+            if debug:
+                print("freshness: information_schema not available - {}".format(e))
+            return None, None
+    finally:
+        cursor.close()
+
+
+def _lasttime(db, table, debug=False):
+    cursor = db.db.cursor()
+    try:
+        cursor.execute("SELECT time FROM {} ORDER BY time DESC LIMIT 1".format(table))
+        value = cursor.fetchall()
+        if value and value[0][0]:
+            return value[0][0]
+    except Exception as e:
+        if debug:
+            print("freshness: could not read {} - {}".format(table, e))
+    finally:
+        cursor.close()
+    return None
+
+
+def scan_lasttimes(db, tables, connect=None, workers=4, debug=False):
+    """
+    DESCRIPTION
+        get the latest timestamp of each table. With a connect function (returning a new
+        database connection) the tables are scanned by a pool of workers, each keeping its own
+        connection for all its tables. Otherwise the tables are scanned one by one using db.
+    RETURNS
+        dictionary {table: datetime}
+    """
+    lasttimes = {}
+    if not tables:
+        return lasttimes
+    if not connect or workers <= 1 or len(tables) == 1:
+        for table in tables:
+            lasttime = _lasttime(db, table, debug=debug)
+            if lasttime:
+                lasttimes[table] = lasttime
+        return lasttimes
+
+    local = threading.local()
+    connections = []
+    lock = threading.Lock()
+
+    def scan(table):
+        conn = getattr(local, 'db', None)
+        if conn is None:
+            conn = connect()
+            local.db = conn
+            with lock:
+                connections.append(conn)
+        return table, _lasttime(conn, table, debug=debug)
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(workers, len(tables))) as executor:
+            for table, lasttime in executor.map(scan, tables):
+                if lasttime:
+                    lasttimes[table] = lasttime
+    finally:
+        for conn in connections:
+            try:
+                conn.db.close()
+            except Exception:
+                pass
+    return lasttimes
+
+
+def union_lasttimes(db, tables, batch=50, debug=False):
+    """
+    DESCRIPTION
+        get the latest timestamp of each table with UNION queries of MAX(time) in batches
+        (tables of a failing batch, e.g. without time column, are queried one by one)
+    RETURNS
+        dictionary {table: datetime}
+    """
+    lasttimes = {}
+    for i in range(0, len(tables), batch):
+        part = tables[i:i+batch]
+        cursor = db.db.cursor()
+        try:
+            try:
+                cursor.execute(" UNION ALL ".join("SELECT '{0}', MAX(time) FROM {0}".format(el) for el in part))
+                rows = cursor.fetchall()
+            except Exception:
+                rows = []
+                for el in part:
+                    try:
+                        cursor.execute("SELECT '{0}', MAX(time) FROM {0}".format(el))
+                        rows.extend(cursor.fetchall())
+                    except Exception as e:
+                        if debug:
+                            print("freshness: could not read {} - {}".format(el, e))
+            for table, lasttime in rows:
+                if lasttime:
+                    lasttimes[table] = lasttime
+        finally:
+            cursor.close()
+    return lasttimes
+
+
+def stale_tables(tables, lasttimes, maxage=None, now=None):
+    """
+    DESCRIPTION
+        tables whose latest time needs to be scanned: not contained in the index, invalid index
+        value or index value older than maxage seconds
+    VARIABLES
+        lasttimes   (dict) index values {table: datetime} (None: no index)
+        maxage      seconds or a function table -> seconds (None: outdated values are not scanned)
+    RETURNS
+        list of tables
+    """
+    if now is None:
+        now = _utcnow()
+    lasttimes = lasttimes or {}
+    stale = []
+    for table in tables:
+        lasttime = lasttimes.get(table)
+        if not valid_lasttime(lasttime):
+            stale.append(table)
+            continue
+        age = maxage(table) if callable(maxage) else maxage
+        if age is not None and (now - lasttime).total_seconds() > age:
+            stale.append(table)
+    return stale
+
+
+def store_scanned(db, scanned, lasttimes=None, debug=False):
+    """
+    DESCRIPTION
+        write scanned latest times into the index. A scan never lowers a newer index value,
+        only invalid (future) index values are replaced.
+    VARIABLES
+        scanned     (dict) {table: datetime} from scan_lasttimes or union_lasttimes
+        lasttimes   (dict) index values read before the scan
+    """
+    lasttimes = lasttimes or {}
+    invalid = {el: val for el, val in scanned.items() if el in lasttimes and not valid_lasttime(lasttimes.get(el))}
+    others = {el: val for el, val in scanned.items() if not el in invalid}
+    success = update_freshness(db, others, debug=debug)
+    if invalid:
+        success = update_freshness(db, invalid, replace=True, debug=debug) and success
+    return success
+
+
+def valid_lasttime(lasttime, tolerance=60):
+    """
+    DESCRIPTION
+        index values in the future (e.g. wrong clocks, deleted records) are not trusted
+    """
+    if not isinstance(lasttime, datetime):
+        return False
+    return lasttime <= _utcnow() + timedelta(seconds=tolerance)
+
+
+class TestFreshness(unittest.TestCase):
+    """
+    Test environment for the freshness index helpers
+    """
+
+    def test_valid_lasttime(self):
+        self.assertTrue(valid_lasttime(_utcnow() - timedelta(hours=1)))
+        self.assertFalse(valid_lasttime(_utcnow() + timedelta(hours=1)))
+        self.assertFalse(valid_lasttime(None))
+
+    def _db(self):
+        now = _utcnow().replace(microsecond=0)
+        times = {'A_0001': now - timedelta(minutes=1), 'B_0001': now - timedelta(hours=5), 'C_0001': now - timedelta(days=2)}
+        index = {'A_0001': now - timedelta(minutes=1), 'B_0001': now - timedelta(days=1)}
+        return _FakeDB(times, index), now
+
+    def test_read_freshness(self):
+        db, now = self._db()
+        tables, lasttimes = read_freshness(db)
+        self.assertEqual(tables, ['A_0001', 'B_0001', 'C_0001'])
+        self.assertEqual(sorted(lasttimes), ['A_0001', 'B_0001'])
+        db.indexexists = False
+        tables, lasttimes = read_freshness(db)
+        self.assertEqual(len(tables), 3)
+        self.assertIsNone(lasttimes)
+
+    def test_update_freshness(self):
+        db, now = self._db()
+        db.indexexists = False
+        # the missing index is created and the update repeated
+        self.assertTrue(update_freshness(db, {'C_0001': now}))
+        self.assertTrue(db.indexexists)
+        self.assertEqual(db.index.get('C_0001'), now)
+        # default: later timestamps win, replace overwrites
+        update_freshness(db, {'C_0001': now - timedelta(hours=1)})
+        self.assertEqual(db.index.get('C_0001'), now)
+        update_freshness(db, {'C_0001': now - timedelta(hours=1)}, replace=True)
+        self.assertEqual(db.index.get('C_0001'), now - timedelta(hours=1))
+        self.assertTrue(db.commits >= 3)
+
+    def test_scan_lasttimes(self):
+        db, now = self._db()
+        tables = ['A_0001', 'B_0001', 'C_0001', 'D_0001']
+        self.assertEqual(scan_lasttimes(db, tables), db.times)
+        connections = []
+        def connect():
+            conn = _FakeDB(db.times, {})
+            connections.append(conn)
+            return conn
+        self.assertEqual(scan_lasttimes(db, tables, connect=connect, workers=2), db.times)
+        self.assertTrue(0 < len(connections) <= 2)
+        self.assertTrue(all(conn.db.closed for conn in connections))
+        self.assertEqual(union_lasttimes(db, tables, batch=2), db.times)
+
+    def test_stale_tables(self):
+        db, now = self._db()
+        tables, lasttimes = read_freshness(db)
+        lasttimes['A_0001'] = now + timedelta(days=1)
+        # C is not indexed, A is invalid, B looks outdated (its writer does not update the index)
+        self.assertEqual(stale_tables(tables, lasttimes, maxage=3600, now=now), ['A_0001', 'B_0001', 'C_0001'])
+        self.assertEqual(stale_tables(tables, lasttimes, maxage=lambda t: 2*86400, now=now), ['A_0001', 'C_0001'])
+        db.index['A_0001'] = lasttimes['A_0001']
+        scanned = scan_lasttimes(db, tables)
+        store_scanned(db, scanned, lasttimes)
+        self.assertEqual(db.index.get('A_0001'), db.times.get('A_0001'))
+        self.assertEqual(db.index.get('B_0001'), db.times.get('B_0001'))
+        # a scan never lowers a newer index value
+        db.index['C_0001'] = now
+        store_scanned(db, {'C_0001': now - timedelta(days=2)}, {'C_0001': now})
+        self.assertEqual(db.index.get('C_0001'), now)
+
+
+class _FakeCursor(object):
+    """
+    minimal cursor answering the queries of this module from dictionaries
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.result = []
+
+    def execute(self, sql, params=None):
+        fakedb = self.db
+        if sql.startswith('CREATE TABLE'):
+            fakedb.indexexists = True
+            self.result = []
+        elif 'LEFT JOIN' in sql:
+            if not fakedb.indexexists:
+                raise Exception("Table DATAFRESHNESS doesn't exist")
+            self.result = [(el, fakedb.index.get(el)) for el in sorted(fakedb.times)]
+        elif 'information_schema.TABLES' in sql:
+            self.result = [(el,) for el in sorted(fakedb.times)]
+        elif 'ORDER BY time DESC LIMIT 1' in sql:
+            table = sql.split()[3]
+            if not table in fakedb.times:
+                raise Exception("Table {} doesn't exist".format(table))
+            self.result = [(fakedb.times.get(table),)]
+        elif 'MAX(time)' in sql:
+            self.result = []
+            for part in sql.split(' UNION ALL '):
+                table = part.split()[-1]
+                if not table in fakedb.times:
+                    raise Exception("Table {} doesn't exist".format(table))
+                self.result.append((table, fakedb.times.get(table)))
+        else:
+            raise Exception("unexpected query {}".format(sql))
+
+    def executemany(self, sql, rows):
+        fakedb = self.db
+        if not fakedb.indexexists:
+            raise Exception("Table DATAFRESHNESS doesn't exist")
+        for dataid, lasttime, updated in rows:
+            if 'GREATEST' in sql and fakedb.index.get(dataid):
+                lasttime = max(lasttime, fakedb.index.get(dataid))
+            fakedb.index[dataid] = lasttime
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class _FakeConnection(object):
+
+    def __init__(self, db):
+        self.fakedb = db
+        self.closed = False
+
+    def cursor(self):
+        return _FakeCursor(self.fakedb)
+
+    def commit(self):
+        self.fakedb.commits += 1
+
+    def close(self):
+        self.closed = True
+
+
+class _FakeDB(object):
+    """
+    stands in for a magpy DataBank - times are the latest times of the data tables, index the freshness index
+    """
+
+    def __init__(self, times, index):
+        self.times = dict(times)
+        self.index = dict(index)
+        self.indexexists = True
+        self.commits = 0
+        self.db = _FakeConnection(self)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Fixed capacity live data store for dashboards (used by web/pages/pMARTAS and pMARCOS).
+
+    Every sensor gets a LiveBuffer: a ring buffer with a datetime64 time column and one
+    preallocated NumPy column per element (float for numerical keys). Appending a sample is O(1)
+    and does not allocate. Each sample is written twice (at slot and slot+capacity), so the last
+    N samples are always a contiguous slice of the storage: "last N seconds" is returned as
+    zero-copy views in chronological order. Views are only valid until the buffer wraps around
+    (i.e. capacity appends later) - copy them if they need to be kept.
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+|  LiveBuffer     |  append    |  2.0.2 |      yes |  O(1), columns created on demand | -      | pMARTAS  |
+|  LiveBuffer     |  extend    |  2.0.2 |      yes |  vectorized, e.g. buffer files   | -      | pMARTAS, pMARCOS |
+|  LiveBuffer     |  last      |  2.0.2 |      yes |  zero-copy views of a time window | -     | pMARTAS  |
+|  LiveBuffer     |  samplingrate |  2.0.2 |   yes |  median period of recent samples | -      | pMARTAS  |
+
+"""
+
+import threading
+import unittest
+from datetime import datetime
+import numpy as np
+
+DEFAULT_CAPACITY = 36000
+
+
+def _missing(col):
+    if col.dtype.kind == 'M':
+        return np.datetime64('NaT')
+    if col.dtype == object:
+        return None
+    return np.nan
+
+
+class LiveBuffer(object):
+    """
+    DESCRIPTION
+        ring buffer for the live data of one sensor
+    VARIABLES
+        capacity   (int) amount of samples kept (36000: one hour of 10 Hz data)
+    APPLICATION
+        buf = LiveBuffer(36000)
+        buf.append(datetime(2025,1,1,0,0,0), {'x': 20000.1, 'y': 1.2})
+        times, columns = buf.last(seconds=600)
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = max(1, int(capacity))
+        self.times = np.full(2 * self.capacity, np.datetime64('NaT'), dtype='datetime64[us]')
+        self.columns = {}
+        self.head = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def _column(self, name, value):
+        col = self.columns.get(name)
+        if col is None:
+            if isinstance(value, datetime):
+                col = np.full(2 * self.capacity, np.datetime64('NaT'), dtype='datetime64[us]')
+            elif isinstance(value, (int, float, np.number)):
+                col = np.full(2 * self.capacity, np.nan)
+            else:
+                col = np.full(2 * self.capacity, None, dtype=object)
+            self.columns[name] = col
+        return col
+
+    def append(self, time, values):
+        """
+        DESCRIPTION
+            add one sample - values is a dictionary {name: value}
+        """
+        with self.lock:
+            slot = self.head
+            mirror = slot + self.capacity
+            self.times[slot] = self.times[mirror] = np.datetime64(time, 'us')
+            for name, col in self.columns.items():
+                if name not in values:
+                    # keep columns aligned if an element is missing in this sample
+                    col[slot] = col[mirror] = _missing(col)
+            for name, value in values.items():
+                col = self._column(name, value)
+                if col.dtype.kind == 'M':
+                    value = np.datetime64(value, 'us')
+                col[slot] = col[mirror] = value
+            self.head = (slot + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def extend(self, times, columns):
+        """
+        DESCRIPTION
+            add many samples at once (vectorized) - times is a sequence of datetimes, columns a
+            dictionary {name: sequence} of the same length
+        """
+        times = np.asarray(times, dtype='datetime64[us]')
+        n = len(times)
+        if not n:
+            return
+        skip = max(0, n - self.capacity)
+        times = times[skip:]
+        columns = {name: np.asarray(values)[skip:] for name, values in columns.items() if len(values) == n}
+        with self.lock:
+            slots = (self.head + np.arange(len(times))) % self.capacity
+            mirror = slots + self.capacity
+            self.times[slots] = times
+            self.times[mirror] = times
+            for name, col in self.columns.items():
+                if name not in columns:
+                    col[slots] = col[mirror] = _missing(col)
+            for name, values in columns.items():
+                first = values[0]
+                col = self._column(name, first.item() if isinstance(first, np.generic) else first)
+                if col.dtype.kind == 'M':
+                    values = values.astype('datetime64[us]')
+                col[slots] = values
+                col[mirror] = values
+            self.head = int((self.head + len(times)) % self.capacity)
+            self.count = min(self.count + len(times), self.capacity)
+
+    def last(self, seconds=None, amount=None):
+        """
+        DESCRIPTION
+            the latest samples as zero-copy views in chronological order
+        VARIABLES
+            seconds   (float) time window relative to the latest sample
+            amount    (int) maximal amount of samples
+        RETURNS
+            times (datetime64[us] array), dictionary {name: array}
+        """
+        with self.lock:
+            n = self.count if amount is None else max(0, min(int(amount), self.count))
+            end = self.head + self.capacity
+            start = end - n
+            times = self.times[start:end]
+            if seconds is not None and n > 0:
+                limit = times[-1] - np.timedelta64(int(seconds * 1000000), 'us')
+                start += int(np.searchsorted(times, limit, side='left'))
+                times = self.times[start:end]
+            return times, {name: col[start:end] for name, col in self.columns.items()}
+
+    def samplingrate(self, samples=100):
+        """
+        DESCRIPTION
+            median sampling period in seconds of the latest samples (None if less than 6 samples)
+        """
+        times, _ = self.last(amount=samples)
+        if len(times) < 6:
+            return None
+        return float(np.median(np.diff(times)) / np.timedelta64(1, 's'))
+
+
+class TestLiveBuffer(unittest.TestCase):
+    """
+    Test environment for the live buffer
+    """
+
+    def test_ring(self):
+        from datetime import timedelta
+        buf = LiveBuffer(5)
+        start = datetime(2025, 1, 1)
+        for i in range(8):
+            buf.append(start + timedelta(seconds=i), {'x': float(i)})
+        times, cols = buf.last()
+        self.assertEqual(len(buf), 5)
+        self.assertEqual(list(cols['x']), [3., 4., 5., 6., 7.])
+        self.assertTrue(np.all(np.diff(times) > np.timedelta64(0, 'us')))
+        times, cols = buf.last(seconds=2)
+        self.assertEqual(list(cols['x']), [5., 6., 7.])
+        # zero-copy view on the storage
+        self.assertTrue(np.shares_memory(cols['x'], buf.columns['x']))
+        self.assertEqual(buf.samplingrate(), None)
+        buf.extend([start + timedelta(seconds=10 + i) for i in range(10)], {'x': list(range(10)), 'y': list(range(10))})
+        times, cols = buf.last(amount=2)
+        self.assertEqual(list(cols['y']), [8., 9.])
+        buf = LiveBuffer(20)
+        buf.extend([start + timedelta(seconds=0.1 * i) for i in range(10)], {'x': list(range(10))})
+        self.assertAlmostEqual(buf.samplingrate(), 0.1)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Offset tracking log file watcher (used by monitor.check_logfile).
+
+    The inode, the byte offset and an incomplete last line are stored in a small json state
+    file between runs. Each run only reads the bytes appended since the last run, in chunks,
+    so memory does not depend on the size of the log. A changed inode (logrotate) or a file
+    smaller than the stored offset (truncation) restarts at the beginning of the file.
+    The last lines of a file are obtained by seeking backwards from its end.
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+|  LogWatcher     |  load      |  2.0.2 |      yes |  returns False without state     | -      | monitor  |
+|  LogWatcher     |  save      |  2.0.2 |      yes |                                  | -      | monitor  |
+|  LogWatcher     |  new_lines |  2.0.2 |      yes |  generator of appended lines     | -      | monitor  |
+|  LogWatcher     |  tail      |  2.0.2 |      yes |  last lines of the file          | -      | monitor  |
+
+"""
+
+import os
+import json
+import unittest
+
+
+class LogWatcher(object):
+    """
+    DESCRIPTION
+        reads lines appended to a log file since the last run
+    VARIABLES
+        logfile      (string) path of the log file
+        statefile    (string) json file with inode, offset and remainder
+        chunksize    (int) bytes read at once
+        maxline      (int) maximal length of a kept incomplete line
+    APPLICATION
+        watcher = LogWatcher('/var/log/magpy/marcos.log', '/tmp/monitor-marcos.log.state')
+        known = watcher.load()
+        for line in watcher.new_lines():
+            ...
+        watcher.save()
+    """
+
+    def __init__(self, logfile, statefile, chunksize=1048576, maxline=65536):
+        self.logfile = logfile
+        self.statefile = statefile
+        self.chunksize = chunksize
+        self.maxline = maxline
+        self.inode = None
+        self.offset = 0
+        self.remainder = ''
+        self.flags = {}
+        self.rotated = False
+
+    def load(self):
+        """
+        DESCRIPTION
+            read the state of the last run - returns False if no state is available
+        """
+        try:
+            with open(self.statefile, 'r') as f:
+                state = json.load(f)
+            self.inode = state.get('inode')
+            self.offset = int(state.get('offset', 0))
+            self.remainder = state.get('remainder', '')
+            self.flags = state.get('flags', {})
+            return True
+        except (OSError, ValueError, TypeError):
+            return False
+
+    def save(self):
+        state = {'inode': self.inode, 'offset': self.offset, 'remainder': self.remainder, 'flags': self.flags}
+        tmpfile = self.statefile + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmpfile, self.statefile)
+
+    def new_lines(self):
+        """
+        DESCRIPTION
+            generator of all complete lines appended since the last run (without line endings).
+            The state is updated while reading - call save afterwards.
+        """
+        with open(self.logfile, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if not st.st_ino == self.inode or st.st_size < self.offset:
+                # rotated or truncated: read the new file from the beginning
+                self.rotated = self.inode is not None
+                self.inode = st.st_ino
+                self.offset = 0
+                self.remainder = ''
+                self.flags = {}
+            f.seek(self.offset)
+            pending = self.remainder.encode('utf-8', 'replace')
+            while True:
+                chunk = f.read(self.chunksize)
+                if not chunk:
+                    break
+                self.offset += len(chunk)
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield line.rstrip(b'\r').decode('utf-8', 'replace')
+            # keep an incomplete last line for the next run (bounded)
+            self.remainder = pending[-self.maxline:].decode('utf-8', 'replace')
+
+    def tail(self, lines=2, blocksize=8192):
+        """
+        DESCRIPTION
+            returns the last lines of the log file by seeking backwards from its end
+        """
+        with open(self.logfile, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            data = b''
+            while position > 0 and data.count(b'\n') <= lines:
+                step = min(blocksize, position)
+                position -= step
+                f.seek(position)
+                data = f.read(step) + data
+        result = data.splitlines()[-lines:]
+        return [line.decode('utf-8', 'replace') for line in result]
+
+
+class TestLogWatcher(unittest.TestCase):
+    """
+    Test environment for the log watcher
+    """
+
+    def test_new_lines(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmpdir:
+            logfile = os.path.join(tmpdir, 'test.log')
+            statefile = os.path.join(tmpdir, 'test.state')
+            with open(logfile, 'w') as f:
+                f.write("line1\nline2\npart")
+            watcher = LogWatcher(logfile, statefile, chunksize=4)
+            self.assertFalse(watcher.load())
+            self.assertEqual(list(watcher.new_lines()), ['line1', 'line2'])
+            watcher.save()
+            with open(logfile, 'a') as f:
+                f.write("ial\nline4\n")
+            watcher = LogWatcher(logfile, statefile)
+            self.assertTrue(watcher.load())
+            self.assertEqual(list(watcher.new_lines()), ['partial', 'line4'])
+            self.assertEqual(watcher.tail(2, blocksize=3), ['partial', 'line4'])
+            watcher.save()
+            # rotation: a new file with the same name
+            os.remove(logfile)
+            with open(logfile, 'w') as f:
+                f.write("new1\n")
+            watcher = LogWatcher(logfile, statefile)
+            watcher.load()
+            self.assertEqual(list(watcher.new_lines()), ['new1'])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
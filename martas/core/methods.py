@@ -2,27 +2,19 @@
 # coding=utf-8
 
 import unittest
-from magpy.core import database
-from magpy.core import methods
-from magpy.opt import cred as cred
 import os
 import sys
 import glob
 from datetime import datetime, timezone, timedelta
-from dateutil.parser import parse
 #import dateutil.parser as dparser
 import paho.mqtt.client as mqtt
 import json
 import socket
 import configparser
-import requests
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email.utils import formatdate
-from email import encoders
-import pexpect
+from martas.core.bufferwriter import get_pool
+# magpy, dateutil, requests, pexpect and smtp/email modules are imported within the
+# methods using them - get_conf, get_sensors and data_to_file are needed at startup of
+# acquisition on small hosts and should not pull in heavy packages
 
 
 """
@@ -40,7 +32,7 @@ Methods:
 |                 |  check_conf  |  2.0.0 |      - |                                  | -      | basevalue, flags  |
 |                 |  connect_db  |  2.0.0 |    yes |                                  | -      | archive  |
 |                 |  datetime_to_array  |  2.0.0 |  yes |                             | -      | libs     |
-|                 |  data_to_file  |  2.0.0 |  yes |                                  | -      | libs     |
+|                 |  data_to_file  |  2.0.2 |  yes |  uses bufferwriter pool          | -      | libs     |
 |                 |  get_bool  |  2.0.0 |      yes |                                  | -      | archive,filter, f_down |
 |                 |  get_conf  |  2.0.0 |      yes |                                  | -      | marcosscripts |
 |                 |  get_json  |  2.0.0 |      yes |                                  | -      | file_upload |
@@ -139,6 +131,7 @@ def check_conf(config, startdate=None, enddate='now', varios=None, scalars=None,
     DESCRIPTION
         this method will extend/modify the configuration data with basevalue analysis specific parameters
     """
+    from dateutil.parser import parse
 
     if varios == None:
         varios = []
@@ -247,6 +240,8 @@ def check_conf(config, startdate=None, enddate='now', varios=None, scalars=None,
 
 
 def connect_db(mcred, exitonfailure=True, report=True):
+    from magpy.core import database
+    from magpy.opt import cred as cred
 
     db = None
     if report:
@@ -270,40 +265,12 @@ def datetime_to_array(t):
 
 
 def data_to_file(outputdir="", sensorid="", filedate="", bindata=None, header=None):
-    # File Operations
-    path = ""
-    try:
-        #hostname = socket.gethostname()
-        path = os.path.join(outputdir,sensorid)
-        # outputdir defined in main options class
-        if not os.path.exists(path):
-            os.makedirs(path)
-    except:
-        print ("buffer {}: bufferdirectory could not be created - check permissions".format(sensorid))
-    try:
-        fname = "{}_{}.bin".format(sensorid, filedate)
-        savefile = os.path.join(path, fname)
-        if sys.version_info>(3,0,0):
-            if not os.path.isfile(savefile):
-                with open(savefile, "wb") as myfile:
-                    head = "{}{}".format(header,"\n")
-                    myfile.write(head.encode('utf-8'))
-                    myfile.write(bindata)
-                    myfile.write("\n".encode('utf-8'))
-            else:
-                with open(savefile, "ab") as myfile:
-                    myfile.write(bindata)
-                    myfile.write("\n".encode('utf-8'))
-        else:
-            if not os.path.isfile(savefile):
-                with open(savefile, "wb") as myfile:
-                    myfile.write(header + "\n")
-                    myfile.write("{}{}".format(bindata,"\n"))
-            else:
-                with open(savefile, "a") as myfile:
-                    myfile.write("{}{}".format(bindata,"\n"))
-    except:
-        print("buffer {}: Error while saving file".format(sensorid))
+    """
+    DESCRIPTION
+        append a binary data record to the daily buffer file of a sensor.
+        File handles are kept open by the buffer writer pool (see core/bufferwriter.py)
+    """
+    get_pool().write(outputdir, sensorid, filedate, bindata, header="{}{}".format(header, "\n"))
 
 
 def get_bool(string):
@@ -313,6 +280,18 @@ def get_bool(string):
         return False
 
 
+def _is_number(s):
+    """
+    DESCRIPTION
+        True if s can be interpreted as a number (as magpy.core.methods.is_number)
+    """
+    try:
+        float(s)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
 def get_conf(path, confdict=None, debug=False):
     """
     Version 2020-10-28
@@ -339,7 +318,7 @@ def get_conf(path, confdict=None, debug=False):
                 if debug:
                     print ("Analyzing config-file line:", conf)
                 conflst = conf.split(':')
-                if conflst[0].strip() in exceptionlist or methods.is_number(conflst[0].strip()):
+                if conflst[0].strip() in exceptionlist or _is_number(conflst[0].strip()):
                     # define a list where : occurs in the value and is not a dictionary indicator
                     conflst = conf.split(':',1)
                 if conf.startswith('#'):
@@ -530,6 +509,7 @@ def scptransfer(src,dest,passwd,**kwargs):
     USED BY:
        cleanup
     """
+    import pexpect
     timeout = kwargs.get('timeout')
 
     COMMAND="scp -oPubKeyAuthentication=no %s %s" % (src, dest)
@@ -555,6 +535,13 @@ def sendmail(dic, credentials="webmail", debug=False):
     VARIABLES
         dic : dict with 'subject', 'from', 'to', 'text', 'attachment'
     """
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.base import MIMEBase
+    from email.mime.text import MIMEText
+    from email.utils import formatdate
+    from email import encoders
+    from magpy.opt import cred as cred
 
     if debug:
         print ("sendmail - input dictionary: ", dic)
@@ -632,6 +619,7 @@ def sendtelegram(message, configpath="", proxies=None, debug=True):
                                         "https" : "https://10.10.10.10:3128",
                                         }
     """
+    import requests
 
     if not proxies:
         proxies = {}
@@ -674,6 +662,7 @@ def sendtelegram2(messageblock, configpath="", proxies=None, debug=True):
         disable_notification  :  no sound on receiver side
 
     """
+    import requests
 
     if not proxies:
         proxies = {}
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Message pipeline decoupling MQTT network handling from data processing.
+
+    The MQTT on_message callback only enqueues (topic, payload, qos). Worker threads
+    consume bounded queues and call the actual message handler. Messages are
+    distributed to the workers by a routing key (the sensor id) so that the order of
+    messages is preserved for each sensor.
+
+    Overflow policies if a worker queue is full:
+        block        the callback waits until space is available (backpressure on the broker connection)
+        drop-oldest  the oldest queued message is discarded
+        spill        messages are appended to a spill file and processed in order
+                     after the queue has been drained
+
+    Configuration (marcos.cfg, all optional):
+        collectorworkers   :  1
+        collectorqueue     :  10000
+        collectoroverflow  :  block
+        collectorspillpath :  /tmp/marcos_spill
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+| MessagePipeline |  __init__  |  2.0.2 |      yes |                                  | -      |          |
+| MessagePipeline |  configure |  2.0.2 |      yes |                                  | -      | collector |
+| MessagePipeline |  start     |  2.0.2 |      yes |                                  | -      | collector |
+| MessagePipeline |  put       |  2.0.2 |      yes |  called by on_message            | -      | collector |
+| MessagePipeline |  stop      |  2.0.2 |      yes |                                  | -      | collector |
+| MessagePipeline |  status    |  2.0.2 |      yes |  backpressure metrics            | -      | collector |
+| MessagePipeline |  summary   |  2.0.2 |      yes |  status as log line              | -      | collector |
+
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import base64
+import threading
+import unittest
+import zlib
+
+OVERFLOW_POLICIES = ['block', 'drop-oldest', 'spill']
+
+
+class PipelineMessage(object):
+    """
+    DESCRIPTION
+        queued MQTT message - provides the attributes of paho's MQTTMessage used by the collector
+    """
+    __slots__ = ('topic', 'payload', 'qos', 'received')
+
+    def __init__(self, topic, payload, qos=0, received=None):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.received = received if received else time.time()
+
+    def dumps(self):
+        payload = self.payload
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        return json.dumps({'topic': self.topic, 'payload': base64.b64encode(payload).decode('ascii'),
+                           'qos': self.qos, 'received': self.received})
+
+    @classmethod
+    def loads(cls, line):
+        cont = json.loads(line)
+        return cls(cont.get('topic'), base64.b64decode(cont.get('payload')), cont.get('qos', 0), cont.get('received'))
+
+
+class _Worker(object):
+    """
+    DESCRIPTION
+        a worker thread with its own bounded queue and optional spill file
+    """
+
+    def __init__(self, number, pipeline):
+        self.number = number
+        self.pipeline = pipeline
+        self.queue = queue.Queue(maxsize=pipeline.maxsize)
+        self.lock = threading.Lock()
+        self.spilling = False
+        self.spillfile = os.path.join(pipeline.spillpath, "collector_spill_{}.json".format(number))
+        self.spillhandle = None
+        self.spillread = 0
+        self.thread = None
+        self.stats = {'enqueued': 0, 'processed': 0, 'dropped': 0, 'spilled': 0, 'errors': 0,
+                      'maxdepth': 0, 'maxwait': 0.0, 'meanwait': 0.0}
+
+    def put(self, msg):
+        policy = self.pipeline.overflow
+        with self.lock:
+            self.stats['enqueued'] += 1
+            if self.spilling:
+                self._spill(msg)
+                return
+            try:
+                self.queue.put_nowait(msg)
+                self.stats['maxdepth'] = max(self.stats['maxdepth'], self.queue.qsize())
+                return
+            except queue.Full:
+                pass
+            if policy == 'drop-oldest':
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                except queue.Empty:
+                    pass
+                self.stats['dropped'] += 1
+                if self.stats['dropped'] in [1, 10, 100] or self.stats['dropped'] % 1000 == 0:
+                    self.pipeline.report("pipeline worker {}: queue full - {} messages dropped".format(self.number, self.stats['dropped']))
+                self.queue.put_nowait(msg)
+                return
+            elif policy == 'spill':
+                self.spilling = True
+                self.pipeline.report("pipeline worker {}: queue full - spilling to {}".format(self.number, self.spillfile))
+                self._spill(msg)
+                return
+        # block: wait outside of the lock
+        self.queue.put(msg)
+
+    def _spill(self, msg):
+        if self.spillhandle is None:
+            if not os.path.isdir(self.pipeline.spillpath):
+                os.makedirs(self.pipeline.spillpath)
+            self.spillhandle = open(self.spillfile, 'a')
+            self.spillread = 0
+        self.spillhandle.write(msg.dumps() + "\n")
+        self.stats['spilled'] += 1
+
+    def _read_spill(self):
+        """
+        returns the next batch of spilled messages - finishes spilling if the file is exhausted
+        """
+        with self.lock:
+            self.spillhandle.flush()
+            with open(self.spillfile, 'r') as f:
+                f.seek(self.spillread)
+                lines = []
+                for i in range(self.pipeline.maxsize):
+                    line = f.readline()
+                    if not line:
+                        break
+                    lines.append(line)
+                self.spillread = f.tell()
+            if not lines:
+                self.spillhandle.close()
+                self.spillhandle = None
+                os.remove(self.spillfile)
+                self.spilling = False
+                self.pipeline.report("pipeline worker {}: spilled messages processed".format(self.number))
+        return [PipelineMessage.loads(line) for line in lines]
+
+    def _process(self, msg):
+        wait = time.time() - msg.received
+        stats = self.stats
+        stats['maxwait'] = max(stats['maxwait'], wait)
+        stats['processed'] += 1
+        stats['meanwait'] += (wait - stats['meanwait']) / stats['processed']
+        try:
+            self.pipeline.handler(msg)
+        except Exception as e:
+            stats['errors'] += 1
+            self.pipeline.report("pipeline worker {}: error while processing {} - {}".format(self.number, msg.topic, e))
+
+    def run(self):
+        while self.pipeline.running or self.spilling or not self.queue.empty():
+            try:
+                msg = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.spilling:
+                    for msg in self._read_spill():
+                        self._process(msg)
+                continue
+            self._process(msg)
+            self.queue.task_done()
+
+
+class MessagePipeline(object):
+    """
+    DESCRIPTION
+        bounded queue pipeline with worker threads
+    VARIABLES
+        handler     function called with each message (e.g. collector.process_message)
+        workers     (int) amount of worker threads
+        maxsize     (int) queue size of each worker
+        overflow    (string) block, drop-oldest or spill
+        spillpath   (string) directory for spill files
+        report      function used for log messages (default print)
+    """
+
+    def __init__(self, handler, workers=1, maxsize=10000, overflow='block', spillpath='/tmp/marcos_spill', report=None):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spillpath = spillpath
+        self.report = report if report else print
+        self.running = False
+        self.workerlist = []
+
+    def configure(self, conf):
+        """
+        DESCRIPTION
+            read pipeline parameters from a marcos configuration dictionary
+        """
+        try:
+            if not conf.get('collectorworkers', '') in ['', '-']:
+                self.workers = max(1, int(conf.get('collectorworkers')))
+            if not conf.get('collectorqueue', '') in ['', '-']:
+                self.maxsize = max(1, int(conf.get('collectorqueue')))
+        except (TypeError, ValueError):
+            self.report("pipeline: invalid worker or queue size - using {} workers and {} messages".format(self.workers, self.maxsize))
+        overflow = conf.get('collectoroverflow', '')
+        if overflow not in ['', '-']:
+            if overflow.strip() in OVERFLOW_POLICIES:
+                self.overflow = overflow.strip()
+            else:
+                self.report("pipeline: unknown overflow policy {} - use one of {}".format(overflow, OVERFLOW_POLICIES))
+        if not conf.get('collectorspillpath', '') in ['', '-']:
+            self.spillpath = conf.get('collectorspillpath').strip()
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.workerlist = [_Worker(i, self) for i in range(self.workers)]
+        for worker in self.workerlist:
+            worker.thread = threading.Thread(target=worker.run, name="CollectorWorker{}".format(worker.number))
+            worker.thread.daemon = True
+            worker.thread.start()
+        # process queued messages before the interpreter exits (worker threads are daemons)
+        atexit.register(self.stop)
+
+    def stop(self, timeout=10.0):
+        """
+        DESCRIPTION
+            stop accepting messages and wait for the workers to process their queues
+        """
+        if not self.running:
+            return
+        self.running = False
+        for worker in self.workerlist:
+            if worker.thread:
+                worker.thread.join(timeout=timeout)
+
+    def put(self, topic, payload, qos=0, key=None):
+        """
+        DESCRIPTION
+            enqueue a message. Messages with identical key (e.g. sensorid) are
+            always handled by the same worker thread and therefore in order.
+        """
+        if not self.workerlist:
+            return
+        msg = PipelineMessage(topic, payload, qos)
+        if key is None:
+            key = topic
+        if len(self.workerlist) == 1:
+            worker = self.workerlist[0]
+        else:
+            worker = self.workerlist[zlib.crc32(key.encode('utf-8')) % len(self.workerlist)]
+        worker.put(msg)
+
+    def status(self):
+        """
+        DESCRIPTION
+            returns queue depth and backpressure statistics for each worker
+        """
+        status = {}
+        for worker in self.workerlist:
+            stat = dict(worker.stats)
+            stat['depth'] = worker.queue.qsize()
+            stat['spilling'] = worker.spilling
+            status[worker.number] = stat
+        return status
+
+    def summary(self):
+        """
+        DESCRIPTION
+            one line summary of status() for log files
+        """
+        status = self.status()
+        total = lambda key: sum([stat.get(key, 0) for stat in status.values()])
+        maxwait = max([stat.get('maxwait', 0.) for stat in status.values()] + [0.])
+        return "{} queued, {} processed, {} dropped, {} spilled, {} errors, max wait {:.3f} sec{}".format(
+            total('depth'), total('processed'), total('dropped'), total('spilled'), total('errors'), maxwait,
+            ", spilling" if any([stat.get('spilling') for stat in status.values()]) else "")
+
+
+class TestMessagePipeline(unittest.TestCase):
+    """
+    Test environment for the message pipeline
+    """
+
+    def test_order(self):
+        received = []
+        pipe = MessagePipeline(lambda msg: received.append(msg.payload), workers=3, maxsize=100)
+        pipe.start()
+        for i in range(50):
+            pipe.put("wic/SENSOR_1_0001/data", i, key="SENSOR_1_0001")
+        pipe.stop()
+        self.assertEqual(received, list(range(50)))
+
+    def test_drop_oldest(self):
+        received = []
+        gate = threading.Event()
+        pipe = MessagePipeline(lambda msg: (gate.wait(), received.append(msg.payload)), maxsize=5, overflow='drop-oldest', report=lambda x: None)
+        pipe.start()
+        for i in range(20):
+            pipe.put("wic/S/data", i)
+        gate.set()
+        pipe.stop()
+        self.assertGreater(pipe.status()[0]['dropped'], 0)
+        self.assertEqual(received[-1], 19)
+        self.assertIn("dropped", pipe.summary())
+
+    def test_stop_processes_queue(self):
+        received = []
+        pipe = MessagePipeline(lambda msg: (time.sleep(0.001), received.append(msg.payload)), maxsize=500)
+        pipe.start()
+        for i in range(200):
+            pipe.put("wic/S/data", i)
+        # messages still queued at shutdown are processed
+        pipe.stop()
+        pipe.stop()
+        self.assertEqual(len(received), 200)
+        self.assertTrue(pipe.summary().startswith("0 queued, 200 processed"))
+
+    def test_spill(self):
+        import tempfile
+        import shutil
+        tmpdir = tempfile.mkdtemp()
+        received = []
+        gate = threading.Event()
+        pipe = MessagePipeline(lambda msg: (gate.wait(), received.append(msg.payload)), maxsize=5, overflow='spill', spillpath=tmpdir, report=lambda x: None)
+        pipe.start()
+        for i in range(30):
+            pipe.put("wic/S/data", "{}".format(i))
+        gate.set()
+        time.sleep(2.0)
+        pipe.stop()
+        shutil.rmtree(tmpdir)
+        self.assertEqual([int(el) for el in received], list(range(30)))
+        self.assertGreater(pipe.status()[0]['spilled'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
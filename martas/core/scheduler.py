@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Periodic job scheduler for active acquisition protocols.
+
+    All periodic requests (e.g. sendRequest of active protocols) are scheduled by a
+    single asyncio event loop running in one long-lived thread. Deadlines are absolute
+    (start + n * interval) so timing does not drift with load. The blocking requests are
+    executed in a small pool of persistent worker threads. For every job the scheduler
+    records jitter (delay of the actual start against the deadline), execution times and
+    overruns (a request lasting longer than the interval - missed ticks are skipped).
+
+    Configuration (martas.cfg, all optional):
+        schedulerworkers   :  4       # threads executing requests
+        schedulerstatus    :  3600    # seconds between status reports in the log (0: off)
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+|  Scheduler      |  __init__  |  2.0.2 |      yes |                                  | -      |          |
+|  Scheduler      |  configure |  2.0.2 |      yes |                                  | -      | acquisition |
+|  Scheduler      |  add       |  2.0.2 |      yes |                                  | -      | acquisition |
+|  Scheduler      |  start     |  2.0.2 |      yes |                                  | -      | acquisition |
+|  Scheduler      |  stop      |  2.0.2 |      yes |                                  | -      |          |
+|  Scheduler      |  status    |  2.0.2 |      yes |  jitter and overrun statistics   | -      |          |
+|                 |  get_scheduler | 2.0.2 |    yes |                                  | -      | acquisition |
+
+"""
+
+import math
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _Job(object):
+    """
+    DESCRIPTION
+        a periodic job and its timing statistics (seconds)
+    """
+    __slots__ = ('name', 'interval', 'func', 'iterations', 'runs', 'errors', 'overruns', 'skipped',
+                 'jittermean', 'jittermax', 'jitterm2', 'durationmax', 'lastrun')
+
+    def __init__(self, name, interval, func, iterations=0):
+        self.name = name
+        self.interval = float(interval)
+        self.func = func
+        self.iterations = iterations
+        self.runs = 0
+        self.errors = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.jittermean = 0.0
+        self.jittermax = 0.0
+        self.jitterm2 = 0.0
+        self.durationmax = 0.0
+        self.lastrun = None
+
+    def record(self, jitter, duration):
+        # running mean and variance (Welford)
+        self.runs += 1
+        delta = jitter - self.jittermean
+        self.jittermean += delta / self.runs
+        self.jitterm2 += delta * (jitter - self.jittermean)
+        self.jittermax = max(self.jittermax, jitter)
+        self.durationmax = max(self.durationmax, duration)
+
+    def status(self):
+        return {'interval': self.interval, 'runs': self.runs, 'errors': self.errors,
+                'overruns': self.overruns, 'skipped': self.skipped,
+                'jittermean': self.jittermean, 'jittermax': self.jittermax,
+                'jitterstd': math.sqrt(self.jitterm2 / self.runs) if self.runs > 1 else 0.0,
+                'durationmax': self.durationmax, 'lastrun': self.lastrun}
+
+
+class Scheduler(object):
+    """
+    DESCRIPTION
+        drift free periodic scheduler based on a single asyncio loop
+    VARIABLES
+        workers         (int) threads executing the (blocking) job functions
+        statusinterval  (float) seconds between status reports (0 disables reports)
+        report          function used for log messages (default print)
+    """
+
+    def __init__(self, workers=4, statusinterval=3600., report=None):
+        self.workers = workers
+        self.statusinterval = statusinterval
+        self.report = report if report else print
+        self.jobs = {}
+        self.loop = None
+        self.thread = None
+        self.executor = None
+        self.running = False
+
+    def configure(self, conf):
+        """
+        DESCRIPTION
+            read scheduler parameters from a martas configuration dictionary
+        """
+        try:
+            if not conf.get('schedulerworkers', '') in ['', '-']:
+                self.workers = max(1, int(conf.get('schedulerworkers')))
+            if not conf.get('schedulerstatus', '') in ['', '-']:
+                self.statusinterval = max(0., float(conf.get('schedulerstatus')))
+        except (TypeError, ValueError):
+            self.report("scheduler: invalid parameters - using {} workers".format(self.workers))
+
+    def add(self, name, interval, func, iterations=0):
+        """
+        DESCRIPTION
+            call func every interval seconds (iterations=0: forever). The first call is done immediately.
+            Jobs added to a running scheduler are started right away.
+        """
+        if name in self.jobs:
+            name = "{}_{}".format(name, len(self.jobs))
+        job = _Job(name, interval, func, iterations=iterations)
+        self.jobs[name] = job
+        if self.running:
+            asyncio.run_coroutine_threadsafe(self._run(job), self.loop)
+        return job
+
+    async def _run(self, job):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        n = 0
+        deadline = start
+        while self.running:
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            began = loop.time()
+            try:
+                await loop.run_in_executor(self.executor, job.func)
+            except Exception as e:
+                job.errors += 1
+                if job.errors in [1, 10, 100] or job.errors % 1000 == 0:
+                    self.report("scheduler: {} failed ({} errors) - {}".format(job.name, job.errors, e))
+            end = loop.time()
+            job.record(began - deadline, end - began)
+            job.lastrun = end
+            n += 1
+            if job.iterations and n >= job.iterations:
+                break
+            deadline = start + n * job.interval
+            if end > deadline:
+                # overrun: the request lasted longer than the interval - skip missed ticks
+                missed = int((end - deadline) // job.interval) + 1
+                job.overruns += 1
+                job.skipped += missed
+                if job.overruns in [1, 10, 100] or job.overruns % 1000 == 0:
+                    self.report("scheduler: {} overrun ({} overruns) - request took {:.3f} sec at an interval of {} sec".format(job.name, job.overruns, end - began, job.interval))
+                n += missed
+                deadline = start + n * job.interval
+
+    async def _status(self):
+        while self.running and self.statusinterval > 0:
+            await asyncio.sleep(self.statusinterval)
+            for name, stat in self.status().items():
+                self.report("scheduler: {} - runs {}, overruns {}, skipped {}, jitter mean {:.4f} max {:.4f} std {:.4f} sec".format(name, stat['runs'], stat['overruns'], stat['skipped'], stat['jittermean'], stat['jittermax'], stat['jitterstd']))
+
+    def _loop(self):
+        asyncio.set_event_loop(self.loop)
+        for job in list(self.jobs.values()):
+            self.loop.create_task(self._run(job))
+        self.loop.create_task(self._status())
+        self.loop.run_forever()
+
+    def start(self):
+        """
+        DESCRIPTION
+            start the scheduler thread
+        """
+        if self.running:
+            return
+        self.running = True
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="SchedulerWorker")
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._loop, name="Scheduler")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=5.0):
+        if not self.running:
+            return
+        self.running = False
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=timeout)
+        self.executor.shutdown(wait=False)
+
+    def status(self):
+        """
+        DESCRIPTION
+            returns a dictionary with timing statistics of all jobs
+        """
+        return {name: job.status() for name, job in list(self.jobs.items())}
+
+
+_scheduler = None
+
+
+def get_scheduler():
+    """
+    DESCRIPTION
+        returns the process wide scheduler
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = Scheduler()
+    return _scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    """
+    Test environment for the scheduler
+    """
+
+    def test_iterations(self):
+        import time
+        calls = []
+        sched = Scheduler(statusinterval=0)
+        sched.add("test", 0.05, lambda: calls.append(time.monotonic()), iterations=5)
+        sched.start()
+        time.sleep(0.5)
+        sched.stop()
+        self.assertEqual(len(calls), 5)
+        # absolute deadlines: no accumulated drift
+        self.assertLess(abs((calls[-1] - calls[0]) - 0.2), 0.04)
+        self.assertEqual(sched.status()['test']['runs'], 5)
+
+    def test_overrun(self):
+        import time
+        sched = Scheduler(statusinterval=0, report=lambda x: None)
+        sched.add("slow", 0.05, lambda: time.sleep(0.12), iterations=3)
+        sched.start()
+        time.sleep(0.6)
+        sched.stop()
+        stat = sched.status()['slow']
+        self.assertGreater(stat['overruns'], 0)
+        self.assertGreater(stat['skipped'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Columnar store for spectral time series (used by app/gamma.py).
+
+    All spectra of a sensor are kept in one binary file "<SensorID>.spec" of fixed size records
+    (mean time, start time, end time, sampling rate and the uint32 counts of all channels).
+    The file is memory-mapped for reading: the time index (datetime64[us]) and the 2-D counts
+    array (time x channel) are views on the file and time ranges are sliced by binary search
+    without parsing anything. New records are appended in place; records with already existing
+    times are dropped. Records older than the last stored one trigger a single sorted rewrite.
+    Sensor information (SensorID, SensorName, channels, ...) is stored in "<SensorID>_spec.json".
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+|                 |  record_dtype |  2.0.2 |   yes |  record layout for n channels    | -      |          |
+|                 |  make_records |  2.0.2 |   yes |  arrays to records               | -      | gamma    |
+|  SpectralStore  |  append    |  2.0.2 |      yes |  in place, drops duplicate times | -      | gamma    |
+|  SpectralStore  |  data      |  2.0.2 |      yes |  memory-mapped records           | -      | gamma    |
+|  SpectralStore  |  read      |  2.0.2 |      yes |  time range slice (zero-copy)    | -      | gamma    |
+|  SpectralStore  |  timerange |  2.0.2 |      yes |                                  | -      | gamma    |
+
+"""
+
+import os
+import json
+import unittest
+import numpy as np
+
+DEFAULT_CHANNELS = 1024
+
+
+def record_dtype(channels=DEFAULT_CHANNELS):
+    """
+    DESCRIPTION
+        layout of a single spectrum record
+    """
+    return np.dtype([('time', '<M8[us]'), ('starttime', '<M8[us]'), ('endtime', '<M8[us]'),
+                     ('samplingrate', '<f8'), ('counts', '<u4', (int(channels),))])
+
+
+def make_records(times, counts, starttimes=None, endtimes=None, samplingrates=None, channels=DEFAULT_CHANNELS):
+    """
+    DESCRIPTION
+        combine arrays into records sorted by time
+    VARIABLES
+        times          sequence of datetimes or ISO strings (mean time of each spectrum)
+        counts         sequence of channel counts - shorter spectra are padded with zeros
+        starttimes     optional, sequence like times
+        endtimes       optional, sequence like times
+        samplingrates  optional, sequence of floats (invalid values become NaN)
+    """
+    n = len(times)
+    records = np.zeros(n, dtype=record_dtype(channels))
+    records['time'] = np.asarray(times, dtype='datetime64[us]')
+    records['starttime'] = np.asarray(starttimes, dtype='datetime64[us]') if starttimes is not None else np.datetime64('NaT')
+    records['endtime'] = np.asarray(endtimes, dtype='datetime64[us]') if endtimes is not None else np.datetime64('NaT')
+    records['samplingrate'] = np.nan
+    if samplingrates is not None:
+        for i, sr in enumerate(samplingrates):
+            try:
+                records['samplingrate'][i] = float(sr)
+            except (TypeError, ValueError):
+                pass
+    for i, spectrum in enumerate(counts):
+        spectrum = np.asarray(spectrum)[:channels]
+        records['counts'][i, :len(spectrum)] = spectrum
+    return records[np.argsort(records['time'], kind='stable')]
+
+
+class SpectralStore(object):
+    """
+    DESCRIPTION
+        memory-mapped, append-only store of the spectra of one sensor
+    VARIABLES
+        path       directory of the store
+        sensorid   (string) SensorID - can be omitted if the directory contains a single store
+        header     (dict) sensor information stored with a new store
+        channels   (int) amount of channels of a new store
+    APPLICATION
+        store = SpectralStore('/srv/archive/DIGIBASE', 'DIGIBASE_16272059_0001', header={'SensorName': 'DIGIBASE'})
+        store.append(make_records(times, counts))
+        records = store.read(datetime(2025,1,1), datetime(2025,1,2))
+        matrix = records['counts']   # (time x channel) view on the file
+    """
+
+    def __init__(self, path, sensorid=None, header=None, channels=DEFAULT_CHANNELS):
+        if not sensorid:
+            stores = sorted(el for el in os.listdir(path) if el.endswith('.spec'))
+            if not len(stores) == 1:
+                raise ValueError("{} spectral stores found in {} - please provide a sensorid".format(len(stores), path))
+            sensorid = stores[0][:-5]
+        self.sensorid = sensorid
+        self.datapath = os.path.join(path, "{}.spec".format(sensorid))
+        self.headerpath = os.path.join(path, "{}_spec.json".format(sensorid))
+        if os.path.isfile(self.headerpath):
+            with open(self.headerpath, 'r') as infile:
+                self.header = json.load(infile)
+        else:
+            self.header = dict(header or {})
+            self.header['SensorID'] = sensorid
+            self.header['channels'] = int(self.header.get('channels', channels))
+            self.header.setdefault('DataType', 'SpectralTimeseries')
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(self.headerpath, 'w') as outfile:
+                json.dump(self.header, outfile)
+        self.channels = int(self.header.get('channels'))
+        self.dtype = record_dtype(self.channels)
+
+    def __len__(self):
+        if not os.path.isfile(self.datapath):
+            return 0
+        # an incomplete trailing record (interrupted write) is ignored
+        return os.path.getsize(self.datapath) // self.dtype.itemsize
+
+    def data(self):
+        """
+        DESCRIPTION
+            all records as read-only memory map
+        """
+        n = len(self)
+        if not n:
+            return np.zeros(0, dtype=self.dtype)
+        return np.memmap(self.datapath, dtype=self.dtype, mode='r', shape=(n,))
+
+    def timerange(self):
+        """
+        DESCRIPTION
+            first and last time (datetime64) or None, None for an empty store
+        """
+        data = self.data()
+        if not len(data):
+            return None, None
+        return data['time'][0], data['time'][-1]
+
+    def read(self, starttime=None, endtime=None):
+        """
+        DESCRIPTION
+            records with starttime <= time < endtime as view on the memory map
+        """
+        data = self.data()
+        times = data['time']
+        start = 0 if starttime is None else int(np.searchsorted(times, np.datetime64(starttime, 'us'), side='left'))
+        end = len(times) if endtime is None else int(np.searchsorted(times, np.datetime64(endtime, 'us'), side='left'))
+        return data[start:end]
+
+    def append(self, records):
+        """
+        DESCRIPTION
+            add records (see make_records) - records with already stored times are dropped
+        RETURNS
+            amount of added records
+        """
+        records = np.asarray(records, dtype=self.dtype)
+        if not len(records):
+            return 0
+        records = records[np.argsort(records['time'], kind='stable')]
+        _, first = np.unique(records['time'], return_index=True)
+        records = records[first]
+        n = len(self)
+        existing = self.data()
+        if n and not records['time'][0] > existing['time'][-1]:
+            records = records[~np.isin(records['time'], existing['time'])]
+            if not len(records):
+                return 0
+            if not records['time'][0] > existing['time'][-1]:
+                # older records: rewrite the store once in time order
+                merged = np.concatenate((np.array(existing), records))
+                merged = merged[np.argsort(merged['time'], kind='stable')]
+                del existing
+                tmppath = self.datapath + '.tmp'
+                with open(tmppath, 'wb') as outfile:
+                    outfile.write(merged.tobytes())
+                os.replace(tmppath, self.datapath)
+                return len(records)
+        del existing
+        if os.path.isfile(self.datapath) and not os.path.getsize(self.datapath) == n * self.dtype.itemsize:
+            with open(self.datapath, 'r+b') as outfile:
+                outfile.truncate(n * self.dtype.itemsize)
+        with open(self.datapath, 'ab') as outfile:
+            outfile.write(records.tobytes())
+        return len(records)
+
+
+class TestSpectralStore(unittest.TestCase):
+    """
+    Test environment for the spectral store
+    """
+
+    def test_store(self):
+        import tempfile
+        from datetime import datetime
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = SpectralStore(tmpdir, 'DIGIBASE_1_0001', header={'SensorName': 'DIGIBASE'}, channels=8)
+            times = ['2025-01-01T{:02d}:30:00'.format(h) for h in range(0, 24, 2)]
+            counts = [[h] * 8 for h in range(12)]
+            self.assertEqual(store.append(make_records(times, counts, channels=8)), 12)
+            # duplicates are dropped, older records are sorted in
+            self.assertEqual(store.append(make_records(times[:2] + ['2025-01-01T01:30:00'], [[1] * 5] * 3, channels=8)), 1)
+            self.assertEqual(store.append(make_records(['2025-01-02T00:30:00'], [[7] * 8], channels=8)), 1)
+            store = SpectralStore(tmpdir)
+            self.assertEqual(len(store), 14)
+            self.assertEqual(store.header.get('SensorName'), 'DIGIBASE')
+            records = store.read(datetime(2025, 1, 1, 1), datetime(2025, 1, 1, 5))
+            self.assertEqual(records['counts'].shape, (3, 8))
+            self.assertEqual(list(records['counts'][0]), [1, 1, 1, 1, 1, 0, 0, 0])
+            self.assertTrue(np.all(np.diff(store.data()['time']) > np.timedelta64(0, 'us')))
+            self.assertEqual(store.timerange()[1], np.datetime64('2025-01-02T00:30:00', 'us'))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Startup profiling for MARTAS and MARCOS processes.
+
+    When enabled (option --profile-startup of acquisition and collector) every import
+    is timed by wrapping builtins.__import__ (similar to python -X importtime) and
+    milestones like 'configuration loaded' or 'first sample' are recorded relative to
+    the start of the process. The report lists the milestones and the modules with the
+    largest import times.
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+| StartupProfiler |  enable    |  2.0.2 |      yes |                                  | -      | acquisition, collector |
+| StartupProfiler |  disable   |  2.0.2 |      yes |                                  | -      |          |
+| StartupProfiler |  mark      |  2.0.2 |      yes |  record a milestone              | -      | acquisition, collector |
+| StartupProfiler |  report    |  2.0.2 |      yes |  milestone and import report     | -      | acquisition, collector |
+
+"""
+
+import sys
+import time
+import builtins
+import unittest
+
+
+class StartupProfiler(object):
+    """
+    DESCRIPTION
+        records import times per module and startup milestones
+    VARIABLES
+        enabled   (bool) start timing imports immediately
+    APPLICATION
+        profiler = StartupProfiler(enabled='--profile-startup' in sys.argv)
+        import heavymodule
+        profiler.mark("imports done")
+        print(profiler.report())
+    """
+
+    def __init__(self, enabled=False):
+        self.start = time.perf_counter()
+        self.enabled = False
+        self.imports = {}
+        self.milestones = []
+        self.reported = False
+        self._stack = []
+        self._original = None
+        if enabled:
+            self.enable()
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self._original = builtins.__import__
+        builtins.__import__ = self._import
+
+    def disable(self):
+        if not self.enabled:
+            return
+        builtins.__import__ = self._original
+        self.enabled = False
+
+    def _import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level > 0 or name in sys.modules:
+            # relative imports and already loaded modules are cheap
+            return self._original(name, globals, locals, fromlist, level)
+        self._stack.append(0.0)
+        t0 = time.perf_counter()
+        try:
+            return self._original(name, globals, locals, fromlist, level)
+        finally:
+            total = time.perf_counter() - t0
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += total
+            cum, own = self.imports.get(name, (0.0, 0.0))
+            self.imports[name] = (cum + total, own + total - children)
+
+    def mark(self, label):
+        """
+        DESCRIPTION
+            record a milestone (seconds since profiler creation)
+        """
+        if self.enabled:
+            self.milestones.append((label, time.perf_counter() - self.start))
+
+    def report(self, top=25):
+        """
+        DESCRIPTION
+            returns a text report with milestones and the slowest imports (self and cumulative time)
+        """
+        lines = ["Startup profile ({} modules imported)".format(len(self.imports))]
+        for label, elapsed in self.milestones:
+            lines.append("  {:8.3f} sec  {}".format(elapsed, label))
+        lines.append("  Slowest imports:      self [sec]   cumulative [sec]")
+        ranking = sorted(self.imports.items(), key=lambda el: el[1][1], reverse=True)
+        for name, (cum, own) in ranking[:top]:
+            lines.append("  {:30s} {:8.3f}   {:8.3f}".format(name, own, cum))
+        self.reported = True
+        return "\n".join(lines)
+
+
+class TestStartupProfiler(unittest.TestCase):
+    """
+    Test environment for the startup profiler
+    """
+
+    def test_profile(self):
+        sys.modules.pop('colorsys', None)
+        profiler = StartupProfiler(enabled=True)
+        try:
+            import colorsys
+            profiler.mark("imported")
+        finally:
+            profiler.disable()
+        self.assertIn('colorsys', profiler.imports)
+        self.assertEqual(profiler.milestones[0][0], "imported")
+        self.assertIn("colorsys", profiler.report())
+        self.assertIs(builtins.__import__, profiler._original)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
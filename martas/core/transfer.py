@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Transfer engine for downloading many files from a remote host (used by file_download).
+
+    FTP and SFTP downloads are distributed over a pool of worker threads. Each host has a pool
+    of persistent sessions which are reused for all files (login once per session). Files which
+    are already complete on the local disk (same size) are skipped, partially downloaded files
+    are resumed (FTP REST, SFTP seek). New downloads are written to "<name>.part" and renamed
+    when complete. rsync transfers are batched into one rsync call per destination directory
+    using a file list (--files-from), with --partial for resuming.
+
+    SFTP requires the optional paramiko package. Without paramiko scp transfers fall back to
+    one scp call per file (martas.core.methods.scptransfer), executed in parallel.
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+|  SessionPool    |  session   |  2.0.2 |       -  |  context manager, reuses sessions | -     | file_download |
+|  SessionPool    |  close     |  2.0.2 |       -  |                                  | -      | file_download |
+|                 |  local_state |  2.0.2 |    yes |  skip/resume decision by size    | -      |          |
+|                 |  ftp_download |  2.0.2 |     - |  resumable                       | -      |          |
+|                 |  sftp_download |  2.0.2 |    - |  resumable, requires paramiko    | -      |          |
+|                 |  rsync_commands |  2.0.2 |  yes |  one call per destination       | -      |          |
+|                 |  download_files |  2.0.2 |    - |  parallel transfers              | -      | file_download |
+
+"""
+
+import os
+import queue
+import tempfile
+import threading
+import subprocess
+import unittest
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import paramiko
+    paramiko_available = True
+except ImportError:
+    paramiko_available = False
+
+
+class SessionPool(object):
+    """
+    DESCRIPTION
+        pool of persistent sessions to one host. Sessions are created on demand (at most size)
+        and returned to the pool after use. Sessions raising an error are closed and replaced.
+    VARIABLES
+        connect   function returning a new session
+        close     function closing a session
+        size      (int) maximal amount of sessions
+    APPLICATION
+        pool = SessionPool(lambda: ftp_connect(address, port, user, password, source), size=4)
+        with pool.session() as ftp:
+            ftp_download(ftp, 'remote.bin', '/tmp/remote.bin')
+        pool.close()
+    """
+
+    def __init__(self, connect, close=None, size=4):
+        self.connect = connect
+        self.closefunc = close
+        self.size = max(1, int(size))
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.available = threading.Semaphore(self.size)
+
+    @contextmanager
+    def session(self):
+        with self.available:
+            try:
+                sess = self.idle.get_nowait()
+            except queue.Empty:
+                sess = self.connect()
+                with self.lock:
+                    self.created += 1
+            try:
+                yield sess
+            except Exception:
+                self._close(sess)
+                raise
+            else:
+                self.idle.put(sess)
+
+    def _close(self, sess):
+        try:
+            if self.closefunc:
+                self.closefunc(sess)
+        except Exception:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                self._close(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+def local_state(destname, remotesize):
+    """
+    DESCRIPTION
+        decides whether a file needs to be downloaded
+    RETURNS
+        'skip' (complete), 'resume' (partial file smaller than remote) or 'new', and the offset
+    """
+    partname = destname + '.part'
+    if remotesize is not None and os.path.isfile(destname) and os.path.getsize(destname) == remotesize:
+        return 'skip', remotesize
+    if remotesize is not None and os.path.isfile(partname):
+        size = os.path.getsize(partname)
+        if 0 < size < remotesize:
+            return 'resume', size
+    return 'new', 0
+
+
+def ftp_connect(address, port=21, user='', password='', cwd=None, timeout=60):
+    import ftplib
+    ftp = ftplib.FTP(timeout=timeout)
+    ftp.connect(address, port)
+    ftp.login(user, password)
+    ftp.voidcmd('TYPE I')
+    if cwd:
+        ftp.cwd(cwd)
+    return ftp
+
+
+def ftp_close(ftp):
+    try:
+        ftp.quit()
+    except Exception:
+        ftp.close()
+
+
+def ftp_download(ftp, remote, destname, delete=False):
+    """
+    DESCRIPTION
+        download a single file using an open ftp session (resumes partial downloads)
+    RETURNS
+        'skip', 'resume' or 'new'
+    """
+    try:
+        remotesize = ftp.size(remote)
+    except Exception:
+        remotesize = None
+    state, offset = local_state(destname, remotesize)
+    if not state == 'skip':
+        partname = destname + '.part'
+        with open(partname, 'ab' if offset else 'wb') as fhandle:
+            ftp.retrbinary('RETR ' + remote, fhandle.write, rest=offset or None)
+        os.replace(partname, destname)
+    if delete:
+        ftp.delete(remote)
+    return state
+
+
+def sftp_connect(address, port=22, user='', password='', timeout=60):
+    """
+    DESCRIPTION
+        open a sftp session - the host key has to be known (known_hosts, as for scp) and
+        ssh keys or the ssh agent are used before the password
+    """
+    if not paramiko_available:
+        raise ImportError("sftp transfers require paramiko")
+    client = paramiko.SSHClient()
+    client.load_system_host_keys()
+    client.set_missing_host_key_policy(paramiko.RejectPolicy())
+    client.connect(address, port=port, username=user, password=password or None, look_for_keys=True,
+                   allow_agent=True, timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
+    return client.open_sftp()
+
+
+def sftp_close(sftp):
+    transport = sftp.get_channel().get_transport()
+    sftp.close()
+    transport.close()
+
+
+def sftp_download(sftp, remote, destname, delete=False, blocksize=1048576):
+    """
+    DESCRIPTION
+        download a single file using an open sftp session (resumes partial downloads)
+    RETURNS
+        'skip', 'resume' or 'new'
+    """
+    remotesize = sftp.stat(remote).st_size
+    state, offset = local_state(destname, remotesize)
+    if not state == 'skip':
+        partname = destname + '.part'
+        with sftp.open(remote, 'rb') as rhandle, open(partname, 'ab' if offset else 'wb') as fhandle:
+            rhandle.seek(offset)
+            rhandle.prefetch(remotesize - offset)
+            while True:
+                block = rhandle.read(blocksize)
+                if not block:
+                    break
+                fhandle.write(block)
+        os.replace(partname, destname)
+    if delete:
+        sftp.remove(remote)
+    return state
+
+
+def rsync_commands(jobs, user, address, deleteremote=False, tmpdir=None):
+    """
+    DESCRIPTION
+        one rsync call with a file list for each destination directory
+    VARIABLES
+        jobs    list of (remotepath, destpath) tuples
+    RETURNS
+        list of (command list, list file, remote files) - the list files need to be removed by the caller
+    """
+    groups = {}
+    for remote, destpath in jobs:
+        groups.setdefault(destpath, []).append(remote)
+    commands = []
+    for destpath, remotes in groups.items():
+        fd, listfile = tempfile.mkstemp(prefix='rsync-', suffix='.list', dir=tmpdir)
+        with os.fdopen(fd, 'w') as f:
+            for remote in remotes:
+                f.write(remote.lstrip('/') + '\n')
+        command = ['rsync', '-avz', '--partial', '--no-relative', '--files-from={}'.format(listfile), '-e', 'ssh']
+        if deleteremote:
+            command.append('--remove-source-files')
+        command.extend(['{}@{}:/'.format(user, address), destpath])
+        commands.append((command, listfile, remotes))
+    return commands
+
+
+def download_files(jobs, protocol, address, port=None, user='', password='', source=None, workers=4, deleteremote=False, debug=False):
+    """
+    DESCRIPTION
+        download all files of jobs in parallel
+    VARIABLES
+        jobs      list of (remotepath, local destination filename) tuples
+        protocol  ftp, scp (sftp if paramiko is available) or rsync
+        workers   (int) parallel transfers and persistent sessions
+    RETURNS
+        list of successfully transferred local filenames, dictionary with counts of skip/resume/new/failed
+    """
+    counts = {'skip': 0, 'resume': 0, 'new': 0, 'failed': 0}
+    done = []
+    if not jobs:
+        return done, counts
+    protocol = protocol.lower()
+
+    if protocol == 'rsync':
+        for command, listfile, remotes in rsync_commands([(remote, os.path.dirname(dest)) for remote, dest in jobs], user, address, deleteremote=deleteremote):
+            if debug:
+                print ("Executing:", " ".join(command))
+            try:
+                result = subprocess.call(command)
+            finally:
+                os.remove(listfile)
+            if result == 0:
+                counts['new'] += len(remotes)
+            else:
+                print ("   rsync returned {}".format(result))
+        for remote, dest in jobs:
+            if os.path.isfile(dest):
+                done.append(dest)
+            else:
+                counts['failed'] += 1
+        return done, counts
+
+    pool = None
+    if protocol == 'ftp':
+        pool = SessionPool(lambda: ftp_connect(address, port or 21, user, password, cwd=source), close=ftp_close, size=workers)
+        download = ftp_download
+    elif protocol == 'scp' and paramiko_available:
+        pool = SessionPool(lambda: sftp_connect(address, port if port and not port == 21 else 22, user, password), close=sftp_close, size=workers)
+        download = sftp_download
+    elif protocol == 'scp':
+        from martas.core import methods as mm
+        download = None
+    else:
+        raise ValueError("unsupported protocol {}".format(protocol))
+
+    def transfer(job):
+        remote, dest = job
+        try:
+            if pool:
+                with pool.session() as sess:
+                    return dest, download(sess, remote, dest, delete=deleteremote)
+            mm.scptransfer(user+'@'+address+':'+remote, os.path.dirname(dest), password, timeout=600)
+            return dest, 'new' if os.path.isfile(dest) else 'failed'
+        except Exception as e:
+            print ("   transfer of {} failed: {}".format(remote, e))
+            return dest, 'failed'
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(int(workers), len(jobs)))) as executor:
+            for dest, state in executor.map(transfer, jobs):
+                counts[state] += 1
+                if not state == 'failed':
+                    done.append(dest)
+                if debug:
+                    print ("   {}: {}".format(dest, state))
+    finally:
+        if pool:
+            pool.close()
+    return done, counts
+
+
+class TestTransfer(unittest.TestCase):
+    """
+    Test environment for the transfer helpers
+    """
+
+    def test_local_state(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dest = os.path.join(tmpdir, 'a.bin')
+            self.assertEqual(local_state(dest, 10), ('new', 0))
+            with open(dest + '.part', 'wb') as f:
+                f.write(b'12345')
+            self.assertEqual(local_state(dest, 10), ('resume', 5))
+            with open(dest, 'wb') as f:
+                f.write(b'1234567890')
+            self.assertEqual(local_state(dest, 10), ('skip', 10))
+            self.assertEqual(local_state(dest, None), ('new', 0))
+
+    def test_rsync_commands(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            jobs = [('/srv/mqtt/A/a1.bin', '/srv/archive/A/raw'), ('/srv/mqtt/A/a2.bin', '/srv/archive/A/raw'),
+                    ('/srv/mqtt/B/b1.bin', '/srv/archive/B/raw')]
+            commands = rsync_commands(jobs, 'cobs', 'remote', deleteremote=True, tmpdir=tmpdir)
+            self.assertEqual(len(commands), 2)
+            command, listfile, remotes = commands[0]
+            with open(listfile) as f:
+                self.assertEqual(f.read().split(), ['srv/mqtt/A/a1.bin', 'srv/mqtt/A/a2.bin'])
+            self.assertIn('--remove-source-files', command)
+            self.assertEqual(command[-2:], ['cobs@remote:/', '/srv/archive/A/raw'])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -3,10 +3,16 @@
 
 import re
 import sys
+import time
+import socket
 import struct
+import selectors
+import threading
+from collections import deque
 from base64 import b64encode
 from hashlib import sha1
 import logging
+import unittest
 
 if sys.version_info[0] < 3:
     from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
@@ -46,6 +52,13 @@ OPCODE_CLOSE_CONN   = 0x8
 OPCODE_PING         = 0x9
 OPCODE_PONG         = 0xA
 
+# Outbound fan-out: frames are encoded once and queued for every client. A single
+# writer thread sends queued frames to non-blocking client sockets (slow clients do not
+# stall producers or other clients).
+MAXQUEUE = 1000      # frames per client - the oldest frames are dropped if exceeded
+MAXLAG = 30.0        # seconds - clients lagging behind for longer are disconnected
+POLL = 0.5           # seconds - wait interval of reader and writer threads
+
 
 # -------------------------------- API ---------------------------------
 
@@ -56,6 +69,7 @@ class API():
             logger.info("Listening on port %d for clients.." % self.port)
             self.serve_forever()
         except KeyboardInterrupt:
+            self.stop()
             self.server_close()
             logger.info("Server terminated.")
         except Exception as e:
@@ -80,11 +94,26 @@ class API():
     def set_fn_message_received(self, fn):
         self.message_received = fn
 
-    def send_message(self, client, msg):
-        self._unicast_(client, msg)
+    def send_message(self, client, msg, binary=False):
+        self._unicast_(client, msg, OPCODE_BINARY if binary else OPCODE_TEXT)
 
-    def send_message_to_all(self, msg):
-        self._multicast_(msg)
+    def send_message_to_all(self, msg, binary=False, clients=None):
+        """
+        send msg to all (or the given list of) clients - the frame is encoded only once
+        """
+        self._multicast_(msg, OPCODE_BINARY if binary else OPCODE_TEXT, clients=clients)
+
+    def stop(self, timeout=5.0):
+        """
+        stop the writer thread and disconnect all clients
+        """
+        self._stop_(timeout)
+
+    def client_status(self):
+        """
+        per client queue statistics: queued frames, sent and dropped frames, lag in seconds
+        """
+        return [client['handler'].outbound_status(client) for client in list(self.clients)]
 
 
 # ------------------------- Implementation -----------------------------
@@ -101,6 +130,9 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
         loglevel: Logging level from logging module to use for logging. By default
             warnings and errors are being logged.
 
+        maxqueue(int): amount of frames queued per client before the oldest are dropped
+        maxlag(float): clients with frames older than maxlag seconds are disconnected
+
     Properties:
         clients(list): A list of connected clients. A client is a dictionary
             like below.
@@ -109,19 +141,35 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
                  'handler' : handler,
                  'address' : (addr, port)
                 }
+
+    Messages are encoded once and put on a bounded outbound queue of each client.
+    Client sockets are non-blocking. A single writer thread drains the queues of
+    writable sockets, so a slow client can neither stall the thread producing the
+    data nor the other clients. stop() terminates the writer thread.
     """
 
     allow_reuse_address = True
     daemon_threads = True  # comment to keep threads alive until finished
 
-    clients = []
     id_counter = 0
 
-    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING):
+    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING, maxqueue=MAXQUEUE, maxlag=MAXLAG):
         logger.setLevel(loglevel)
         self.port = port
+        self.maxqueue = maxqueue
+        self.maxlag = maxlag
+        self.clients = []
+        self.clientlock = threading.Lock()
+        # new frames interrupt the select of the writer thread
+        self.wakeup, self.wakeupsend = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.wakeupsend.setblocking(False)
+        self.stopping = threading.Event()
         TCPServer.allow_reuse_address = True
         TCPServer.__init__(self, (host, port), WebSocketHandler)
+        self.writer = threading.Thread(target=self._writer_, name="WebsocketWriter")
+        self.writer.daemon = True
+        self.writer.start()
 
     def _message_received_(self, handler, msg):
         self.message_received(self.handler_to_client(handler), self, msg)
@@ -133,27 +181,91 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
         pass
 
     def _new_client_(self, handler):
-        self.id_counter += 1
-        client = {
-            'id': self.id_counter,
-            'handler': handler,
-            'address': handler.client_address
-        }
-        self.clients.append(client)
+        with self.clientlock:
+            self.id_counter += 1
+            client = {
+                'id': self.id_counter,
+                'handler': handler,
+                'address': handler.client_address
+            }
+            self.clients.append(client)
         self.new_client(client, self)
 
     def _client_left_(self, handler):
         client = self.handler_to_client(handler)
         self.client_left(client, self)
-        if client in self.clients:
-            self.clients.remove(client)
-
-    def _unicast_(self, to_client, msg):
-        to_client['handler'].send_message(msg)
+        with self.clientlock:
+            if client in self.clients:
+                self.clients.remove(client)
+
+    def _unicast_(self, to_client, msg, opcode=OPCODE_TEXT):
+        frame = encode_frame(msg, opcode)
+        if frame:
+            to_client['handler'].enqueue(frame)
+            self._wakeup_()
+
+    def _multicast_(self, msg, opcode=OPCODE_TEXT, clients=None):
+        # encode once for all clients
+        frame = encode_frame(msg, opcode)
+        if not frame:
+            return
+        if clients is None:
+            clients = list(self.clients)
+        for client in clients:
+            client['handler'].enqueue(frame)
+        self._wakeup_()
+
+    def _stop_(self, timeout=5.0):
+        self.stopping.set()
+        self._wakeup_()
+        if self.writer.is_alive() and not self.writer is threading.current_thread():
+            self.writer.join(timeout)
+        for client in list(self.clients):
+            client['handler'].drop("server stopped")
+
+    def _wakeup_(self):
+        try:
+            self.wakeupsend.send(b'\0')
+        except OSError:
+            # buffer full (writer is woken anyway) or server closed
+            pass
 
-    def _multicast_(self, msg):
-        for client in self.clients:
-            self._unicast_(client, msg)
+    def _writer_(self):
+        """
+        single writer thread: sends queued frames to all writable client sockets
+        """
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup, selectors.EVENT_READ, None)
+        while not self.stopping.is_set():
+            pending = [client['handler'] for client in list(self.clients) if client['handler'].has_pending()]
+            for handler in pending:
+                try:
+                    selector.register(handler.request, selectors.EVENT_WRITE, handler)
+                except (KeyError, ValueError, OSError):
+                    handler.drop("socket not available")
+            try:
+                ready = selector.select(timeout=POLL)
+            except OSError:
+                ready = []
+            for key, events in ready:
+                if key.data is None:
+                    try:
+                        while self.wakeup.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                else:
+                    key.data.drain()
+            for handler in pending:
+                try:
+                    selector.unregister(handler.request)
+                except (KeyError, ValueError, OSError):
+                    pass
+                if handler.lag() > self.maxlag:
+                    handler.drop("lagging {:.1f} sec behind".format(handler.lag()))
+        selector.close()
+        self.wakeup.close()
+        self.wakeupsend.close()
 
     def handler_to_client(self, handler):
         for client in self.clients:
@@ -169,9 +281,88 @@ class WebSocketHandler(StreamRequestHandler):
 
     def setup(self):
         StreamRequestHandler.setup(self)
+        # non-blocking on all platforms: the writer thread must never wait for a single client,
+        # the reader thread waits for incoming data with a selector (see recv_bytes)
+        self.request.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.request, selectors.EVENT_READ)
         self.keep_alive = True
         self.handshake_done = False
         self.valid_client = False
+        self.outqueue = deque()
+        self.outlock = threading.Lock()
+        self.partial = None     # remaining part of a partially sent frame
+        self.sent = 0
+        self.dropped = 0
+        self.sentbytes = 0
+
+    def enqueue(self, frame):
+        """
+        queue an encoded frame - drops the oldest frame if the queue is full
+        """
+        with self.outlock:
+            if len(self.outqueue) >= self.server.maxqueue:
+                self.outqueue.popleft()
+                self.dropped += 1
+            self.outqueue.append((time.time(), frame))
+
+    def has_pending(self):
+        return self.keep_alive and (self.partial is not None or len(self.outqueue) > 0)
+
+    def lag(self):
+        """
+        age of the oldest queued frame in seconds
+        """
+        with self.outlock:
+            if not self.outqueue:
+                return 0.0
+            return time.time() - self.outqueue[0][0]
+
+    def drain(self):
+        """
+        send queued frames until the socket would block (called by the writer thread)
+        """
+        while True:
+            if self.partial is None:
+                with self.outlock:
+                    if not self.outqueue:
+                        return
+                    self.partial = memoryview(self.outqueue.popleft()[1])
+            try:
+                n = self.request.send(self.partial)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                self.drop(str(e))
+                return
+            self.sentbytes += n
+            if n < len(self.partial):
+                self.partial = self.partial[n:]
+                return
+            self.partial = None
+            self.sent += 1
+
+    def drop(self, reason):
+        """
+        disconnect a slow or broken client
+        """
+        if not self.keep_alive:
+            return
+        logger.warning("Dropping client %s: %s" % (str(self.client_address), reason))
+        self.keep_alive = False
+        with self.outlock:
+            self.dropped += len(self.outqueue)
+            self.outqueue.clear()
+            self.partial = None
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def outbound_status(self, client=None):
+        return {'id': client.get('id') if client else None, 'address': self.client_address,
+                'queued': len(self.outqueue), 'sent': self.sent, 'dropped': self.dropped,
+                'bytes': self.sentbytes, 'lag': self.lag()}
 
     def handle(self):
         while self.keep_alive:
@@ -180,9 +371,28 @@ class WebSocketHandler(StreamRequestHandler):
             elif self.valid_client:
                 self.read_next_message()
 
+    def recv_bytes(self, num):
+        """
+        read num bytes from the non-blocking socket - returns less if the connection is closed
+        """
+        data = bytearray()
+        while len(data) < num and self.keep_alive and not self.server.stopping.is_set():
+            if not self.selector.select(timeout=POLL):
+                continue
+            try:
+                chunk = self.request.recv(num - len(data))
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                break
+            if not chunk:
+                break
+            data.extend(chunk)
+        return bytes(data)
+
     def read_bytes(self, num):
         # python3 gives ordinal of byte directly
-        bytes = self.rfile.read(num)
+        bytes = self.recv_bytes(num)
         if sys.version_info[0] < 3:
             return map(ord, bytes)
         else:
@@ -229,9 +439,9 @@ class WebSocketHandler(StreamRequestHandler):
             return
 
         if payload_length == 126:
-            payload_length = struct.unpack(">H", self.rfile.read(2))[0]
+            payload_length = struct.unpack(">H", self.recv_bytes(2))[0]
         elif payload_length == 127:
-            payload_length = struct.unpack(">Q", self.rfile.read(8))[0]
+            payload_length = struct.unpack(">Q", self.recv_bytes(8))[0]
 
         masks = self.read_bytes(4)
         decoded = ""
@@ -248,53 +458,28 @@ class WebSocketHandler(StreamRequestHandler):
 
     def send_text(self, message, opcode=OPCODE_TEXT):
         """
-        Important: Fragmented(=continuation) messages are not supported since
-        their usage cases are limited - when we don't know the payload length.
+        Queue a message for this client (sent by the writer thread of the server)
         """
-
-        # Validate message
-        if isinstance(message, bytes):
-            message = try_decode_UTF8(message)  # this is slower but ensures we have UTF-8
-            if not message:
-                logger.warning("Can\'t send message, message is not valid UTF-8")
-                return False
-        elif sys.version_info < (3,0) and (isinstance(message, str) or isinstance(message, unicode)):
-            pass
-        elif isinstance(message, str):
-            pass
-        else:
-            logger.warning('Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
+        frame = encode_frame(message, opcode)
+        if not frame:
             return False
-
-        header  = bytearray()
-        payload = encode_to_UTF8(message)
-        payload_length = len(payload)
-
-        # Normal payload
-        if payload_length <= 125:
-            header.append(FIN | opcode)
-            header.append(payload_length)
-
-        # Extended payload
-        elif payload_length >= 126 and payload_length <= 65535:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT16)
-            header.extend(struct.pack(">H", payload_length))
-
-        # Huge extended payload
-        elif payload_length < 18446744073709551616:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT64)
-            header.extend(struct.pack(">Q", payload_length))
-
-        else:
-            raise Exception("Message is too big. Consider breaking it into chunks.")
-            return
-
-        self.request.send(header + payload)
+        self.enqueue(frame)
+        self.server._wakeup_()
+        return True
 
     def handshake(self):
-        message = self.request.recv(1024).decode().strip()
+        message = b''
+        while self.keep_alive and not self.server.stopping.is_set():
+            if not self.selector.select(timeout=POLL):
+                continue
+            try:
+                message = self.request.recv(1024)
+            except (BlockingIOError, InterruptedError):
+                continue
+            except OSError:
+                pass
+            break
+        message = message.decode(errors='replace').strip()
         upgrade = re.search('\nupgrade[\s]*:[\s]*websocket', message.lower())
         if not upgrade:
             self.keep_alive = False
@@ -326,9 +511,59 @@ class WebSocketHandler(StreamRequestHandler):
         return response_key.decode('ASCII')
 
     def finish(self):
+        self.selector.close()
         self.server._client_left_(self)
 
 
+def encode_frame(message, opcode=OPCODE_TEXT):
+    """
+    Encode a complete websocket frame (header and payload) once.
+    Text frames require str or UTF-8 bytes, binary frames bytes.
+    Important: Fragmented(=continuation) messages are not supported since
+    their usage cases are limited - when we don't know the payload length.
+    """
+    if opcode == OPCODE_BINARY:
+        payload = bytes(message)
+    else:
+        # Validate message
+        if isinstance(message, bytes):
+            message = try_decode_UTF8(message)  # this is slower but ensures we have UTF-8
+            if not message:
+                logger.warning("Can\'t send message, message is not valid UTF-8")
+                return False
+        elif not isinstance(message, str):
+            logger.warning('Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
+            return False
+        payload = encode_to_UTF8(message)
+        if payload is False:
+            return False
+
+    header = bytearray()
+    payload_length = len(payload)
+
+    # Normal payload
+    if payload_length <= 125:
+        header.append(FIN | opcode)
+        header.append(payload_length)
+
+    # Extended payload
+    elif payload_length >= 126 and payload_length <= 65535:
+        header.append(FIN | opcode)
+        header.append(PAYLOAD_LEN_EXT16)
+        header.extend(struct.pack(">H", payload_length))
+
+    # Huge extended payload
+    elif payload_length < 18446744073709551616:
+        header.append(FIN | opcode)
+        header.append(PAYLOAD_LEN_EXT64)
+        header.extend(struct.pack(">Q", payload_length))
+
+    else:
+        raise Exception("Message is too big. Consider breaking it into chunks.")
+
+    return bytes(header) + payload
+
+
 def encode_to_UTF8(data):
     try:
         return data.encode('UTF-8')
@@ -347,3 +582,86 @@ def try_decode_UTF8(data):
         return False
     except Exception as e:
         raise(e)
+
+
+class TestWebsocketServer(unittest.TestCase):
+    """
+    Test environment for the queued websocket fan-out
+    """
+
+    def test_encode_frame(self):
+        self.assertEqual(encode_frame("abc"), b'\x81\x03abc')
+        frame = encode_frame(b'\x00' * 300, OPCODE_BINARY)
+        self.assertEqual(frame[:4], b'\x82\x7e\x01\x2c')
+        self.assertFalse(encode_frame(b'\xff\xfe'))
+
+    def connect(self, port):
+        client = socket.create_connection(('127.0.0.1', port), timeout=5)
+        client.send(b'GET / HTTP/1.1\r\nUpgrade: websocket\r\nSec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nHost: localhost\r\n\r\n')
+        self.assertIn(b'101', client.recv(1024))
+        return client
+
+    def test_fanout(self):
+        server = WebsocketServer(0, loglevel=logging.ERROR)
+        port = server.socket.getsockname()[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = self.connect(port)
+            while not server.clients:
+                time.sleep(0.01)
+            server.send_message_to_all("hello")
+            self.assertEqual(client.recv(1024), b'\x81\x05hello')
+            for i in range(100):
+                if server.client_status()[0]['sent']:
+                    break
+                time.sleep(0.01)
+            status = server.client_status()[0]
+            self.assertEqual(status['sent'], 1)
+            self.assertEqual(status['dropped'], 0)
+            client.close()
+        finally:
+            server.shutdown()
+            server.stop()
+            server.server_close()
+        self.assertFalse(server.writer.is_alive())
+
+    def test_slow_client(self):
+        # a client which does not read must not delay the others
+        server = WebsocketServer(0, loglevel=logging.CRITICAL, maxqueue=20)
+        port = server.socket.getsockname()[1]
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            slow = self.connect(port)
+            fast = self.connect(port)
+            while len(server.clients) < 2:
+                time.sleep(0.01)
+            payload = "x" * 65000
+            frame = encode_frame(payload)
+            received = 0
+            for i in range(100):
+                server.send_message_to_all(payload)
+                while received < (i + 1) * len(frame):
+                    received += len(fast.recv(len(frame)))
+            # the counter is updated after the last send returned
+            for i in range(100):
+                status = {el['address'][1]: el for el in server.client_status()}
+                if status[fast.getsockname()[1]]['sent'] == 100:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(status[fast.getsockname()[1]]['sent'], 100)
+            self.assertGreater(status[slow.getsockname()[1]]['dropped'], 0)
+            slow.close()
+            fast.close()
+        finally:
+            server.shutdown()
+            server.stop()
+            server.server_close()
+        self.assertFalse(server.writer.is_alive())
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
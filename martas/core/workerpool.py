@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+DESCRIPTION
+    Parallel execution of per instrument jobs (used by filter and archive, option --workers).
+
+    The jobs are executed by a pool of worker processes. Every worker opens one database
+    connection which is used for all its jobs. The amount of simultaneous database reads
+    of all workers is limited by a shared semaphore (see read_slot) so that the database is
+    not overloaded. With workers=1 the jobs are executed one after another in the calling
+    process using the given database connection.
+
+    A job function is called as func(db, item) and has to be defined on module level.
+
+| class           |  method  |  version |  tested  |              comment             | manual | *used by |
+| --------------- |  ------  |  ------- |  ------- |  ------------------------------- | ------ | ---------- |
+|                 |  run_jobs  |  2.0.2 |      yes |  sequential or process pool      | -      | filter, archive |
+|                 |  read_slot |  2.0.2 |      yes |  limit simultaneous db reads     | -      | filter, archive |
+
+"""
+
+import multiprocessing
+import unittest
+from contextlib import contextmanager
+
+_worker_db = None
+_worker_credentials = None
+_read_semaphore = None
+
+
+def _init_worker(dbcredentials, semaphore):
+    global _worker_db, _worker_credentials, _read_semaphore
+    _worker_credentials = dbcredentials
+    _read_semaphore = semaphore
+    _worker_db = _connect(dbcredentials)
+
+
+def _connect(dbcredentials):
+    if not dbcredentials:
+        return None
+    from martas.core import methods as mm
+    return mm.connect_db(dbcredentials, exitonfailure=False, report=False)
+
+
+def _call(job):
+    global _worker_db
+    func, item = job
+    if _worker_db is None and _worker_credentials:
+        # reconnect if the connection of this worker failed before
+        _worker_db = _connect(_worker_credentials)
+    return func(_worker_db, item)
+
+
+@contextmanager
+def read_slot():
+    """
+    DESCRIPTION
+        context manager limiting the amount of simultaneous database reads of all workers
+    APPLICATION
+        with read_slot():
+            stream = db.read(dataid, starttime=start, endtime=end)
+    """
+    if _read_semaphore is None:
+        yield
+    else:
+        with _read_semaphore:
+            yield
+
+
+def run_jobs(func, items, workers=1, db=None, dbcredentials=None, maxreads=2, debug=False):
+    """
+    DESCRIPTION
+        call func(db, item) for all items
+    VARIABLES
+        workers        (int) amount of worker processes (1: sequential in this process using db)
+        db             database connection for sequential execution
+        dbcredentials  credentials used by every worker to open its own connection
+        maxreads       (int) simultaneous database reads of all workers
+    RETURNS
+        list of the results (order of completion for workers > 1)
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(db, item) for item in items]
+    workers = min(int(workers), len(items))
+    if debug:
+        print("Running {} jobs in {} worker processes (max {} simultaneous database reads)".format(len(items), workers, maxreads))
+    semaphore = multiprocessing.BoundedSemaphore(max(1, int(maxreads)))
+    results = []
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(dbcredentials, semaphore)) as pool:
+        for result in pool.imap_unordered(_call, [(func, item) for item in items]):
+            results.append(result)
+    return results
+
+
+def _square(db, item):
+    with read_slot():
+        return {item: item * item}
+
+
+class TestWorkerPool(unittest.TestCase):
+    """
+    Test environment for the worker pool
+    """
+
+    def test_sequential(self):
+        self.assertEqual(run_jobs(_square, [1, 2, 3]), [{1: 1}, {2: 4}, {3: 9}])
+
+    def test_pool(self):
+        results = run_jobs(_square, range(6), workers=3, maxreads=1)
+        merged = {}
+        for result in results:
+            merged.update(result)
+        self.assertEqual(merged, {i: i * i for i in range(6)})
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -34,14 +34,19 @@ import socket # for hostname identification
 import string # for ascii selection
 import sys
 import numpy as np
-import os     # binary data saved directly without acs helper method
 from datetime import datetime, timedelta, timezone
 from twisted.protocols.basic import LineReceiver
 from twisted.python import log
 from martas.core import methods as mm
+from martas.core.bufferwriter import get_pool
+from martas.core.framing import FrameAssembler
 import subprocess
 from subprocess import check_call
 
+LEMI_FRAMELENGTH = 153
+LEMI_RECORD = struct.Struct("<4cB6B8hb30f3BcB")
+LEMI_TIME = struct.Struct("<6hL")
+
 
 ## Lemi protocol (Lemi025 and Lemi036)
 ## -------------
@@ -119,6 +124,8 @@ class LemiProtocol(LineReceiver):
             self.buffer = self.buffer.encode('ascii')
             self.gpsstate1 = self.gpsstate1.encode('ascii')
             self.gpsstate2 = self.gpsstate2.encode('ascii')  # Initialize with Z so that current state is send when startet
+        # frames are synchronized on the start-of-line-tag within a preallocated buffer
+        self.assembler = FrameAssembler(LEMI_FRAMELENGTH, starttag=self.soltag)
         print ("Initializing LEMI finished")
 
 
@@ -140,10 +147,8 @@ class LemiProtocol(LineReceiver):
     def initiateRestart(self):
         log.msg('LEMI - Protocol: Cannot fix problem - restarting process')
         log.msg('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-        self.buffer = ''
+        self.assembler.reset()
         self.buffererrorcnt = 0
-        if self.pvers > 2:
-            self.buffer = self.buffer.encode('ascii')
         print (" ... performing restart now...")
         try:
             # For some reason restart doesn't work?
@@ -158,7 +163,7 @@ class LemiProtocol(LineReceiver):
 
     def processLemiData(self, data):
         """Convert raw ADC counts into SI units as per datasheets"""
-        if len(data) != 153:
+        if len(data) != LEMI_FRAMELENGTH:
             log.err('LEMI - Protocol: Unable to parse data of length %i' % len(data))
 
         #print ("Processing data ...")
@@ -169,14 +174,7 @@ class LemiProtocol(LineReceiver):
         timestamp = datetime.strftime(currenttime, "%Y-%m-%d %H:%M:%S.%f")
         outtime = datetime.strftime(currenttime, "%H:%M:%S")
         datearray = mm.time_to_array(timestamp)
-        date_bin = struct.pack('<6hL',datearray[0]-2000,datearray[1],datearray[2],datearray[3],datearray[4],datearray[5],datearray[6])   ## Added "<" to pack code to get correct length in new machines
-
-        # define pathname for local file storage
-        # (default dir plus hostname plus sensor plus year) and create if not existing
-        path = os.path.join(self.confdict.get('bufferdirectory'), self.sensor)
-
-        if not os.path.exists(path):
-            os.makedirs(path)
+        date_bin = LEMI_TIME.pack(datearray[0]-2000,datearray[1],datearray[2],datearray[3],datearray[4],datearray[5],datearray[6])   ## Added "<" to pack code to get correct length in new machines
 
         packcode = "<4cb6B8hb30f3BcBcc5hL"
         header = "LemiBin %s %s %s %s %s %s %d\n" % (self.sensor, '[x,y,z,t1,t2]', '[X,Y,Z,T_sensor,T_elec]', '[nT,nT,nT,deg_C,deg_C]', '[0.001,0.001,0.001,100,100]', packcode, struct.calcsize(packcode))
@@ -187,21 +185,15 @@ class LemiProtocol(LineReceiver):
             header = header.encode('ascii')
 
         # save binary raw data to buffer file ### please note that this file always contains GPS readings
-        lemipath = os.path.join(path,self.sensor+'_'+date+".bin")
-        if not os.path.exists(lemipath):
-            with open(lemipath, "ab") as myfile:
-                myfile.write(header)
-        try:
-            with open(lemipath, "ab") as myfile:
-                myfile.write(data+date_bin)
-            pass
-        except:
+        # file handles are kept open by the buffer writer pool - LEMI records have no line end
+        if not get_pool().write(self.confdict.get('bufferdirectory'), self.sensor, date, bytes(data)+date_bin, header=header, eol=b""):
             log.err('LEMI - Protocol: Could not write data to file.')
 
         # unpack data and extract time and first field values
         # This data is streamed via mqtt
         try:
-            data_array = struct.unpack("<4cB6B8hb30f3BcB", data)
+            # unpack directly from the frame buffer
+            data_array = LEMI_RECORD.unpack_from(data)
         except:
             log.err("LEMI - Protocol: Bit error while reading.")
 
@@ -234,8 +226,8 @@ class LemiProtocol(LineReceiver):
         #print ("HERE2", packcode, struct.calcsize(packcode))
         processerror = False
         if not gpsstat in ['P','A']:
-            print (" ERROR in BINDATA:", struct.unpack("<4cB6B8hb30f3BcB", data))
-            print (" Rawdata looks like:", data)
+            print (" ERROR in BINDATA:", LEMI_RECORD.unpack_from(data))
+            print (" Rawdata looks like:", bytes(data))
             self.buffererrorcnt += 1
             processerror = True
             if self.buffererrorcnt == 10:
@@ -306,154 +298,64 @@ class LemiProtocol(LineReceiver):
 
 
     def dataReceived(self, data):
-        #print ("Lemi data here!", self.buffer)
         """
-        Sometime the code is starting wrongly -> 148 bit length
-        self healing not working - Check data
+        Serial chunks are assembled into 153 byte frames starting with the start-of-line-tag.
+        Bad or incomplete frames are skipped by the frame assembler (resync). A restart
+        is initiated after 10 consecutive errors.
         """
-
         topic = self.confdict.get('station') + '/' + self.sensordict.get('sensorid')
 
-        flag = 0
-        WSflag = 0
-        #debug = self.debug
-
-        """
-        # Test range
-        self.buffer = self.buffer + data
-        if not (self.buffer).startswith(self.soltag):
-            lemisearch = (self.buffer).find(self.soltag, 6)
-            if not lemisearch == -1:
-                print ("Lemisearch", lemisearch, self.buffer)
-                self.buffer = self.buffer[lemisearch:len(self.buffer)]
-        if len(self.buffer) == 153:
-            # Process data
-            print (self.buffer)
-            self.buffer = ''
-        """
-
+        resyncs = self.assembler.resyncs
         try:
-            # 1. Found correct data length
-            if (self.buffer).startswith(self.soltag) and len(self.buffer) == 153:
-                currdata = self.buffer
-                self.buffer = ''
-                if self.pvers > 2:
-                    self.buffer = self.buffer.encode('ascii')
-                dataarray, head = self.processLemiData(currdata)
-                comp = ''
-                if self.pvers > 2:
-                    comp = comp.encode('ascii')
-                if not dataarray == comp:
-                    WSflag = 2
-
-            # 2. Found incorrect data length
-
-            ### Note: this code for fixing data is more complex than the POS fix code
-            ### due to the LEMI device having a start code rather than an EOL code.
-            ### It can handle and deal with multiple errors:
-            ###  - multiple data parts arriving at once
-            ###  - databits being lost. Bad string is then deleted.
-            ###  - bad bits infiltrating the data. Bad string is deleted.
-
-            if len(self.buffer) > 153:
-                if self.debug:
-                    log.msg('LEMI - Protocol: Warning: Bufferlength ({}) exceeds 153 characters, fixing...'.format(len(self.buffer)))
-                    log.msg("BUFFER: {}".format(self.buffer))
-                lemisearch = (self.buffer).find(self.soltag)
-                #print '1', lemisearch
-                if (self.buffer).startswith(self.soltag):
-                    datatest = len(self.buffer)%153
-                    dataparts = int(len(self.buffer)/153)
-                    log.msg('LEMI - Protocol: datatest {} and dataparts {}'.format(datatest,dataparts))
-                    if datatest == 0:
-                        if self.debug:
-                            log.msg('LEMI - Protocol: It appears multiple parts came in at once, amount N of parts: {}'.format(dataparts))
-                        for i in range(dataparts):
-                            split_data_string = self.buffer[0:153]
-                            if (split_data_string).startswith(self.soltag):
-                                if self.debug:
-                                    log.msg('LEMI - Protocol: Processing data part N {} in string...'.format(str(i+1)))
-                                dataarray, head = self.processLemiData(split_data_string)
-                                WSflag = 2
-                                self.buffer = self.buffer[153:len(self.buffer)]
-                            else:
-                                flag = 1
-                                break
-                    else:
-                        for i in range(dataparts):
-                            lemisearch = (self.buffer).find(self.soltag, 6)
-                            if lemisearch >= 153:
-                                split_data_string = self.buffer[0:153]
-                                dataarray, head = self.processLemiData(split_data_string)
-                                WSflag = 2
-                                self.buffer = self.buffer[153:len(self.buffer)]
-                            elif lemisearch == -1:
-                                log.msg('LEMI - Protocol: No header found. Deleting buffer.')
-                                self.buffer = ''
-                                if self.pvers > 2:
-                                    self.buffer = self.buffer.encode('ascii')
-                            else:
-                                log.msg('LEMI - Protocol: String contains bad data ({} bits). Deleting. Lemisearchpos: {}'.format(len(self.buffer[:lemisearch]), lemisearch))
-                                #self.buffer = ''
-                                self.buffer = self.buffer[lemisearch:len(self.buffer)]
-                                flag = 1
-                                self.buffererrorcnt += 1
-                                #break #uncommented on 2018-09-11
-                    if self.buffererrorcnt == 10:
-                        self.initiateRestart()
-
-                else:
-                    log.msg('LEMI - Protocol: Incorrect header. Attempting to fix buffer... Bufferlength: {}'.format(len(self.buffer)))
-                    lemisearch = (self.buffer).find(self.soltag, 6)
-                    #lemisearch = repr(self.buffer).find(self.soltag)
-                    if lemisearch == -1:
-                        log.msg('LEMI - Protocol: No header found. Deleting buffer.')
-                        self.buffer = ''
-                        if self.pvers > 2:
-                            self.buffer = self.buffer.encode('ascii')
-                    else:
-                        self.buffer = self.buffer[lemisearch:len(self.buffer)]
-                        log.msg('LEMI - Protocol: Bad data ({} bits) deleted. New bufferlength: {}'.format(lemisearch,len(self.buffer)))
-                        flag = 1
-
-            if flag in [0,1]: #flag == 0: #uncommented 2018-09-11
-                self.buffer = self.buffer + data
-
+            frames = self.assembler.feed(data)
         except:
             log.msg('LEMI - Protocol: Error while parsing data.')
-            #Emtpying buffer
-            self.buffer = ''
-            if self.pvers > 2:
-                self.buffer = self.buffer.encode('ascii')
+            self.assembler.reset()
+            frames = []
             self.buffererrorcnt += 1
-            if self.buffererrorcnt == 10:
-                self.initiateRestart()
-
-        ## publish events to all clients subscribed to topic
-        if WSflag == 2:
-
-            self.buffererrorcnt = 0
-            senddata = False
-            coll = int(self.sensordict.get('stack'))
-            if coll > 1:
-                self.metacnt = 1 # send meta data with every block
-                if self.datacnt < coll:
-                    self.datalst.append(dataarray)
-                    self.datacnt += 1
-                else:
-                    senddata = True
-                    dataarray = ';'.join(self.datalst)
-                    self.datalst = []
-                    self.datacnt = 0
+        if self.assembler.resyncs > resyncs:
+            log.msg('LEMI - Protocol: Bad data deleted ({} resyncs, {} bytes discarded so far)'.format(self.assembler.resyncs, self.assembler.discarded))
+            self.buffererrorcnt += self.assembler.resyncs - resyncs
+
+        for frame in frames:
+            try:
+                dataarray, head = self.processLemiData(frame)
+            except:
+                log.msg('LEMI - Protocol: Error while processing data.')
+                self.buffererrorcnt += 1
+                continue
+            if dataarray:
+                self.buffererrorcnt = 0
+                self.publishData(topic, dataarray, head)
+
+        if self.buffererrorcnt >= 10:
+            self.initiateRestart()
+
+    def publishData(self, topic, dataarray, head):
+        """
+        publish events to all clients subscribed to topic
+        """
+        senddata = False
+        coll = int(self.sensordict.get('stack'))
+        if coll > 1:
+            self.metacnt = 1 # send meta data with every block
+            if self.datacnt < coll:
+                self.datalst.append(dataarray)
+                self.datacnt += 1
             else:
                 senddata = True
-
-            if senddata:
-                self.client.publish(topic+"/data", dataarray, qos=self.qos)
-                if self.count == 0:
-                    add = "SensorID:{},StationID:{},DataPier:{},SensorModule:{},SensorGroup:{},SensorDescription:{},DataTimeProtocol:{},DataNTPTimeDelay:{},DataCompensationX:{},DataCompensationY:{},DataCompensationZ:{}".format( self.sensordict.get('sensorid',''),self.confdict.get('station',''),self.sensordict.get('pierid',''),self.sensordict.get('protocol',''),self.sensordict.get('sensorgroup',''),self.sensordict.get('sensordesc','').rstrip(),self.sensordict.get('ptime',''),self.timedelay, self.compensation[0],self.compensation[1],self.compensation[2] )
-                    self.client.publish(topic+"/dict", add, qos=self.qos)
-                    self.client.publish(topic+"/meta", head, qos=self.qos)
-                self.count += 1
-                if self.count >= self.metacnt:
-                    self.count = 0
+                dataarray = ';'.join(self.datalst)
+                self.datalst = []
+                self.datacnt = 0
+        else:
+            senddata = True
+
+        if senddata:
+            self.client.publish(topic+"/data", dataarray, qos=self.qos)
+            if self.count == 0:
+                add = "SensorID:{},StationID:{},DataPier:{},SensorModule:{},SensorGroup:{},SensorDescription:{},DataTimeProtocol:{},DataNTPTimeDelay:{},DataCompensationX:{},DataCompensationY:{},DataCompensationZ:{}".format( self.sensordict.get('sensorid',''),self.confdict.get('station',''),self.sensordict.get('pierid',''),self.sensordict.get('protocol',''),self.sensordict.get('sensorgroup',''),self.sensordict.get('sensordesc','').rstrip(),self.sensordict.get('ptime',''),self.timedelay, self.compensation[0],self.compensation[1],self.compensation[2] )
+                self.client.publish(topic+"/dict", add, qos=self.qos)
+                self.client.publish(topic+"/meta", head, qos=self.qos)
+            self.count += 1
+            if self.count >= self.metacnt:
+                self.count = 0
@@ -20,6 +20,67 @@ from magpy.core.methods import testtime
 ## MySQL protocol
 ## --------------------
 
+# seconds between checks of the table columns and between renewals of the cached headers
+SCHEMA_INTERVAL = 30
+HEADER_INTERVAL = 600
+
+
+def time_components(times):
+    """
+    DESCRIPTION
+        year, month, day, hour, minute, second, microsecond of all times (as datetime_to_array)
+    RETURNS
+        integer array with shape (len(times), 7)
+    """
+    t = np.asarray(times, dtype='datetime64[us]')
+    years = t.astype('datetime64[Y]')
+    months = t.astype('datetime64[M]')
+    days = t.astype('datetime64[D]')
+    us = (t - days).astype(np.int64)
+    comps = np.empty((len(t), 7), dtype=np.int64)
+    comps[:, 0] = years.astype(np.int64) + 1970
+    comps[:, 1] = (months - years.astype('datetime64[M]')).astype(np.int64) + 1
+    comps[:, 2] = (days - months.astype('datetime64[D]')).astype(np.int64) + 1
+    comps[:, 3] = us // 3600000000
+    comps[:, 4] = (us // 60000000) % 60
+    comps[:, 5] = (us // 1000000) % 60
+    comps[:, 6] = us % 1000000
+    return comps
+
+
+def pack_values(values):
+    """
+    DESCRIPTION
+        int(float(x)*10000) for a block of values, invalid values are replaced by 999990000
+    """
+    values = np.asarray(values)
+    if not values.dtype.kind == 'f':
+        try:
+            values = values.astype(float)
+        except (TypeError, ValueError):
+            values = np.array([[float(v) if mm._is_number(v) else np.nan for v in row] for row in values], dtype=float)
+    scaled = values * 10000
+    valid = np.isfinite(scaled) & (np.abs(scaled) < 9.2e18)
+    return np.where(valid, np.trunc(np.where(valid, scaled, 0)), 999990000).astype(np.int64)
+
+
+def pack_block(times, values):
+    """
+    DESCRIPTION
+        converts a block of times and values (rows x keys) into MagPyBin records (packcode 6HLq...)
+    RETURNS
+        integer rows (time components and values) and the binary records of all rows
+    """
+    comps = time_components(times)
+    ints = pack_values(values).reshape(len(comps), -1)
+    dtype = np.dtype([('date', '<u2', (6,)), ('us', '<u4'), ('vals', '<i8', (ints.shape[1],))])
+    records = np.empty(len(comps), dtype=dtype)
+    records['date'] = comps[:, :6]
+    records['us'] = comps[:, 6]
+    records['vals'] = ints
+    return np.hstack((comps, ints)), records.tobytes()
+
+
 class MySQLProtocol(object):
     """
     Protocol to read SQL data (usually from ttyACM0)
@@ -29,6 +90,8 @@ class MySQLProtocol(object):
     Here data can be selected and deselected. Update requires the removal of all
     data of a specific database from sensors.cfg.
     MySQL is an active protocol, requesting data at defined periods.
+    Headers (keys, elements, units, packcode) are cached per table until its columns change,
+    only rows newer than the last sent time are requested.
     """
 
     ## need a reference to our WS-MCU gateway factory to dispatch PubSub events
@@ -92,6 +155,10 @@ class MySQLProtocol(object):
                 self.sensorlist.append(sensdict)
 
         self.lastt = [None]*len(self.sensorlist)
+        self.headers = {}
+        self.schema = {}
+        self.schematime = None
+        self.headertime = None
 
 
     def connectionMade(self, dbname):
@@ -173,10 +240,138 @@ class MySQLProtocol(object):
         return senslist3
 
 
+    def check_schema(self):
+        """
+        DESCRIPTION
+            reads the columns of all polled tables with a single query (at most every SCHEMA_INTERVAL
+            seconds) and drops cached headers of tables whose columns changed. Headers are also
+            renewed every HEADER_INTERVAL seconds to follow changes of SENSORS and DATAINFO.
+        """
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if self.schematime and (now - self.schematime).total_seconds() < SCHEMA_INTERVAL:
+            return
+        if not self.headertime or (now - self.headertime).total_seconds() > HEADER_INTERVAL:
+            self.headers = {}
+            self.headertime = now
+        tables = [sensdict.get('sensorid')+'_'+self.revision for sensdict in self.sensorlist]
+        if not tables:
+            return
+        sql = ("SELECT TABLE_NAME, GROUP_CONCAT(COLUMN_NAME ORDER BY ORDINAL_POSITION) FROM INFORMATION_SCHEMA.COLUMNS "
+               "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({}) GROUP BY TABLE_NAME".format(",".join(["%s"]*len(tables))))
+        cursor = self.db.db.cursor()
+        try:
+            cursor.execute(sql, tables)
+            schema = {el[0]: el[1].split(',') for el in cursor.fetchall()}
+        except:
+            log.msg("  -> ERROR - could not read table columns")
+            return
+        finally:
+            cursor.close()
+        for table in tables:
+            if not self.schema.get(table) == schema.get(table):
+                self.headers.pop(table, None)
+        self.schema = schema
+        self.schematime = now
+
+    def get_header(self, sensorid, dataid):
+        """
+        DESCRIPTION
+            header line, keys, packcode, sampling rate and select statements of a table
+            (cached in self.headers until the table columns change)
+        """
+        def getRow(sql):
+            cursor = self.db.db.cursor()
+            try:
+                cursor.execute(sql, (sensorid,))
+                row = cursor.fetchone()
+            except:
+                log.msg("  -> ERROR - get SQL data")
+                row = None
+            finally:
+                cursor.close()
+            return row if row else []
+
+        keystab = [key for key in self.schema.get(dataid, []) if not key in ['time','flag','typ','comment']]
+        if not len(keystab) > 0:
+            return None
+        if self.debug:
+            log.msg("  -> DEBUG - requesting header {}".format(sensorid))
+        sensorrow = getRow('SELECT SensorElements, SensorKeys FROM SENSORS WHERE SensorID LIKE %s')
+        inforow = getRow('SELECT ColumnUnits, ColumnContents, DataSamplingRate FROM DATAINFO WHERE SensorID LIKE %s')
+        def _split(row, i):
+            try:
+                return row[i].split(',')
+            except:
+                return []
+        elem, keyssens = _split(sensorrow, 0), _split(sensorrow, 1)
+        unit, cont = _split(inforow, 0), _split(inforow, 1)
+        units, elems = [], []
+        for key in keystab:
+            try:
+                pos1 = keyssens.index(key)
+                ele = elem[pos1]
+            except:
+                ele = key
+            elems.append(ele)
+            try:
+                pos2 = cont.index(ele)
+                units.append(unit[pos2])
+            except:
+                units.append('None')
+        if self.debug:
+            log.msg("  -> DEBUG - creating head line {}".format(sensorid))
+        multplier = '['+','.join(map(str, [10000]*len(keystab)))+']'
+        packcode = '6HL'+''.join(['q']*len(keystab))
+        header = ("# MagPyBin {} {} {} {} {} {} {}".format(sensorid, '['+','.join(keystab)+']', '['+','.join(elems)+']', '['+','.join(units)+']', multplier, packcode, struct.calcsize('<'+packcode)))
+        try:
+            sr = float(inforow[2])
+        except:
+            sr = 1.
+        if not sr > 0:
+            sr = 1.
+        coverage = int(self.requestrate/sr)+120
+        columns = ','.join(['time']+keystab)
+        try:
+            # meta information of the sensor for publishing, renewed with the header
+            meta = self.db.get_lines(dataid, 1).header
+        except:
+            meta = {}
+        return {'meta': meta, 'keys': keystab, 'header': header, 'packcode': packcode, 'coverage': coverage,
+                # statements are created once per table and executed with parameters
+                'lastsql': 'SELECT {} FROM {} ORDER BY time DESC LIMIT %s'.format(columns, dataid),
+                'newsql': 'SELECT {} FROM {} WHERE time > %s ORDER BY time LIMIT %s'.format(columns, dataid)}
+
+    def get_new_rows(self, index, dataid, head):
+        """
+        DESCRIPTION
+            rows of the table newer than the last sent time (the last coverage rows on the first request)
+        """
+        cursor = self.db.db.cursor()
+        rows = []
+        try:
+            if not self.lastt[index]:
+                cursor.execute(head.get('lastsql'), (head.get('coverage'),))
+                rows = list(reversed(cursor.fetchall()))
+            else:
+                # limit the amount of rows after longer outages - the rest follows with the next requests
+                cursor.execute(head.get('newsql'), (self.lastt[index], 10*head.get('coverage')))
+                rows = list(cursor.fetchall())
+            self.db.db.commit()
+        except:
+            log.msg("  -> ERROR - could not read data of {}".format(dataid))
+            # columns might have changed - renew the header with the next request
+            self.headers.pop(dataid, None)
+            self.schematime = None
+        finally:
+            cursor.close()
+        return rows
+
     def sendRequest(self):
         """
         source:mysql:
         Method to obtain data from table
+        Headers are cached per table, only rows newer than the last sent time are requested
+        and all rows of a table are converted and packed together.
         """
         t1 = datetime.now(timezone.utc).replace(tzinfo=None)
         outdate = datetime.strftime(t1, "%Y-%m-%d")
@@ -185,19 +380,7 @@ class MySQLProtocol(object):
         if self.debug:
             log.msg("  -> DEBUG - Sending periodic request ...")
 
-        def getList(sql):
-            cursor = self.db.db.cursor()
-            keys=[]
-            try:
-                cursor.execute(sql)
-            except:
-                log.msg("  -> ERROR - get SQL data")
-                cursor.close()
-                return keys
-            head = cursor.fetchall()
-            keys = list(np.transpose(np.asarray(head))[0])
-            cursor.close()
-            return keys
+        self.check_schema()
 
         # get self.sensorlist
         # get last timestamps
@@ -207,119 +390,43 @@ class MySQLProtocol(object):
             sensorid = sensdict.get('sensorid')
             if self.debug:
                 log.msg("  -> DEBUG - dealing with sensor {}".format(sensorid))
-            # 1. Getting header
-            # -----------------
-            # load keys, elements and units
-            #header = "# MagPyBin %s %s %s %s %s %s %d" % (sensorid, key, ele, unit, multplier, packcode, struct.calcsize('<'+packcode))
             dataid = sensorid+'_'+self.revision
-            keyssql = 'SHOW COLUMNS FROM %s' % (dataid)
-            keystab = getList(keyssql)
-            if len(keystab) > 0:
-                if 'time' in keystab:
-                    keystab.remove('time')
-                if 'flag' in keystab:
-                    keystab.remove('flag')
-                if 'typ' in keystab:
-                    keystab.remove('typ')
-                if 'comment' in keystab:
-                    keystab.remove('comment')
-                keys = ','.join(keystab)
-                if self.debug:
-                    log.msg("  -> DEBUG - requesting header {}".format(sensorid))
-                sql1 = 'SELECT SensorElements FROM SENSORS WHERE SensorID LIKE "{}"'.format(sensorid)
-                sql2 = 'SELECT SensorKeys FROM SENSORS WHERE SensorID LIKE "{}"'.format(sensorid)
-                sql3 = 'SELECT ColumnUnits FROM DATAINFO WHERE SensorID LIKE "{}"'.format(sensorid)
-                sql4 = 'SELECT ColumnContents FROM DATAINFO WHERE SensorID LIKE "{}"'.format(sensorid)
-                try:
-                    elem = getList(sql1)[0].split(',')
-                except:
-                    elem =[]
-                try:
-                    keyssens = getList(sql2)[0].split(',')
-                except:
-                    keyssens =[]
-                try:
-                    unit = getList(sql3)[0].split(',')
-                except:
-                    unit =[]
-                try:
-                    cont = getList(sql4)[0].split(',')
-                except:
-                    cont =[]
-                units, elems = [], []
-                for key in keystab:
-                    try:
-                        pos1 = keyssens.index(key)
-                        ele = elem[pos1]
-                    except:
-                        ele = key
-                    elems.append(ele)
-                    try:
-                        pos2 = cont.index(ele)
-                        units.append(unit[pos2])
-                    except:
-                        units.append('None')
-                if self.debug:
-                    log.msg("  -> DEBUG - creating head line {}".format(sensorid))
-                multplier = '['+','.join(map(str, [10000]*len(keystab)))+']'
-                packcode = '6HL'+''.join(['q']*len(keystab))
-                header = ("# MagPyBin {} {} {} {} {} {} {}".format(sensorid, '['+','.join(keystab)+']', '['+','.join(elems)+']', '['+','.join(units)+']', multplier, packcode, struct.calcsize('<'+packcode)))
-
+            # 1. Getting header (cached)
+            # -----------------
+            head = self.headers.get(dataid)
+            if not head:
+                head = self.get_header(sensorid, dataid)
+                if not head:
+                    continue
+                self.headers[dataid] = head
                 if self.debug:
-                    print ("DATA header", header)
-
-                # 2. Getting dict
-                sql = 'SELECT DataSamplingRate FROM DATAINFO WHERE SensorID LIKE "{}"'.format(sensorid)
-                sr = float(getList(sql)[0])
-                coverage = int(self.requestrate/sr)+120
-
-                # 3. Getting data
-                # get data and create typical message topic
-                # based on sampling rate and collection rate -> define coverage
-                data = self.db.get_lines(dataid, coverage)
-                self.db.db.commit()
+                    print ("DATA header", head.get('header'))
 
-                #li = sorted(self.db.select('time,'+keys, dataid, expert='ORDER BY time DESC LIMIT {}'.format(int(coverage))))
-                if not self.lastt[index]:
-                    self.lastt[index]=data.ndarray[0][0]
-
-                data = data.trim(starttime=self.lastt[index])
-                if self.debug:
-                    print ("DATA content", len(data), self.lastt[index])
-
-                # transpose
-                dataarray = data.ndarray
-                orglist = [col for col in dataarray if len(col) == len(dataarray[0])]
-                newli = np.transpose(orglist)
-
-                for dataline in newli:
-                    timestamp = dataline[0]
-                    data_bin = None
-                    datearray = ''
-                    try:
-                        datearray = mm.datetime_to_array(timestamp)
-                        for i, para in enumerate(keystab):
-                            try:
-                                val = int(float(dataline[i + 1]) * 10000)
-                            except:
-                                val = 999990000
-                            datearray.append(val)
-                        data_bin = struct.pack('<' + packcode, *datearray)  # little endian
-                    except:
-                        log.msg('Error while packing binary data')
-
-                    if not self.confdict.get('bufferdirectory', '') == '' and data_bin:
-                        mm.data_to_file(self.confdict.get('bufferdirectory'), sensorid, bufferfilename, data_bin,
-                                        header)
-                    if self.debug:
-                        log.msg("  -> DEBUG - sending ... {}".format(','.join(list(map(str, datearray))), header))
-                    self.sendData(sensorid, ','.join(list(map(str, datearray))), header, len(newli) - 1,
-                                  fullhead=data.header)
+            # 2. Getting data
+            rows = self.get_new_rows(index, dataid, head)
+            if self.debug:
+                print ("DATA content", len(rows), self.lastt[index])
+            if not rows:
+                continue
 
-                self.lastt[index] = newli[-1][0]
+            # 3. Converting and packing the whole block
+            header = head.get('header')
+            try:
+                introws, data_bin = pack_block([row[0] for row in rows], [row[1:] for row in rows])
+            except:
+                log.msg('Error while packing binary data')
+                continue
+            if not self.confdict.get('bufferdirectory', '') == '':
+                mm.data_to_file(self.confdict.get('bufferdirectory'), sensorid, bufferfilename, data_bin, header)
+            lines = [','.join(map(str, datearray)) for datearray in introws.tolist()]
+            for line in lines:
                 if self.debug:
-                    print ("NEW STARTTIME", self.lastt[index])
+                    log.msg("  -> DEBUG - sending ... {}".format(line))
+                self.sendData(sensorid, line, header, len(lines) - 1, fullhead=head.get('meta'))
 
+            self.lastt[index] = rows[-1][0]
+            if self.debug:
+                print ("NEW STARTTIME", self.lastt[index])
 
         t2 = datetime.now(timezone.utc).replace(tzinfo=None)
         if self.debug:
@@ -382,6 +489,22 @@ class TestMySQLProtocol(unittest.TestCase):
         my = MySQLProtocol(None,sensordict,confdict)
         print (my.sensorlist)
 
+    def test_pack_block(self):
+        times = [datetime(2025,3,4,5,6,7,890123), datetime(2024,12,31,23,59,59,999999)]
+        values = [[1.23456, None], [-2.5, 20000.1]]
+        introws, data_bin = pack_block(times, values)
+        expected = b''
+        for t, row in zip(times, values):
+            datearray = mm.datetime_to_array(t)
+            for v in row:
+                try:
+                    datearray.append(int(float(v) * 10000))
+                except:
+                    datearray.append(999990000)
+            self.assertEqual(introws.tolist()[len(expected)//struct.calcsize('<6HLqq')], datearray)
+            expected += struct.pack('<6HLqq', *datearray)
+        self.assertEqual(data_bin, expected)
+
 
 
 if __name__ == "__main__":
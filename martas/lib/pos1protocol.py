@@ -13,7 +13,9 @@ from datetime import datetime, timezone
 from twisted.protocols.basic import LineReceiver
 from twisted.python import log
 from martas.core import methods as mm
-import sys
+from martas.core.framing import FrameAssembler
+
+POS1_FRAMELENGTH = 44
 
 
 ## POS1 protocol
@@ -65,6 +67,8 @@ class POS1Protocol(LineReceiver):
 
         delimiter = '\x00'
         self.buffer = ''
+        # 44 byte records terminated by the delimiter
+        self.assembler = FrameAssembler(POS1_FRAMELENGTH, endtag=delimiter.encode('ascii'))
 
         # QOS
         self.qos=int(confdict.get('mqttqos',0))
@@ -170,83 +174,53 @@ class POS1Protocol(LineReceiver):
         return ','.join(list(map(str,datearray))), header
 
     def dataReceived(self, data):
-        dataarray = ""
-        head = ""
         topic = self.confdict.get('station') + '/' + self.sensordict.get('sensorid')
-        # extract only ascii characters
-        if sys.version_info >= (3,0):
-            data = data.decode()
+        if not isinstance(data, bytes):
+            data = data.encode()
 
-        ok = False
-        try:
-            if len(self.buffer) == 44:
-                dataarray, head = self.processPos1Data(self.buffer[:44])
-                self.buffer = ''
+        resyncs = self.assembler.resyncs
+        frames = self.assembler.feed(data)
+        if self.assembler.resyncs > resyncs:
+            log.msg('POS1 - Protocol: String contains bad data. Deleting. ({} bytes discarded so far)'.format(self.assembler.discarded))
+
+        for frame in frames:
+            try:
+                dataarray, head = self.processPos1Data(bytes(frame).decode())
                 try:
                     value = float(dataarray.split(',')[7])
                 except:
                     value = 0.0
-                if value > 0:
-                    ok = True
-                else:
-                    log.err('POS1 - Protocol: Zero value, skipping. (Value still written to file.)')
-            self.buffer = self.buffer + data
-            if len(self.buffer) > 44:
-                log.msg('POS1 - Protocol: Warning: Bufferlength (%s) exceeds 44 characters, fixing...' % len(self.buffer))
-                if repr(data).endswith("x00'"):    # check if last part read is end of POS string.
-                    datatest = (len(self.buffer))%44
-                    # OPTION 1: Data is good, but too much arrived at once. Split and process.
-                    if datatest == 0:
-                        dataparts = int(len(self.buffer)/44)
-                        log.msg('POS1 - Protocol: It appears multiple parts came in at once, # of parts:', dataparts)
-                        for i in range(dataparts):
-                            split_data_string = self.buffer[i*44:(i*44)+44]
-                            log.msg('POS1 - Protocol: Processing data part # %s in string (%s)' % (str(i+1), split_data_string))
-                            dataarray, head = self.processPos1Data(split_data_string)
-                            try:
-                                value = float(dataarray.split(',')[7])
-                            except:
-                                value = 0.0
-                            if value > 0:
-                                ok = True
-                            else:
-                                log.err('POS1 - Protocol: Zero value, skipping. (Value still written to file.)')
-                        self.buffer = ''
-                    # OPTION 2: Data is bad; bit was lost.
-                    else:
-                        log.msg('POS1 - Protocol: String contains bad data. Deleting. (String content: %s)' % self.buffer)
-                        self.buffer = ''              # If true, bad data. Log and delete.
-                else:    # if last part read is not end of POS string, continue reading.
-                    log.msg('POS1 - Protocol: Attempting to fix buffer... last part read:', self.buffer[-10:], "Bufferlength:", len(self.buffer))
-        except:
-            print('{}: Data seems not be POS1Data: Looks like {}'.format(self.sensordict.get('protocol'),data))
-            ok = False
-
-
-        if ok:
-            senddata = False
-            coll = int(self.sensordict.get('stack'))
-            if coll > 1:
-                self.metacnt = 1 # send meta data with every block
-                if self.datacnt < coll:
-                    self.datalst.append(dataarray)
-                    self.datacnt += 1
-                else:
-                    senddata = True
-                    dataarray = ';'.join(self.datalst)
-                    self.datalst = []
-                    self.datacnt = 0
+            except:
+                print('{}: Data seems not be POS1Data: Looks like {}'.format(self.sensordict.get('protocol'),bytes(frame)))
+                continue
+            if value > 0:
+                self.publishData(topic, dataarray, head)
+            else:
+                log.err('POS1 - Protocol: Zero value, skipping. (Value still written to file.)')
+
+    def publishData(self, topic, dataarray, head):
+        senddata = False
+        coll = int(self.sensordict.get('stack'))
+        if coll > 1:
+            self.metacnt = 1 # send meta data with every block
+            if self.datacnt < coll:
+                self.datalst.append(dataarray)
+                self.datacnt += 1
             else:
                 senddata = True
-
-            if senddata:
-                self.client.publish(topic+"/data", dataarray, qos=self.qos)
-                if self.count == 0:
-                    add = "SensorID:{},StationID:{},DataPier:{},SensorModule:{},SensorGroup:{},SensorDecription:{},DataTimeProtocol:{},DataNTPTimeDelay:{}".format( self.sensordict.get('sensorid',''),self.confdict.get('station',''),self.sensordict.get('pierid',''),self.sensordict.get('protocol',''),self.sensordict.get('sensorgroup',''),self.sensordict.get('sensordesc',''),self.sensordict.get('ptime',''), self.timedelay )
-                    self.client.publish(topic+"/dict", add, qos=self.qos)
-                    self.client.publish(topic+"/meta", head, qos=self.qos)
-
-                self.count += 1
-                if self.count >= self.metacnt:
-                    self.count = 0
-
+                dataarray = ';'.join(self.datalst)
+                self.datalst = []
+                self.datacnt = 0
+        else:
+            senddata = True
+
+        if senddata:
+            self.client.publish(topic+"/data", dataarray, qos=self.qos)
+            if self.count == 0:
+                add = "SensorID:{},StationID:{},DataPier:{},SensorModule:{},SensorGroup:{},SensorDecription:{},DataTimeProtocol:{},DataNTPTimeDelay:{}".format( self.sensordict.get('sensorid',''),self.confdict.get('station',''),self.sensordict.get('pierid',''),self.sensordict.get('protocol',''),self.sensordict.get('sensorgroup',''),self.sensordict.get('sensordesc',''),self.sensordict.get('ptime',''), self.timedelay )
+                self.client.publish(topic+"/dict", add, qos=self.qos)
+                self.client.publish(topic+"/meta", head, qos=self.qos)
+
+            self.count += 1
+            if self.count >= self.metacnt:
+                self.count = 0
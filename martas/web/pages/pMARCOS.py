@@ -3,6 +3,9 @@
 from magpy.stream import *
 from martas.version import __version__
 import martas.core.methods as mm
+from martas.core import freshness as fr
+from martas.core.livestore import LiveBuffer
+from martas.core.decimation import DecimationCache, point_budget
 import dash
 from dash import html, dash_table, dcc, Output, Input, callback
 import dash_daq as daq
@@ -13,6 +16,7 @@ from crontab import CronTab
 import psutil
 from pathlib import Path
 import numpy as np
+import threading
 
 """
 DESCRIPTION:
@@ -68,6 +72,19 @@ if webcfg.get('read_initial_buffer',False) in ['False','false','FALSE', False]:
     read_initial_buffer = False
 if webcfg.get('debug',False) in ['True','true','TRUE', True]:
     debug = True
+# refresh interval of the database status snapshot in seconds
+statusrefresh = int(webcfg.get('statusrefresh', 30))
+# interval for re-checking outdated looking entries of the freshness index in seconds
+statusrecheck = int(webcfg.get('statusrecheck', 300))
+recheckstate = {'last': None}
+# server side decimation of the plotted traces
+plotwidth = int(webcfg.get('plotwidth', 1200))
+tracecache = DecimationCache(method=webcfg.get('plotdecimation', 'minmax'))
+# latest data of each data table (only new records are read on updates)
+livebuffers = {}
+# one lock per data table - overlapping callbacks must not add the same records twice
+livebufferlocks = {}
+livebufferslock = threading.Lock()
 
 
 statusdict = {"archive" : {"space" : 400, "used": 150, "cronenabled": False, "active": False, "logstatus":False },
@@ -76,10 +93,60 @@ statusdict = {"archive" : {"space" : 400, "used": 150, "cronenabled": False, "ac
               }
 
 
+def _get_table_columns(db):
+    """
+    DESCRIPTION
+        all tables of the database and their columns with a single INFORMATION_SCHEMA query
+    RETURNS
+        dictionary {tablename: [columns]}
+    """
+    columns = {}
+    cursor = db.db.cursor()
+    try:
+        cursor.execute("SELECT TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME, ORDINAL_POSITION")
+        for tablename, column in cursor.fetchall():
+            columns.setdefault(tablename, []).append(column)
+    finally:
+        cursor.close()
+    return columns
+
+
+def _get_last_inputs(db, tables, batch=50, debug=False):
+    """
+    DESCRIPTION
+        time of the last input of all tables. Values are taken from the freshness index
+        (DATAFRESHNESS), remaining tables are queried with UNION queries of MAX(time)
+        in batches. Every statusrecheck seconds index values older than one hour are queried
+        as well, as not all writers update the index. Query results are added to the index
+        without lowering newer index values.
+    RETURNS
+        dictionary {tablename: datetime}
+    """
+    lasttimes = {}
+    try:
+        indextables, indexed = fr.read_freshness(db, debug=debug)
+    except Exception:
+        indexed = None
+    indexed = indexed or {}
+    lasttimes = {el: indexed.get(el) for el in tables if fr.valid_lasttime(indexed.get(el))}
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    maxage = None
+    if not recheckstate.get('last') or (now - recheckstate.get('last')).total_seconds() >= statusrecheck:
+        # one hour corresponds to the "actual" state of the table
+        maxage = 3600
+        recheckstate['last'] = now
+    scanned = fr.union_lasttimes(db, fr.stale_tables(tables, indexed, maxage=maxage, now=now), batch=batch, debug=debug)
+    if scanned:
+        fr.store_scanned(db, scanned, indexed, debug=debug)
+    lasttimes.update(scanned)
+    return lasttimes
+
+
 def get_datainfo_from_db(cred='cobsdb', debug=False):
     """
     DESCRIPTION
         select all datatables from database, check DATAINFO, check contents
+        (one query for all table columns, last inputs from the freshness index or batched MAX(time) queries)
     RETURNS
         dictionary with DataID, SensorID, datatable ok, DATAINFO ok, last input, first input, StationID, PierID
     """
@@ -106,23 +173,8 @@ def get_datainfo_from_db(cred='cobsdb', debug=False):
                 usedkeys.append(allkeys[i+1])
         return usedkeys, components, counits
 
-    def _get_column_names(tablename):
-        keys = []
-        sql = "SELECT * FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = '{}'".format(tablename)
-        cursor = db.db.cursor()
-        msg = db._executesql(cursor, sql)
-        n = cursor.fetchall()
-        for l in n:
-            keys.append(l[3])
-        # drop time column and only return keys with more then time
-        if len(keys) > 1:
-            return keys[1:]
-        else:
-            return []
-
     # Check whether DB still available
     result = {}
-    missingdatainfo = []
     now = datetime.now(timezone.utc).replace(tzinfo=None)
 
     if db:
@@ -131,12 +183,8 @@ def get_datainfo_from_db(cred='cobsdb', debug=False):
             #print ("Columns", elem[3],elem[4])
             usedkeys, components, units = _analyse_columns(elem[3],elem[4])
             result[elem[0]] = {"SensorID":elem[1],"StationID":elem[2],"PierID":elem[5],"DataKeys":usedkeys,"DataElements":components,"DataUnits":units,"TableExists":False,"DataInfoExists":True,"FirstInput":None,"LastInput":None,"Actual":0}
-        sql = "SHOW TABLES"
-        cursor = db.db.cursor()
-        msg = db._executesql(cursor, sql)
-        n = cursor.fetchall()
-        for elem in n:
-            tablename = elem[0]
+        tablecolumns = _get_table_columns(db)
+        for tablename in sorted(tablecolumns):
             if tablename.count("_") == 3:
                 #follows the naming convention of MagPy
                 cont = result.get(tablename, None)
@@ -144,41 +192,90 @@ def get_datainfo_from_db(cred='cobsdb', debug=False):
                     cont["TableExists"] = True
                     result[tablename] = cont
                 else:
-                    missingdatainfo.append(tablename)
-        for elem in missingdatainfo:
-            # Get columns of existing data
-            keys = _get_column_names(elem)
-            if len(keys) > 0:
-                result[elem] = {"SensorID":elem[:-5],"StationID":"","PierID":"","DataKeys":keys,"TableExists":True,"DataInfoExists":False,"FirstInput":None,"LastInput":None,"Actual":0}
-            else:
-                if debug:
-                    print("ERROR with table {}: no data keys".format(elem))
-
-        # Update start and enddate for all DataID
-        for elem in result:
+                    # drop time column and only use tables with more then time
+                    keys = tablecolumns.get(tablename)[1:]
+                    if len(keys) > 0:
+                        result[tablename] = {"SensorID":tablename[:-5],"StationID":"","PierID":"","DataKeys":keys,"TableExists":True,"DataInfoExists":False,"FirstInput":None,"LastInput":None,"Actual":0}
+                    else:
+                        if debug:
+                            print("ERROR with table {}: no data keys".format(tablename))
+
+        # Update enddate for all DataID
+        existing = [elem for elem in result if result.get(elem).get("TableExists")]
+        lasttimes = _get_last_inputs(db, existing, debug=debug)
+        for elem in existing:
             cont = result.get(elem)
-            #print (elem)
-            if cont.get("TableExists"):
-                try:
-                    l = db.get_lines(elem, 1)
-                    cont['LastInput'] = l.end()
-                    diff = (now - l.end()).total_seconds()
-                    if diff < 3600: # Threshold corresponds to maximal graph range - only those can be plotted
-                        cont["Actual"] = 2
-                    elif diff < 87000: # data younger then 1 day
-                        cont["Actual"] = 1
-                    cont['TimeDiff'] = diff
-                    result[elem] = cont
-                except:
-                    if debug:
-                        print ("ERROR with get_lines in table {}".format(elem))
-                    pass
+            lasttime = lasttimes.get(elem)
+            if not lasttime:
+                if debug:
+                    print ("ERROR with last input of table {}".format(elem))
+                continue
+            cont['LastInput'] = lasttime
+            diff = (now - lasttime).total_seconds()
+            if diff < 3600: # Threshold corresponds to maximal graph range - only those can be plotted
+                cont["Actual"] = 2
+            elif diff < 87000: # data younger then 1 day
+                cont["Actual"] = 1
+            cont['TimeDiff'] = diff
+            result[elem] = cont
+        try:
+            db.db.close()
+        except Exception:
+            pass
 
         if debug:
             print ("Summary", result)
         return result
 
 
+class DatainfoSnapshot(object):
+    """
+    DESCRIPTION
+        in-memory snapshot of get_datainfo_from_db which is refreshed by a background thread
+        every interval seconds - dash callbacks only read the snapshot
+    """
+
+    def __init__(self, cred='cobsdb', interval=30, debug=False):
+        self.cred = cred
+        self.interval = interval
+        self.debug = debug
+        self.result = {}
+        self.updated = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def refresh(self):
+        try:
+            result = get_datainfo_from_db(cred=self.cred, debug=self.debug)
+        except Exception as e:
+            print ("Status snapshot: refresh failed - {}".format(e))
+            return False
+        if result is None:
+            # database not available - keep the last snapshot
+            return False
+        with self.lock:
+            self.result = result
+            self.updated = datetime.now(timezone.utc).replace(tzinfo=None)
+        return True
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.refresh()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="DatainfoSnapshot")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def get(self):
+        with self.lock:
+            return self.result
+
+
 def convert_datainfo_to_datatable(result, debug=False):
     """
     DESCRIPTION
@@ -277,19 +374,53 @@ def get_graph_keys(tablename, result):
     return keyoptions, keyvalue
 
 
+def _livebuffer_lock(datatable):
+    with livebufferslock:
+        lock = livebufferlocks.get(datatable)
+        if lock is None:
+            lock = threading.Lock()
+            livebufferlocks[datatable] = lock
+    return lock
+
+
 def get_data(datatable, keys, datainfo=None, duration=60, cred="cobsdb"):
+    """
+    DESCRIPTION
+        latest data of datatable. The records are kept in a ring buffer (LiveBuffer) per table,
+        on updates only records newer than the last one are read from the database. Reading
+        and extending the buffer of a table is done under a per-table lock.
+    """
     mydata = {}
     names = []
-    db = mm.connect_db(cred, False, False)
-    # This job needs including trim needs about 1 sec on my comp
-    stream = db.get_lines(datatable, 36000)
-    endtime = stream.timerange()[1]
-    stream = stream.trim(starttime=endtime-timedelta(minutes=duration), endtime=endtime)
-    mydata['time'] = stream.ndarray[0]
+    with _livebuffer_lock(datatable):
+        db = mm.connect_db(cred, False, False)
+        buf = livebuffers.get(datatable)
+        if buf is None:
+            buf = LiveBuffer(36000)
+            livebuffers[datatable] = buf
+        stream = DataStream()
+        if db:
+            try:
+                if not len(buf):
+                    # This job needs including trim needs about 1 sec on my comp
+                    stream = db.get_lines(datatable, 36000)
+                else:
+                    lasttime = buf.last(amount=1)[0][-1].item()
+                    stream = db.read(datatable, starttime=lasttime+timedelta(microseconds=1), endtime=datetime.now(timezone.utc).replace(tzinfo=None))
+            finally:
+                try:
+                    db.db.close()
+                except Exception:
+                    pass
+        if stream.length()[0] > 0:
+            columns = {key: stream._get_column(key) for key in stream._get_key_headers() if key in DataStream().NUMKEYLIST}
+            buf.extend(stream.ndarray[0], columns)
+        times, columns = buf.last(seconds=duration*60)
+    mydata['time'] = times
     for key in keys:
         name = key
         #name = stream.get_key_name(key) # get name from results
-        mydata[name] = stream._get_column(key)
+        mydata[name] = columns.get(key, np.array([]))
         names.append(name)
     return mydata, names
 
@@ -486,7 +617,10 @@ def get_marcos_html(statusdict,marcos,i):
 
 
 # Initialize basic result dictionary (fast interval, graph and table)
-result = get_datainfo_from_db(cred=dbcred, debug=debug)
+snapshot = DatainfoSnapshot(cred=dbcred, interval=statusrefresh, debug=debug)
+snapshot.refresh()
+snapshot.start()
+result = snapshot.get()
 dtable, dcols = convert_datainfo_to_datatable(result)
 dataoptions, datavalue = get_graph_options(result)
 keyoptions, keyvalue = get_graph_keys(datavalue, result)
@@ -1015,7 +1149,7 @@ def update_marcos7_status(n):
               Output('key-dropdown', 'value'),
               Input('data-dropdown', 'value'))
 def update_keydrop(datavalue):
-    result = get_datainfo_from_db(cred=dbcred)
+    result = snapshot.get()
     keyoptions, keyvalue = get_graph_keys(datavalue, result)
     return keyoptions, keyvalue
 
@@ -1025,7 +1159,7 @@ def update_keydrop(datavalue):
 def update_table_update(datavalue):
     #print ("updating table")
     global dbcred
-    result = get_datainfo_from_db(cred=dbcred)
+    result = snapshot.get()
     if datavalue.startswith("Sensor"):
         dtable, dcols = convert_datainfo_to_datatable(result)
     else:
@@ -1048,7 +1182,7 @@ def update_graph(n, hvalue, duration, datavalue, keyvalue):
     # read data
     #print ("Get available data sets")
     global dbcred
-    result = get_datainfo_from_db(cred=dbcred)
+    result = snapshot.get()
 
     data, names = get_data(datavalue, [keyvalue], datainfo=result, duration=duration, cred=dbcred)
     fig = make_subplots(rows=len(names), cols=1, vertical_spacing=0.1)
@@ -1075,13 +1209,15 @@ def update_graph(n, hvalue, duration, datavalue, keyvalue):
     }
     fig['layout']['legend'] = {'x': 0, 'y': 1, 'xanchor': 'left'}
     fig.update_layout(height=int(hvalue))
+    budget = point_budget(width=plotwidth, height=int(hvalue), rows=len(names))
 
     i = 0
     for name in names:
             i += 1
+            x, y = tracecache.get((datavalue, name), data['time'], data[name], int(duration)*60, budget)
             fig.add_trace({
-                'x': data['time'],
-                'y': data[name],
+                'x': x,
+                'y': y,
                 'name': name,
                 'mode': 'lines+markers',
                 'type': 'scatter'
@@ -4,6 +4,8 @@ from magpy.stream import *
 from magpy.core.methods import is_number
 from magpy.opt import cred as mpcred
 from martas.core import methods as mm
+from martas.core.livestore import LiveBuffer
+from martas.core.decimation import DecimationCache, point_budget
 from martas import collector as mcoll
 from martas.version import __version__
 import dash
@@ -61,6 +63,9 @@ class MartasPage(object):
 
         self.defaultheight = int(webcfg.get('defaultheight', 450))
         self.defaultduration = int(webcfg.get('defaultcoverage', 10))
+        # server side decimation of the plotted traces
+        self.plotwidth = int(webcfg.get('plotwidth', 1200))
+        self.tracecache = DecimationCache(method=webcfg.get('plotdecimation', 'minmax'))
         if self.defaultduration > 60:
             self.defaultduration = 60
         self.data2show = self.get_new_data()
@@ -78,7 +83,10 @@ class MartasPage(object):
             print("Using buffer to get initial data")
             for d in self.data2show:
                 data, names, anames, sr, sensorid = self.extract_data(d,duration=self.defaultduration*60)
-                self.livedata[sensorid] = {'samplingrate': sr, 'names': names, 'allnames': anames, 'data': data}
+                # fill the ring buffer of the sensor with the buffer file contents
+                livebuffer = LiveBuffer()
+                livebuffer.extend(data.get('time',[]), {name: data[name] for name in names})
+                self.livedata[sensorid] = {'samplingrate': sr, 'names': names, 'allnames': anames, 'data': livebuffer}
         print ("Display refresh rate: {} sec".format(self.srate))
         # now create initial outputs:
         self.sl = self.get_sensors(debug=False)
@@ -312,9 +320,9 @@ class MartasPage(object):
 
             PARAMETERS:
                 linelimit:  store this amount of data within the array: 36000 would contain 1hour in 10Hz/0.1sec resolution
+                            (capacity of the ring buffer (LiveBuffer) of each sensor)
             """
             #global livedata
-            values = []
             config = self.cfg
 
             broker = config.get("broker","")
@@ -433,7 +441,7 @@ class MartasPage(object):
                     uns = sensorcont.get('SensorUnits','').split(',')
                     sr = sensorcont.get("samplingrate",1)
                     pc = sensorcont.get('PackingCode', '')
-                    datacont = sensorcont.get('data', {})
+                    datacont = sensorcont.get('data')
                     #print ("Existing datacont", datacont)
                     if content == 'meta':
                         #print ("FOUND META ---------------------------")
@@ -457,42 +465,33 @@ class MartasPage(object):
                             plc = pl.replace("\n", "").split(":")
                             sensorcont[plc[0]] = plc[1].replace('-', '')
                     elif content == 'data' and len(keys) > 0 and not keys==['']:
+                        if not isinstance(datacont, LiveBuffer):
+                            datacont = LiveBuffer(linelimit)
+                        for i, k in enumerate(keys):
+                            if not k == "sectime" and k in DataStream().KEYLIST:
+                                namelst.append(els[i])
                         payloadlist = payload.split(';')
                         for dataline in payloadlist:
                             datalist = dataline.split(',')
                             datalist = [int(el) if is_number(el) else el for el in datalist]
                             #print (datalist, array)
                             timel = [int(t) for t in datalist[:7]]
-                            values.append(timel)
-                            ti = list(datacont.get('time',[]))
-                            ti.append(datetime(*timel))
-                            ti = ti[-linelimit:]
-                            if len(ti) > 5 and not sensorcont.get("samplingrate",None):
-                                # determine sampling rate if not set already from file data - needed for maximum display range
-                                sensorcont["samplingrate"] = np.median(np.diff(ti)).total_seconds()
-                            datacont['time'] = np.asarray(ti)
-                            #print ("Length of time column", len(ti))
+                            sample = {}
                             if pc.endswith('6hL'):
                                 sectimel = [int(t) for t in datalist[-7:]]
-                                sti = list(datacont.get('sectime',[]))
-                                sti.append(datetime(*sectimel))
-                                sti = sti[-linelimit:]
-                                datacont['sectime'] = np.asarray(sti)
+                                sample['sectime'] = datetime(*sectimel)
                             for i, k in enumerate(keys):
                                 if not k == "sectime" and k in DataStream().KEYLIST:
                                     nam = els[i]
-                                    namelst.append(nam)
                                     if k in DataStream().NUMKEYLIST:
-                                        dat = list(datacont.get(nam, []))
-                                        dat.append(float(datalist[7 + i]) / float(multi[i]))
-                                        dat = dat[-linelimit:]
-                                        datacont[nam] = np.asarray(dat)
+                                        sample[nam] = float(datalist[7 + i]) / float(multi[i])
                                     else:
-                                        dat = list(datacont.get(nam, []))
-                                        dat.append(datalist[7 + i])
-                                        dat = dat[-linelimit:]
-                                        datacont[nam] = np.asarray(dat)
-                        # limit length of array
+                                        sample[nam] = datalist[7 + i]
+                            # O(1) append to the ring buffer (limited to linelimit samples)
+                            datacont.append(datetime(*timel), sample)
+                        if not sensorcont.get("samplingrate",None):
+                            # determine sampling rate if not set already from file data - needed for maximum display range
+                            sensorcont["samplingrate"] = datacont.samplingrate()
                         sensorcont['allnames'] = namelst
                         # by default limit to three shown diagrams for each sensor
                         sensorcont['names'] = namelst[:3]
@@ -872,24 +871,24 @@ def martas_update_graph(n, hvalue, duration):
         }
         fig['layout']['legend'] = {'x': 0, 'y': 1, 'xanchor': 'left'}
         fig.update_layout(height=int(hvalue))
+        budget = point_budget(width=mapa.plotwidth, height=int(hvalue), rows=len(all_names))
 
         i = 0
         for f in mapa.livedata:
             if f in mapa.sensors_to_plot:
                 ndd = mapa.livedata[f]
-                sr = ndd.get('samplingrate',None)
-                if sr:
-                    amount = int(cov/sr)
-                    #print ("Cutting down to", amount, cov, sr)
-                else:
-                    amount = cov ## assuming 1Hz
                 data = ndd.get('data')
                 names = ndd.get('names')
+                if not isinstance(data, LiveBuffer):
+                    continue
+                # zero-copy views of the last cov seconds
+                times, columns = data.last(seconds=cov)
                 for name in names:
                     i += 1
+                    x, y = mapa.tracecache.get((f, name), times, columns.get(name, []), cov, budget)
                     fig.add_trace({
-                        'x': data['time'][-amount:],
-                        'y': data[name][-amount:],
+                        'x': x,
+                        'y': y,
                         'name': name,
                         'mode': 'lines+markers',
                         'type': 'scatter'
@@ -4,6 +4,8 @@
     var serveraddr= location.host.split(':')[0];
     console.log(serveraddr);
     var wsconnection = new WebSocket('ws://' +serveraddr+ ':5000/');
+    // binary frames of the batched mode (socketbinary) are received as ArrayBuffer
+    wsconnection.binaryType = 'arraybuffer';
     var signals = {};
     var descrFields = {};
     var table;
@@ -116,15 +118,41 @@
                 console.log('new header: sensor ' + signals[signalid].sensorid);
                 //debug.innerHTML = 'new header: sensor ' + signals[signalid].sensorid;
             }
+        } else if (e.data instanceof ArrayBuffer) {
+            // binary data (batched mode):
+            // uint16 len, sensorid, padding to 8 bytes, uint32 samples, uint32 columns,
+            // int64 msec[samples], float32 values[samples x columns] - little endian
+            var view = new DataView(e.data);
+            var len = view.getUint16(0, true);
+            var sensor = new TextDecoder().decode(new Uint8Array(e.data, 2, len));
+            var offset = Math.ceil((2 + len) / 8) * 8;
+            var n = view.getUint32(offset, true);
+            var ncol = view.getUint32(offset + 4, true);
+            offset += 8;
+            for (var j=0; j < n; j++) {
+                var msec = Number(view.getBigInt64(offset + 8*j, true));
+                var row = [msec];
+                for (var k=0; k < ncol; k++) {
+                    row.push(view.getFloat32(offset + 8*n + 4*(j*ncol + k), true));
+                }
+                showData(sensor, row);
+            }
         } else {
             // data
-            // sensorid: timestamp,data0,data1...
-            var data = e.data.split(': ');
-            var sensor = data[0];
+            // sensorid: timestamp,data0,data1... (batched mode: one line per sample)
+            var lines = e.data.split('\n');
+            for (var j=0; j < lines.length; j++) {
+                var data = lines[j].split(': ');
+                showData(data[0], data[1].split(','));
+            }
+        }
+        // console.log('data from collector: ' + e.data);
+    };
+
+    function showData(sensor, data_arr) {
             if (signals[sensor+'#0'] == null) {
                 // no header yet
             } else {
-                var data_arr = data[1].split(',');
                 for (i=0; i < data_arr.length-1; i++) {
                     var signalid = sensor +'#'+ i.toString();
                     // catch not selected signals in non default mode
@@ -142,8 +170,6 @@
                     //debug.innerHTML = data_arr[i+1];
                 }
             }
-        }
-        // console.log('data from collector: ' + e.data);
     };
     wsconnection.onopen = function (){
         console.log('websocket connection open');